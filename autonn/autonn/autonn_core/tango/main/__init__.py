@@ -9,6 +9,9 @@ Pth  = apps.get_model('autonn_core', 'Pth' )
 
 import requests
 import json
+import threading
+import time
+from collections import OrderedDict
 from pathlib import Path
 COMMON_ROOT = Path("/shared/common")
 DATASET_ROOT = Path("/shared/datasets")
@@ -17,15 +20,53 @@ CFG_PATH = CORE_DIR / 'tango' / 'common' / 'cfg'
 
 DEBUG = False
 
-def status_update(userid, project_id, update_id=None, update_content=None):
+STATUS_URL = 'http://projectmanager:8085/status_update'
+STATUS_BULK_URL = 'http://projectmanager:8085/status_update_bulk'
+STATUS_QUEUE_SIZE = 1024        # pending updates kept while P.M. is slow or restarting
+STATUS_BATCH_SIZE = 64          # updates sent per flush
+STATUS_FLUSH_INTERVAL = 0.5     # seconds between flushes
+STATUS_MAX_RETRIES = 3          # attempts per update before it is dropped
+STATUS_TIMEOUT = 5              # seconds per HTTP request
+# only the latest value of these matters to the dashboard, a newer one replaces a pending one
+COALESCED_UPDATE_IDS = ('train_loss', 'val_accuracy', 'train_dataset', 'val_dataset', 'batchsize')
+
+
+class StatusReporter:
     """
-    Update AutoNN status for P.M. to visualize the progress on their dashboard
+    Background client which delivers AutoNN status updates to P.M.
+
+    Callers only enqueue; a daemon thread flushes the queue in batches over a
+    keep-alive session (P.M.'s /status_update_bulk) and mirrors the latest update_id into Info.progress.
+    Snapshot-like updates (COALESCED_UPDATE_IDS) replace a pending update of
+    the same project and id and move to the back of the queue, except the
+    last step of an epoch which P.M. stores as a row of its own. When the
+    queue is full the oldest snapshot is dropped, or the new update if there
+    is none; failed sends are retried up to STATUS_MAX_RETRIES times.
     """
-    try:
-        url = 'http://projectmanager:8085/status_update'
-        headers = {
-            'Content-Type' : 'application/json'
-        }
+    def __init__(self, url=STATUS_URL, bulk_url=STATUS_BULK_URL, maxsize=STATUS_QUEUE_SIZE):
+        self.url = url
+        self.bulk_url = bulk_url  # set to None when P.M. has no bulk endpoint
+        self.maxsize = maxsize
+        self._cond = threading.Condition()
+        self._pending = OrderedDict()   # key: [payload, retries]
+        self._busy = False
+        self._seq = 0
+        self._thread = None
+        self._session = None
+        self.dropped = 0
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # a forked child (mp.Process) inherits neither the sender thread nor a usable lock
+        self._cond = threading.Condition()
+        self._pending = OrderedDict()
+        self._busy = False
+        self._thread = None
+        self._session = None
+
+    def submit(self, userid, project_id, update_id=None, update_content=None):
+        # serialize now, callers keep mutating their dicts after this returns
         payload = {
             'container_id' : "autonn",
             'user_id' : userid,
@@ -33,21 +74,155 @@ def status_update(userid, project_id, update_id=None, update_content=None):
             'update_id' : update_id,
             'update_content' : json.dumps(update_content),
         }
-        response = requests.post(url, headers=headers, data=json.dumps(payload))
-        # temp printing
+        with self._cond:
+            self._ensure_thread()
+            key = self._key(payload, update_content)
+            if key in self._pending:
+                self._pending[key][0] = payload  # coalesce
+                self._pending.move_to_end(key)  # behind anything queued meanwhile, e.g. a last step
+            else:
+                if len(self._pending) >= self.maxsize and not self._drop_one():
+                    self.dropped += 1
+                    return False
+                self._pending[key] = [payload, 0]
+            self._cond.notify()
+        return True
+
+    def flush(self, timeout=None):
+        # Blocks until everything queued so far has been sent (or dropped)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            if self._thread is None or not self._thread.is_alive():
+                return not self._pending
+            while self._pending or self._busy:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def _key(self, payload, content):
+        update_id = payload['update_id']
+        if update_id in COALESCED_UPDATE_IDS:
+            last_step = isinstance(content, dict) and 'step' in content \
+                and str(content.get('step')) == str(content.get('total_step'))
+            if not last_step:
+                return (payload['user_id'], payload['project_id'], update_id)
+        self._seq += 1
+        return self._seq
+
+    def _drop_one(self):
+        for key in self._pending:
+            if isinstance(key, tuple):  # oldest snapshot
+                del self._pending[key]
+                self.dropped += 1
+                return True
+        return False
+
+    def _ensure_thread(self):
+        # start the sender lazily, in the process which actually reports
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='autonn-status', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+            time.sleep(STATUS_FLUSH_INTERVAL)  # let a burst of updates coalesce
+            with self._cond:
+                batch = []
+                while self._pending and len(batch) < STATUS_BATCH_SIZE:
+                    batch.append(self._pending.popitem(last=False))
+                self._busy = True
+            failed = []
+            try:
+                failed = self._send(batch)
+                self._save_progress([item[0] for _, item in batch])
+            except Exception as e:
+                print(f"[AutoNN status_update] exception: {e}")
+            finally:
+                with self._cond:
+                    for key, item in reversed(failed):
+                        item[1] += 1
+                        if item[1] >= STATUS_MAX_RETRIES:
+                            self.dropped += 1
+                        elif key not in self._pending:  # a newer snapshot wins over a retry
+                            self._pending[key] = item
+                            self._pending.move_to_end(key, last=False)
+                    self._busy = False
+                    self._cond.notify_all()
+                if failed:
+                    time.sleep(STATUS_FLUSH_INTERVAL * 2)  # back off while P.M. is unreachable
+
+    def _send(self, batch):
+        if self._session is None:
+            self._session = requests.Session()
+            self._session.headers.update({'Content-Type' : 'application/json'})
         if DEBUG:
             import pprint
-            print(f"_________POST /status_update [ {update_id} ]_________")
-            pprint.pprint(update_content, indent=2, depth=3, compact=False)
+            for _, (payload, _) in batch:
+                print(f"_________POST /status_update [ {payload['update_id']} ]_________")
+                pprint.pprint(json.loads(payload['update_content']), indent=2, depth=3, compact=False)
+        if self.bulk_url and len(batch) > 1:
+            try:
+                response = self._session.post(self.bulk_url,
+                                              data=json.dumps([item[0] for _, item in batch]),
+                                              timeout=STATUS_TIMEOUT)
+                if response.status_code >= 500:
+                    return batch  # nothing was applied, try again later
+                if response.status_code != 404:
+                    return []  # per-item errors are P.M.'s business, resending would not help
+                self.bulk_url = None  # older P.M., fall back to one request per update
+            except requests.RequestException as e:
+                print(f"[AutoNN status_update] bulk of {len(batch)}: {e}")
+                return batch
+        failed = []
+        for i, (key, item) in enumerate(batch):
+            payload = item[0]
+            try:
+                self._session.post(self.url, data=json.dumps(payload), timeout=STATUS_TIMEOUT)
+            except requests.RequestException as e:
+                print(f"[AutoNN status_update] {payload['update_id']}: {e}")
+                failed.append((key, item))
+                failed += batch[i + 1:]  # P.M. is down, keep the rest for the next round
+                break
+        return failed
+
+    def _save_progress(self, payloads):
+        from django.db import close_old_connections
+        progress = {}
+        for p in payloads:
+            progress[(p['user_id'], p['project_id'])] = p['update_id']
+        for (userid, project_id), update_id in progress.items():
+            Info.objects.filter(userid=userid, project_id=project_id).update(progress=update_id)
+        close_old_connections()
+
+
+# this package is imported both as 'tango.main' and 'autonn_core.tango.main', share one reporter between them
+_reporter = next((m._reporter for m in list(sys.modules.values())
+                  if getattr(m, '__file__', None) == __file__ and hasattr(m, '_reporter')), None) \
+            or StatusReporter()
 
-        info = Info.objects.get(userid=userid, project_id=project_id)
-        info.progress = update_id
-        info.save()
-        # print('\n'+'='*14+' AutoNN Status Update '+ '='*14)
-        # info.print()
 
+def status_update(userid, project_id, update_id=None, update_content=None):
+    """
+    Update AutoNN status for P.M. to visualize the progress on their dashboard
+
+    This never blocks, the update is queued and delivered in the background.
+    """
+    try:
+        _reporter.submit(userid, project_id, update_id, update_content)
     except Exception as e:
         print(f"[AutoNN status_update] exception: {e}")
 
 
+def status_flush(timeout=30):
+    """
+    Wait until queued status updates are delivered, e.g. before the process ends
+    """
+    return _reporter.flush(timeout)
+
+
 # __all__ = ['status_update']
@@ -17,6 +17,7 @@ from tango.utils.general import (   check_img_size,
                                     check_imshow,
                                     non_max_suppression,
                                     non_max_suppression_v9,
+                                    non_max_suppression_batched,
                                     scale_coords, 
                                     xyxy2xywh,      ) 
 from tango.utils.plots import plot_one_box
@@ -108,7 +109,8 @@ def detect(weights, cfg, view_img=True, save_img=False, save_txt=False):
         t2 = time_synchronized()
 
         # Apply NMS ------------------------------------------------------------
-        pred = non_max_suppression_v9(pred) #, opt.conf_thres, opt.iou_thres, classes=opt.classes, agnostic=opt.agnostic_nms)
+        pred, counts = non_max_suppression_batched(pred, v9=True) #, opt.conf_thres, opt.iou_thres, classes=opt.classes, agnostic=opt.agnostic_nms)
+        pred = [det[:n] for det, n in zip(pred, counts.tolist())]
         logger.info(f"\t2. nms      : {len(pred)} imgs, {pred[0].shape}")
         t3 = time_synchronized()
         
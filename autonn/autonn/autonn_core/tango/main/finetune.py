@@ -69,6 +69,7 @@ from tango.common.models.resnet_cifar10     import ClassifyModel
 # from tango.common.models import *
 from tango.utils.autoanchor import check_anchors
 from tango.utils.autobatch import get_batch_size_for_gpu
+from tango.utils.checkpoint import CheckpointWriter
 from tango.utils.datasets import create_dataloader
 from tango.utils.general import (   labels_to_class_weights,
                                     labels_to_image_weights,
@@ -120,6 +121,7 @@ def finetune(proj_info, subnet, hyp, opt, data_dict, tb_writer=None):
     for d in subnet.yaml['depth_list']:
         d_str += str(d)
     search_best = wdir / f'subnet{d_str}.pt'
+    ckpt_writer = CheckpointWriter() # saves .pt files off the training loop
 
     # Device -------------------------------------------------------------------
     device = select_device(opt.device)
@@ -363,142 +365,145 @@ def finetune(proj_info, subnet, hyp, opt, data_dict, tb_writer=None):
                 # f'Logging results to {save_dir}\n'
                 f'Starting finetuing for {epochs} epochs...')
     # torch.save(model, wdir / 'init.pt')
-    for epoch in range(start_epoch, epochs):
-        subnet.train()
-
-        # Update image weights (optional)
-        if opt.image_weights:
-            # Generate indices
-            if rank in [-1, 0]:
-                cw = subnet.class_weights.cpu().numpy() * (1 - maps) ** 2 / nc  # class weights
-                iw = labels_to_image_weights(dataset.labels, nc=nc, class_weights=cw)  # image weights
-                dataset.indices = random.choices(range(dataset.n), weights=iw, k=dataset.n)  # rand weighted idx
-            # Broadcast if DDP
-            if rank != -1:
-                indices = (torch.tensor(dataset.indices) if rank == 0 else torch.zeros(dataset.n)).int()
-                dist.broadcast(indices, 0)
-                if rank != 0:
-                    dataset.indices = indices.cpu().numpy()
+    try:
+        for epoch in range(start_epoch, epochs):
+            subnet.train()
+
+            # Update image weights (optional)
+            if opt.image_weights:
+                # Generate indices
+                if rank in [-1, 0]:
+                    cw = subnet.class_weights.cpu().numpy() * (1 - maps) ** 2 / nc  # class weights
+                    iw = labels_to_image_weights(dataset.labels, nc=nc, class_weights=cw)  # image weights
+                    dataset.indices = random.choices(range(dataset.n), weights=iw, k=dataset.n)  # rand weighted idx
+                # Broadcast if DDP
+                if rank != -1:
+                    indices = (torch.tensor(dataset.indices) if rank == 0 else torch.zeros(dataset.n)).int()
+                    dist.broadcast(indices, 0)
+                    if rank != 0:
+                        dataset.indices = indices.cpu().numpy()
     
-        # Update mosaic border
-        # b = int(random.uniform(0.25 * imgsz, 0.75 * imgsz + gs) // gs * gs)
-        # dataset.mosaic_border = [b - imgsz, -b]  # height, width borders
+            # Update mosaic border
+            # b = int(random.uniform(0.25 * imgsz, 0.75 * imgsz + gs) // gs * gs)
+            # dataset.mosaic_border = [b - imgsz, -b]  # height, width borders
     
-        # mean loss
-        mloss = torch.zeros(4, device=device)  # mean losses
-
-        # distribute data
-        if rank != -1:
-            dataloader.sampler.set_epoch(epoch)
-
-        # progress bar
-        pbar = enumerate(dataloader)
-        # logger.info(('\n' + '%10s' * 8) % ('Epoch', 'gpu_mem', 'box', 'obj', 'cls', 'total', 'labels', 'img_size'))
-        # if rank in [-1, 0]:
-        #     pbar = tqdm(pbar, total=nb)  # progress bar
-
-        # optimizer.zero_grad()
-        # finetuing batches start ==============================================
-        for i, (imgs, targets, paths, _) in pbar:
-            ni = i + nb * epoch  # number integrated batches (since train start)
-            imgs = imgs.to(device, non_blocking=True).float() / 255.0  # uint8 to float32, 0-255 to 0.0-1.0
+            # mean loss
+            mloss = torch.zeros(4, device=device)  # mean losses
+
+            # distribute data
+            if rank != -1:
+                dataloader.sampler.set_epoch(epoch)
+
+            # progress bar
+            pbar = enumerate(dataloader)
+            # logger.info(('\n' + '%10s' * 8) % ('Epoch', 'gpu_mem', 'box', 'obj', 'cls', 'total', 'labels', 'img_size'))
+            # if rank in [-1, 0]:
+            #     pbar = tqdm(pbar, total=nb)  # progress bar
+
+            # optimizer.zero_grad()
+            # finetuing batches start ==============================================
+            for i, (imgs, targets, paths, _) in pbar:
+                ni = i + nb * epoch  # number integrated batches (since train start)
+                imgs = imgs.to(device, non_blocking=True).float() / 255.0  # uint8 to float32, 0-255 to 0.0-1.0
     
-            # Warmup
-            if ni <= nw:
-                xi = [0, nw]  # x interp
-                # model.gr = np.interp(ni, xi, [0.0, 1.0])  # iou loss ratio (obj_loss = 1.0 or iou)
-                accumulate = max(1, np.interp(ni, xi, [1, nbs / total_batch_size]).round())
-                for j, x in enumerate(optimizer.param_groups):
-                    # bias lr falls from 0.1 to lr0, all other lrs rise from 0.0 to lr0
-                    x['lr'] = np.interp(ni, xi, [hyp['warmup_bias_lr'] if j == 2 else 0.0, x['initial_lr'] * lf(epoch)])
-                    if 'momentum' in x:
-                        x['momentum'] = np.interp(ni, xi, [hyp['warmup_momentum'], hyp['momentum']])
+                # Warmup
+                if ni <= nw:
+                    xi = [0, nw]  # x interp
+                    # model.gr = np.interp(ni, xi, [0.0, 1.0])  # iou loss ratio (obj_loss = 1.0 or iou)
+                    accumulate = max(1, np.interp(ni, xi, [1, nbs / total_batch_size]).round())
+                    for j, x in enumerate(optimizer.param_groups):
+                        # bias lr falls from 0.1 to lr0, all other lrs rise from 0.0 to lr0
+                        x['lr'] = np.interp(ni, xi, [hyp['warmup_bias_lr'] if j == 2 else 0.0, x['initial_lr'] * lf(epoch)])
+                        if 'momentum' in x:
+                            x['momentum'] = np.interp(ni, xi, [hyp['warmup_momentum'], hyp['momentum']])
             
-            # Multi-scale
-            if opt.multi_scale:
-                sz = random.randrange(imgsz * 0.5, imgsz * 1.5 + gs) // gs * gs  # size
-                sf = sz / max(imgs.shape[2:])  # scale factor
-                if sf != 1:
-                    ns = [math.ceil(x * sf / gs) * gs for x in imgs.shape[2:]]  # new shape (stretched to gs-multiple)
-                    imgs = F.interpolate(imgs, size=ns, mode='bilinear', align_corners=False)     
+                # Multi-scale
+                if opt.multi_scale:
+                    sz = random.randrange(imgsz * 0.5, imgsz * 1.5 + gs) // gs * gs  # size
+                    sf = sz / max(imgs.shape[2:])  # scale factor
+                    if sf != 1:
+                        ns = [math.ceil(x * sf / gs) * gs for x in imgs.shape[2:]]  # new shape (stretched to gs-multiple)
+                        imgs = F.interpolate(imgs, size=ns, mode='bilinear', align_corners=False)     
                     
-            # Forward
-            # with amp.autocast(enabled=cuda):
-            pred = subnet(imgs)  # forward
-            if 'loss_ota' not in hyp or hyp['loss_ota'] == 1:
-                loss, loss_items = compute_loss_ota(pred, targets.to(device), imgs)  # loss scaled by batch_size
-            else:
-                loss, loss_items = compute_loss(pred, targets.to(device))  # loss scaled by batch_size
-            if rank != -1:
-                loss *= opt.world_size  # gradient averaged between devices in DDP mode
-            if opt.quad:
-                loss *= 4.    
+                # Forward
+                # with amp.autocast(enabled=cuda):
+                pred = subnet(imgs)  # forward
+                if 'loss_ota' not in hyp or hyp['loss_ota'] == 1:
+                    loss, loss_items = compute_loss_ota(pred, targets.to(device), imgs)  # loss scaled by batch_size
+                else:
+                    loss, loss_items = compute_loss(pred, targets.to(device))  # loss scaled by batch_size
+                if rank != -1:
+                    loss *= opt.world_size  # gradient averaged between devices in DDP mode
+                if opt.quad:
+                    loss *= 4.    
             
-            # Backward
-            # scaler.scale(loss).backward()
-            loss.requires_grad_(True)
-            loss.backward()
-
-            # Optimize
-            if ni % accumulate == 0:
-                # scaler.step(optimizer)  # optimizer.step
-                # scaler.update()
-                optimizer.step()
-                optimizer.zero_grad()
-                if ema:
-                    ema.update(subnet)
+                # Backward
+                # scaler.scale(loss).backward()
+                loss.requires_grad_(True)
+                loss.backward()
+
+                # Optimize
+                if ni % accumulate == 0:
+                    # scaler.step(optimizer)  # optimizer.step
+                    # scaler.update()
+                    optimizer.step()
+                    optimizer.zero_grad()
+                    if ema:
+                        ema.update(subnet)
                     
-            # Print
-            if rank in [-1, 0]:
-                mloss = (mloss * i + loss_items) / (i + 1)  # update mean losses
-                mem = '%.3gG' % (torch.cuda.memory_reserved() / 1E9 if torch.cuda.is_available() else 0)  # (GB)
-                s = ('%10s' * 2 + '%10.4g' * 6) % (
-                    '%g/%g' % (epoch, epochs - 1), mem, *mloss, targets.shape[0], imgs.shape[-1])
-                # pbar.set_description(s)
-        # finetuning batches end ===============================================
+                # Print
+                if rank in [-1, 0]:
+                    mloss = (mloss * i + loss_items) / (i + 1)  # update mean losses
+                    mem = '%.3gG' % (torch.cuda.memory_reserved() / 1E9 if torch.cuda.is_available() else 0)  # (GB)
+                    s = ('%10s' * 2 + '%10.4g' * 6) % (
+                        '%g/%g' % (epoch, epochs - 1), mem, *mloss, targets.shape[0], imgs.shape[-1])
+                    # pbar.set_description(s)
+            # finetuning batches end ===============================================
         
-        # Scheduler
-        lr = [x['lr'] for x in optimizer.param_groups]  # for tensorboard
-        scheduler.step()
+            # Scheduler
+            lr = [x['lr'] for x in optimizer.param_groups]  # for tensorboard
+            scheduler.step()
         
-        # DDP process 0 or single-GPU test =====================================
-        if rank in [-1, 0]:
-            # mAP
-            ema.update_attr(subnet, include=['yaml', 'nc', 'hyp', 'gr', 'names', 'stride', 'class_weights'])
-            final_epoch = epoch + 1 == epochs
-            if not opt.notest or final_epoch:  # Calculate mAP
-                # wandb_logger.current_epoch = epoch + 1
-                results, maps, times =  test.test(proj_info,
-                                                  data_dict,
-                                                  batch_size=opt.batch_size, # * 2,
-                                                  imgsz=imgsz_test,
-                                                  model=ema.ema,
-                                                  conf_thres=0.001,
-                                                  iou_thres=0.7,
-                                                  single_cls=opt.single_cls,
-                                                  dataloader=testloader,
-                                                  verbose=nc < 50 and final_epoch,
-                                                  # save_dir=save_dir,
-                                                  save_json=False,
-                                                  plots=False,
-                                                  is_coco=is_coco,
-                                                  metric=opt.metric)
-            # Update best mAP
-            fi = fitness(np.array(results).reshape(1, -1))  # weighted combination of [P, R, mAP@.5, mAP@.5-.95]
-            if fi > best_fitness:
-                best_fitness = fi
+            # DDP process 0 or single-GPU test =====================================
+            if rank in [-1, 0]:
+                # mAP
+                ema.update_attr(subnet, include=['yaml', 'nc', 'hyp', 'gr', 'names', 'stride', 'class_weights'])
+                final_epoch = epoch + 1 == epochs
+                if not opt.notest or final_epoch:  # Calculate mAP
+                    # wandb_logger.current_epoch = epoch + 1
+                    results, maps, times =  test.test(proj_info,
+                                                      data_dict,
+                                                      batch_size=opt.batch_size, # * 2,
+                                                      imgsz=imgsz_test,
+                                                      model=ema.ema,
+                                                      conf_thres=0.001,
+                                                      iou_thres=0.7,
+                                                      single_cls=opt.single_cls,
+                                                      dataloader=testloader,
+                                                      verbose=nc < 50 and final_epoch,
+                                                      # save_dir=save_dir,
+                                                      save_json=False,
+                                                      plots=False,
+                                                      is_coco=is_coco,
+                                                      metric=opt.metric)
+                # Update best mAP
+                fi = fitness(np.array(results).reshape(1, -1))  # weighted combination of [P, R, mAP@.5, mAP@.5-.95]
+                if fi > best_fitness:
+                    best_fitness = fi
                 
-            if best_fitness == fi:
-                ckpt = {'epoch': epoch,
-                        'best_fitness': best_fitness,
-                        # 'training_results': results_file.read_text(),
-                        'model': deepcopy(subnet.module if is_parallel(subnet) else subnet).half(),
-                        'ema': deepcopy(ema.ema).half(),
-                        'updates': ema.updates,
-                        'optimizer': optimizer.state_dict()}
-                torch.save(ckpt, search_best)
-                del ckpt
-        # end validation =======================================================
+                if best_fitness == fi:
+                    ckpt = {'epoch': epoch,
+                            'best_fitness': best_fitness,
+                            # 'training_results': results_file.read_text(),
+                            'model': subnet.module if is_parallel(subnet) else subnet, # staged as half
+                            'ema': ema.ema,
+                            'updates': ema.updates,
+                            'optimizer': optimizer.state_dict()}
+                    ckpt_writer.save(ckpt, [search_best])
+                    del ckpt
+            # end validation =======================================================
+    finally:
+        ckpt_writer.close() # wait for the last checkpoint, also when an epoch raises
 
     # end finetuning -----------------------------------------------------------
     if not rank in [-1, 0]:
@@ -540,6 +545,7 @@ def finetune_hyp(proj_info, basemodel, hyp, opt, data_dict, tb_writer=None):
     wdir = save_dir / 'weights'
     wdir.mkdir(parents=True, exist_ok=True)  # make dir
     search_best = wdir / f'hyp_{gen:04d}.pt'
+    ckpt_writer = CheckpointWriter() # saves .pt files off the training loop
 
     # Device -------------------------------------------------------------------
     device = select_device(opt.device)
@@ -826,144 +832,147 @@ def finetune_hyp(proj_info, basemodel, hyp, opt, data_dict, tb_writer=None):
                 # f'Logging results to {save_dir}\n'
                 f'Starting finetuing for {epochs} epochs...')
     # torch.save(model, wdir / 'init.pt')
-    for epoch in range(start_epoch, epochs):
-        net.train()
-
-        # Update image weights (optional)
-        if opt.image_weights:
-            # Generate indices
-            if rank in [-1, 0]:
-                cw = net.class_weights.cpu().numpy() * (1 - maps) ** 2 / nc  # class weights
-                iw = labels_to_image_weights(dataset.labels, nc=nc, class_weights=cw)  # image weights
-                dataset.indices = random.choices(range(dataset.n), weights=iw, k=dataset.n)  # rand weighted idx
-            # Broadcast if DDP
-            if rank != -1:
-                indices = (torch.tensor(dataset.indices) if rank == 0 else torch.zeros(dataset.n)).int()
-                dist.broadcast(indices, 0)
-                if rank != 0:
-                    dataset.indices = indices.cpu().numpy()
+    try:
+        for epoch in range(start_epoch, epochs):
+            net.train()
+
+            # Update image weights (optional)
+            if opt.image_weights:
+                # Generate indices
+                if rank in [-1, 0]:
+                    cw = net.class_weights.cpu().numpy() * (1 - maps) ** 2 / nc  # class weights
+                    iw = labels_to_image_weights(dataset.labels, nc=nc, class_weights=cw)  # image weights
+                    dataset.indices = random.choices(range(dataset.n), weights=iw, k=dataset.n)  # rand weighted idx
+                # Broadcast if DDP
+                if rank != -1:
+                    indices = (torch.tensor(dataset.indices) if rank == 0 else torch.zeros(dataset.n)).int()
+                    dist.broadcast(indices, 0)
+                    if rank != 0:
+                        dataset.indices = indices.cpu().numpy()
     
-        # Update mosaic border
-        # b = int(random.uniform(0.25 * imgsz, 0.75 * imgsz + gs) // gs * gs)
-        # dataset.mosaic_border = [b - imgsz, -b]  # height, width borders
+            # Update mosaic border
+            # b = int(random.uniform(0.25 * imgsz, 0.75 * imgsz + gs) // gs * gs)
+            # dataset.mosaic_border = [b - imgsz, -b]  # height, width borders
     
-        # mean loss
-        mloss = torch.zeros(4, device=device)  # mean losses
-
-        # distribute data
-        if rank != -1:
-            dataloader.sampler.set_epoch(epoch)
-
-        # progress bar
-        pbar = enumerate(dataloader)
-        # logger.info(('\n' + '%10s' * 8) % ('Epoch', 'gpu_mem', 'box', 'obj', 'cls', 'total', 'labels', 'img_size'))
-        # if rank in [-1, 0]:
-        #     pbar = tqdm(pbar, total=nb)  # progress bar
-
-        # optimizer.zero_grad()
-        # finetuing batches start ==============================================
-        for i, (imgs, targets, paths, _) in pbar:
-            ni = i + nb * epoch  # number integrated batches (since train start)
-            imgs = imgs.to(device, non_blocking=True).float() / 255.0  # uint8 to float32, 0-255 to 0.0-1.0
+            # mean loss
+            mloss = torch.zeros(4, device=device)  # mean losses
+
+            # distribute data
+            if rank != -1:
+                dataloader.sampler.set_epoch(epoch)
+
+            # progress bar
+            pbar = enumerate(dataloader)
+            # logger.info(('\n' + '%10s' * 8) % ('Epoch', 'gpu_mem', 'box', 'obj', 'cls', 'total', 'labels', 'img_size'))
+            # if rank in [-1, 0]:
+            #     pbar = tqdm(pbar, total=nb)  # progress bar
+
+            # optimizer.zero_grad()
+            # finetuing batches start ==============================================
+            for i, (imgs, targets, paths, _) in pbar:
+                ni = i + nb * epoch  # number integrated batches (since train start)
+                imgs = imgs.to(device, non_blocking=True).float() / 255.0  # uint8 to float32, 0-255 to 0.0-1.0
     
-            # Warmup
-            if ni <= nw:
-                xi = [0, nw]  # x interp
-                # model.gr = np.interp(ni, xi, [0.0, 1.0])  # iou loss ratio (obj_loss = 1.0 or iou)
-                accumulate = max(1, np.interp(ni, xi, [1, nbs / total_batch_size]).round())
-                for j, x in enumerate(optimizer.param_groups):
-                    # bias lr falls from 0.1 to lr0, all other lrs rise from 0.0 to lr0
-                    x['lr'] = np.interp(ni, xi, [hyp['warmup_bias_lr'] if j == 2 else 0.0, x['initial_lr'] * lf(epoch)])
-                    if 'momentum' in x:
-                        x['momentum'] = np.interp(ni, xi, [hyp['warmup_momentum'], hyp['momentum']])
+                # Warmup
+                if ni <= nw:
+                    xi = [0, nw]  # x interp
+                    # model.gr = np.interp(ni, xi, [0.0, 1.0])  # iou loss ratio (obj_loss = 1.0 or iou)
+                    accumulate = max(1, np.interp(ni, xi, [1, nbs / total_batch_size]).round())
+                    for j, x in enumerate(optimizer.param_groups):
+                        # bias lr falls from 0.1 to lr0, all other lrs rise from 0.0 to lr0
+                        x['lr'] = np.interp(ni, xi, [hyp['warmup_bias_lr'] if j == 2 else 0.0, x['initial_lr'] * lf(epoch)])
+                        if 'momentum' in x:
+                            x['momentum'] = np.interp(ni, xi, [hyp['warmup_momentum'], hyp['momentum']])
             
-            # Multi-scale
-            if opt.multi_scale:
-                sz = random.randrange(imgsz * 0.5, imgsz * 1.5 + gs) // gs * gs  # size
-                sf = sz / max(imgs.shape[2:])  # scale factor
-                if sf != 1:
-                    ns = [math.ceil(x * sf / gs) * gs for x in imgs.shape[2:]]  # new shape (stretched to gs-multiple)
-                    imgs = F.interpolate(imgs, size=ns, mode='bilinear', align_corners=False)     
+                # Multi-scale
+                if opt.multi_scale:
+                    sz = random.randrange(imgsz * 0.5, imgsz * 1.5 + gs) // gs * gs  # size
+                    sf = sz / max(imgs.shape[2:])  # scale factor
+                    if sf != 1:
+                        ns = [math.ceil(x * sf / gs) * gs for x in imgs.shape[2:]]  # new shape (stretched to gs-multiple)
+                        imgs = F.interpolate(imgs, size=ns, mode='bilinear', align_corners=False)     
                     
-            # Forward
-            optimizer.zero_grad()
-            # with amp.autocast(enabled=cuda):
-            pred = net(imgs)  # forward
-            # if 'loss_ota' not in hyp or hyp['loss_ota'] == 1:
-            if 'OTA' in opt.loss_name: #opt.loss_name == 'OTA':
-                loss, loss_items = compute_loss_ota(pred, targets.to(device), imgs)  # loss scaled by batch_size
-            else:
-                loss, loss_items = compute_loss(pred, targets.to(device))  # loss scaled by batch_size
-            if rank != -1:
-                loss *= opt.world_size  # gradient averaged between devices in DDP mode
-            if opt.quad:
-                loss *= 4.    
-            
-            # Backward
-            # scaler.scale(loss).backward()
-            loss.requires_grad_(True)
-            loss.backward()
-
-            # Optimize
-            if ni % accumulate == 0:
-                # scaler.step(optimizer)  # optimizer.step
-                # scaler.update()
-                optimizer.step()
+                # Forward
                 optimizer.zero_grad()
-                if ema:
-                    ema.update(net)
+                # with amp.autocast(enabled=cuda):
+                pred = net(imgs)  # forward
+                # if 'loss_ota' not in hyp or hyp['loss_ota'] == 1:
+                if 'OTA' in opt.loss_name: #opt.loss_name == 'OTA':
+                    loss, loss_items = compute_loss_ota(pred, targets.to(device), imgs)  # loss scaled by batch_size
+                else:
+                    loss, loss_items = compute_loss(pred, targets.to(device))  # loss scaled by batch_size
+                if rank != -1:
+                    loss *= opt.world_size  # gradient averaged between devices in DDP mode
+                if opt.quad:
+                    loss *= 4.    
+            
+                # Backward
+                # scaler.scale(loss).backward()
+                loss.requires_grad_(True)
+                loss.backward()
+
+                # Optimize
+                if ni % accumulate == 0:
+                    # scaler.step(optimizer)  # optimizer.step
+                    # scaler.update()
+                    optimizer.step()
+                    optimizer.zero_grad()
+                    if ema:
+                        ema.update(net)
                     
-            # Print
-            if rank in [-1, 0]:
-                mloss = (mloss * i + loss_items) / (i + 1)  # update mean losses
-                mem = '%.3gG' % (torch.cuda.memory_reserved() / 1E9 if torch.cuda.is_available() else 0)  # (GB)
-                s = ('%10s' * 2 + '%10.4g' * 6) % (
-                    '%g/%g' % (epoch, epochs - 1), mem, *mloss, targets.shape[0], imgs.shape[-1])
-                # pbar.set_description(s)
-        # finetuning batches end ===============================================
+                # Print
+                if rank in [-1, 0]:
+                    mloss = (mloss * i + loss_items) / (i + 1)  # update mean losses
+                    mem = '%.3gG' % (torch.cuda.memory_reserved() / 1E9 if torch.cuda.is_available() else 0)  # (GB)
+                    s = ('%10s' * 2 + '%10.4g' * 6) % (
+                        '%g/%g' % (epoch, epochs - 1), mem, *mloss, targets.shape[0], imgs.shape[-1])
+                    # pbar.set_description(s)
+            # finetuning batches end ===============================================
         
-        # Scheduler
-        lr = [x['lr'] for x in optimizer.param_groups]  # for tensorboard
-        scheduler.step()
+            # Scheduler
+            lr = [x['lr'] for x in optimizer.param_groups]  # for tensorboard
+            scheduler.step()
         
-        # DDP process 0 or single-GPU test =====================================
-        if rank in [-1, 0]:
-            # mAP
-            ema.update_attr(net, include=['yaml', 'nc', 'hyp', 'gr', 'names', 'stride', 'class_weights'])
-            final_epoch = epoch + 1 == epochs
-            if not opt.notest or final_epoch:  # Calculate mAP
-                # wandb_logger.current_epoch = epoch + 1
-                results, maps, times =  test.test(proj_info,
-                                                  data_dict,
-                                                  batch_size=opt.batch_size, # * 2,
-                                                  imgsz=imgsz_test,
-                                                  model=ema.ema,
-                                                  conf_thres=0.001,
-                                                  iou_thres=0.7,
-                                                  single_cls=opt.single_cls,
-                                                  dataloader=testloader,
-                                                  verbose=nc < 50 and final_epoch,
-                                                  # save_dir=save_dir,
-                                                  save_json=False,
-                                                  plots=False,
-                                                  is_coco=is_coco,
-                                                  metric=opt.metric)
-            # Update best mAP
-            fi = fitness(np.array(results).reshape(1, -1))  # weighted combination of [P, R, mAP@.5, mAP@.5-.95]
-            if fi > best_fitness:
-                best_fitness = fi
+            # DDP process 0 or single-GPU test =====================================
+            if rank in [-1, 0]:
+                # mAP
+                ema.update_attr(net, include=['yaml', 'nc', 'hyp', 'gr', 'names', 'stride', 'class_weights'])
+                final_epoch = epoch + 1 == epochs
+                if not opt.notest or final_epoch:  # Calculate mAP
+                    # wandb_logger.current_epoch = epoch + 1
+                    results, maps, times =  test.test(proj_info,
+                                                      data_dict,
+                                                      batch_size=opt.batch_size, # * 2,
+                                                      imgsz=imgsz_test,
+                                                      model=ema.ema,
+                                                      conf_thres=0.001,
+                                                      iou_thres=0.7,
+                                                      single_cls=opt.single_cls,
+                                                      dataloader=testloader,
+                                                      verbose=nc < 50 and final_epoch,
+                                                      # save_dir=save_dir,
+                                                      save_json=False,
+                                                      plots=False,
+                                                      is_coco=is_coco,
+                                                      metric=opt.metric)
+                # Update best mAP
+                fi = fitness(np.array(results).reshape(1, -1))  # weighted combination of [P, R, mAP@.5, mAP@.5-.95]
+                if fi > best_fitness:
+                    best_fitness = fi
                 
-            if best_fitness == fi:
-                ckpt = {'epoch': epoch,
-                        'best_fitness': best_fitness,
-                        # 'training_results': results_file.read_text(),
-                        'model': deepcopy(net.module if is_parallel(net) else net).half(),
-                        'ema': deepcopy(ema.ema).half(),
-                        'updates': ema.updates,
-                        'optimizer': optimizer.state_dict()}
-                torch.save(ckpt, search_best)
-                del ckpt
-        # end validation =======================================================
+                if best_fitness == fi:
+                    ckpt = {'epoch': epoch,
+                            'best_fitness': best_fitness,
+                            # 'training_results': results_file.read_text(),
+                            'model': net.module if is_parallel(net) else net, # staged as half
+                            'ema': ema.ema,
+                            'updates': ema.updates,
+                            'optimizer': optimizer.state_dict()}
+                    ckpt_writer.save(ckpt, [search_best])
+                    del ckpt
+            # end validation =======================================================
+    finally:
+        ckpt_writer.close() # wait for the last checkpoint, also when an epoch raises
 
     # end finetuning -----------------------------------------------------------
     if not rank in [-1, 0]:
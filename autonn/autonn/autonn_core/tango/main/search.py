@@ -59,7 +59,8 @@ def search(proj_info, hyp, opt, data_dict, model):
     supernet = attempt_load(opt.weights, map_location=device, fused=False) # make sure it is not a fused model
 
     # build latency predictor --------------------------------------------------
-    efficiency_predictor = LatencyPredictor(target=target, target_acc=acc, device=device)
+    # the latency table is built once (one batched pass), so the GPUs are left to fine-tuning
+    efficiency_predictor = LatencyPredictor(target=target, target_acc=acc, device='cpu')
 
     # build accuracy predictor -------------------------------------------------
     accuracy_predictor = AccuracyCalculator(proj_info, hyp, opt, data_dict, supernet)
@@ -88,6 +89,7 @@ def search(proj_info, hyp, opt, data_dict, model):
         logger.info(f"found best architecture at flops <= {flops:.2f} MFLOPS in {ed-st:.2f} seconds! "
                     f"{best_info[0]*100:.2f}% predicted accuracy with {best_info[2]:.2f} MFLOPS.")
         result_list.append(best_info)
+    accuracy_predictor.close()
     logger.info(f"Complete NAS process")
 
     # save weights and configs -------------------------------------------------
@@ -36,6 +36,7 @@ from tango.utils.general import (   increment_path,
                                     strip_optimizer,
                                     colorstr        )
 from tango.utils.plots import plot_evolution
+from tango.utils.benchmark import benchmark_cfg, meets_target
 from tango.utils.wandb_logging.wandb_utils import check_wandb_resume
 
 
@@ -135,6 +136,17 @@ MODEL_TO_SIZE_TABLE = {
     }
 }
 
+MODEL_SIZE_ORDER = ("T", "S", "MS", "M", "L", "XL", "XXL") # small to large
+
+# default latency budget (ms, batch 1) when project_info has no 'latency'
+# only for targets whose models run on this kind of host, since benchmarks measure this device
+TARGET_LATENCY_TABLE = {
+    "cloud": 33.0,          # 30 fps
+    "k8s": 33.0,
+    "pcweb": 33.0,
+    "pc": 33.0,
+}
+
 logger = logging.getLogger(__name__)
 
 
@@ -361,6 +373,11 @@ def base_model_select(userid, project_id, proj_info, data, manual_select=False):
 
     # resnet and resnet-c is in the same directory
     dirname = model if task_ != 'classification-c' else model[:-1] # remove 'c' from 'resnetc'
+
+    # benchmark candidates up to the memory tier against a latency budget (ms)
+    latency = proj_info.get('latency') or TARGET_LATENCY_TABLE.get(target)
+    if not manual_select and model_size != 'NAS' and latency:
+        size = benchmark_select(model, dirname, model_size, task, latency, target_mem)
     filename = f'{model}{size}.yaml'
 
     # store basemodel.yaml
@@ -397,6 +414,34 @@ def base_model_select(userid, project_id, proj_info, data, manual_select=False):
     return target_path, basemodel
 
 
+def benchmark_select(model, dirname, model_size, task, latency, memory):
+    """
+    Largest size up to the memory tier that meets the target on this device
+
+    Each candidate yaml is benchmarked with synthetic batches (cached per yaml,
+    device and imgsz) and checked against the latency budget (ms) and the
+    memory of the target (GB, against the training footprint). The smallest
+    size is used if none fits.
+    """
+    sizes = []
+    for k in MODEL_SIZE_ORDER:
+        s = MODEL_TO_SIZE_TABLE[model][k]
+        if s not in sizes and os.path.isfile(CFG_PATH / dirname / f'{model}{s}.yaml'):
+            sizes.append(s)
+        if k == model_size:
+            break
+    if len(sizes) < 2:
+        return MODEL_TO_SIZE_TABLE[model][model_size]
+
+    logger.info(f'BMS: Benchmarking {model} {sizes} for latency <= {latency}ms, memory <= {memory}G')
+    for s in reversed(sizes):
+        result = benchmark_cfg(str(CFG_PATH / dirname / f'{model}{s}.yaml'), task)
+        if meets_target(result, latency, memory):
+            return s
+    logger.warning(f'BMS: No candidate meets the target, the smallest one is used')
+    return sizes[0]
+
+
 def backup_previous_work(model):
     m = Path(model)
     cur_dir = m.parent
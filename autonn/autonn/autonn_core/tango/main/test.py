@@ -20,8 +20,10 @@ from tango.utils.general import (   coco80_to_coco91_class,
                                     check_img_size,
                                     check_requirements,
                                     box_iou,
+                                    match_predictions,
                                     non_max_suppression,
                                     non_max_suppression_v9,
+                                    non_max_suppression_batched,
                                     scale_coords,
                                     xyxy2xywh,
                                     xywh2xyxy,
@@ -29,12 +31,14 @@ from tango.utils.general import (   coco80_to_coco91_class,
                                     increment_path,
                                     colorstr
                                 )
-from tango.utils.metrics import ap_per_class, ConfusionMatrix
+from tango.utils.metrics import ap_per_class, APAccumulator, ConfusionMatrix
 from tango.utils.plots import plot_images, output_to_target, plot_study_txt
 from tango.utils.torch_utils import select_device, time_synchronized, TracedModel
 
 logger = logging.getLogger(__name__)
 
+REPORT_INTERVAL = 10 # batches between two running P/R/mAP computations for the val_accuracy status
+
 def test(proj_info,
          data,
          weights=None,
@@ -58,7 +62,9 @@ def test(proj_info,
          half_precision=True,
          trace=False,
          is_coco=False,
-         metric='v5'):
+         metric='v5',
+         report_interval=REPORT_INTERVAL,
+         batched_nms=True):
     # Set device ---------------------------------------------------------------
     training = model is not None
     if training:  # called by train.py
@@ -157,6 +163,8 @@ def test(proj_info,
     t, t0, t1, t2 = 0., 0., 0., 0.
     loss = torch.zeros(3, device=device)
     jdict, stats, ap, ap_class = [], [], [], []
+    accumulator = APAccumulator(niou, metric=metric)
+    _mp, _mr, _map50, _map = 0., 0., 0., 0.
     # for batch_i, (img, targets, paths, shapes) in enumerate(tqdm(dataloader, desc=s)):
     for batch_i, (img, targets, paths, shapes) in enumerate(dataloader):
         img = img.to(device, non_blocking=True)
@@ -223,7 +231,11 @@ def test(proj_info,
             targets[:, 2:] *= torch.Tensor([width, height, width, height]).to(device)  # to pixels
             lb = [targets[targets[:, 0] == i, 1:] for i in range(nb)] if save_hybrid else []  # for autolabelling
             t = time_synchronized()
-            if v9:
+            if batched_nms:  # whole batch in one NMS, then per-image views of the padded output
+                out, counts = non_max_suppression_batched(out, conf_thres=conf_thres, iou_thres=iou_thres, labels=lb,
+                                                          multi_label=True, v9=v9)
+                out = [o[:c] for o, c in zip(out, counts.tolist())]
+            elif v9:
                 out = non_max_suppression_v9(out, conf_thres=conf_thres, iou_thres=iou_thres, labels=lb, multi_label=True)
             else:
                 out = non_max_suppression(out, conf_thres=conf_thres, iou_thres=iou_thres, labels=lb, multi_label=True)
@@ -232,6 +244,8 @@ def test(proj_info,
             logger.info(f"      batch #{batch_i}: Running NMS   ({_t1*1E3:.2f} ms)")
 
         # Metrics per image ----------------------------------------------------
+        image_stats = []  # (pred, tcls) per image, evaluated together below
+        pboxes, pimgs, tboxes, tclses, timgs = [], [], [], [], []
         for si, pred in enumerate(out):
             labels = targets[targets[:, 0] == si, 1:]
             nl = len(labels)
@@ -242,47 +256,25 @@ def test(proj_info,
 
             if len(pred) == 0:
                 if nl:
-                    stats.append((torch.zeros(0, niou, dtype=torch.bool), torch.Tensor(), torch.Tensor(), tcls))
+                    image_stats.append((None, tcls))
                 continue
 
             # Predictions
             predn = pred.clone()
             scale_coords(img[si].shape[1:], predn[:, :4], shapes[si][0], shapes[si][1])  # native-space pred
+            pboxes.append(predn[:, :4])
+            pimgs.append(torch.full((len(pred),), si, device=device))
+            image_stats.append((pred, tcls))
 
-            # Evaluate : assign all predictions as incorrect
-            correct = torch.zeros(pred.shape[0], niou, dtype=torch.bool, device=device)
             if nl:
-                detected = []  # target indices
-                tcls_tensor = labels[:, 0]
-
                 # target boxes
                 tbox = xywh2xyxy(labels[:, 1:5])
                 scale_coords(img[si].shape[1:], tbox, shapes[si][0], shapes[si][1])  # native-space labels
                 if plots:
                     confusion_matrix.process_batch(predn, torch.cat((labels[:, 0:1], tbox), 1))
-
-                # Per target class
-                for cls in torch.unique(tcls_tensor):
-                    ti = (cls == tcls_tensor).nonzero(as_tuple=False).view(-1)  # target indices
-                    pi = (cls == pred[:, 5]).nonzero(as_tuple=False).view(-1)  # prediction indices
-
-                    # Search for detections
-                    if pi.shape[0]:
-                        # Prediction to target ious
-                        ious, i = box_iou(predn[pi, :4], tbox[ti]).max(1)  # best ious, indices
-
-                        # Append detections
-                        detected_set = set()
-                        for j in (ious > iouv[0]).nonzero(as_tuple=False):
-                            d = ti[i[j]]  # detected target
-                            if d.item() not in detected_set:
-                                detected_set.add(d.item()) # set of int
-                                detected.append(d) # list of tensor
-                                correct[pi[j]] = ious[j] > iouv  # iou_thres is 1xn
-                                if len(detected) == nl:  # all targets already located in image
-                                    break
-            # Append statistics (correct, conf, pcls, tcls)
-            stats.append((correct.cpu(), pred[:, 4].cpu(), pred[:, 5].cpu(), tcls))
+                tboxes.append(tbox)
+                tclses.append(labels[:, 0])
+                timgs.append(torch.full((nl,), si, device=device))
 
             # Save / log
             if save_txt:
@@ -303,6 +295,27 @@ def test(proj_info,
                                   'category_id': coco91class[int(p[5])] if is_coco else int(p[5]),
                                   'bbox': [round(x, 3) for x in b],
                                   'score': round(p[4], 5)})
+
+        # Evaluate : match predictions to targets of the whole batch at once
+        if pboxes:
+            pred_all = torch.cat([p for p, _ in image_stats if p is not None])
+            correct = match_predictions(torch.cat(pboxes), pred_all[:, 5], torch.cat(pimgs),
+                                        torch.cat(tboxes) if tboxes else torch.zeros(0, 4, device=device),
+                                        torch.cat(tclses) if tclses else torch.zeros(0, device=device),
+                                        torch.cat(timgs) if timgs else torch.zeros(0, device=device),
+                                        iouv).cpu()
+            pred_all = pred_all[:, 4:6].cpu()
+        correct_i = 0
+        for pred, tcls in image_stats:
+            # Append statistics (correct, conf, pcls, tcls)
+            if pred is None:
+                accumulator.update(torch.zeros(0, niou, dtype=torch.bool), torch.Tensor(), torch.Tensor(), tcls)
+                continue
+            n = len(pred)
+            accumulator.update(correct[correct_i:correct_i + n],
+                               pred_all[correct_i:correct_i + n, 0],
+                               pred_all[correct_i:correct_i + n, 1], tcls)
+            correct_i += n
                     
         # Plot images ----------------------------------------------------------
         # if plots and batch_i < 3:
@@ -311,14 +324,9 @@ def test(proj_info,
         #     f = save_dir / f'test_batch{batch_i}_pred.jpg'  # predictions
         #     Thread(target=plot_images, args=(img, output_to_target(out), paths, f, names), daemon=True).start()
 
-        _p, _r, _f1, _mp, _mr, _map50, _map = 0., 0., 0., 0., 0., 0., 0.
-        statsn, _ap, _ap_class = [], [], []
-        statsn = deepcopy(stats)
-        statsn = [np.concatenate(x, 0) for x in zip(*statsn)]  # to numpy
-        if len(statsn) and statsn[0].any():
-            _p, _r, _ap, _f1, _ap_class = ap_per_class(*statsn, plot=plots, metric=metric, save_dir=save_dir, names=names)
-            _ap50, _ap = _ap[:, 0], _ap.mean(1)  # AP@0.5, AP@0.5:0.95
-            _mp, _mr, _map50, _map = _p.mean(), _r.mean(), _ap50.mean(), _ap.mean()
+        # running P/R/mAP, refreshed every report_interval batches (the final ones come from ap_per_class below)
+        if (batch_i + 1) % max(report_interval, 1) == 0 or batch_i + 1 == len(dataloader):
+            _mp, _mr, _map50, _map = accumulator.snapshot()
         # Status update
         # label_cnt += targets.size(0)
         val_acc['class'] = 'all'
@@ -341,7 +349,7 @@ def test(proj_info,
     # Test end =================================================================
 
     # Compute statistics -------------------------------------------------------
-    stats = [np.concatenate(x, 0) for x in zip(*stats)]  # to numpy
+    stats = accumulator.stats()  # to numpy
     if len(stats) and stats[0].any():
         p, r, ap, f1, ap_class = ap_per_class(*stats, plot=plots, metric=metric, save_dir=save_dir, names=names)
         ap50, ap = ap[:, 0], ap.mean(1)  # AP@0.5, AP@0.5:0.95
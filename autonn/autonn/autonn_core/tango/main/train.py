@@ -19,6 +19,7 @@ import torch.optim as optim
 import torch.optim.lr_scheduler as lr_scheduler
 # import torch.utils.data
 import yaml
+from django.db import close_old_connections
 from torch.cuda import amp
 from torch.nn.parallel import DistributedDataParallel as DDP
 from tqdm import tqdm
@@ -32,6 +33,7 @@ from tango.common.models.supernet_yolov7    import NASModel
 # from tango.common.models import *
 from tango.utils.autoanchor import check_anchors
 from tango.utils.autobatch import get_batch_size_for_gpu
+from tango.utils.checkpoint import CheckpointWriter
 from tango.utils.datasets import create_dataloader
 from tango.utils.general import (   DEBUG,
                                     labels_to_class_weights,
@@ -97,6 +99,7 @@ def train(proj_info, hyp, opt, data_dict, tb_writer=None):
     last = wdir / 'last.pt'
     best = wdir / 'best.pt'
     results_file = save_dir / 'results.txt'
+    ckpt_writer = CheckpointWriter() # saves .pt files off the training loop
 
     # CUDA device --------------------------------------------------------------
     device_str = ''
@@ -211,7 +214,9 @@ def train(proj_info, hyp, opt, data_dict, tb_writer=None):
                                             imgsz,
                                             bs_factor,
                                             amp_enabled=True,
-                                            max_search=True )
+                                            max_search=True,
+                                            mode=getattr(opt, 'autobatch', 'search'),
+                                            cfg=opt.cfg )
         batch_size = int(autobatch_rst) # autobatch_rst = result * bs_factor * gpu_number
     
     batch_size = min(batch_size, server_gpu_mem*2)
@@ -604,403 +609,404 @@ def train(proj_info, hyp, opt, data_dict, tb_writer=None):
     print(f'Train: start epoch = {start_epoch}, final epoch = {epochs}')
 
     # torch.save(model, wdir / 'init.pt')
-    for epoch in range(start_epoch, epochs):
-        t_epoch = time.time() #time_synchronized()
-        model.train()
+    try:
+        for epoch in range(start_epoch, epochs):
+            t_epoch = time.time() #time_synchronized()
+            model.train()
 
-        # Update image weights (optional)
-        if opt.image_weights:
+            # Update image weights (optional)
+            if opt.image_weights:
+                if task == 'detection':
+                    # Generate indices
+                    if rank in [-1, 0]:
+                        cw = model.class_weights.cpu().numpy() * (1 - maps) ** 2 / nc  # class weights
+                        iw = labels_to_image_weights(dataset.labels, nc=nc, class_weights=cw)  # image weights
+                        dataset.indices = random.choices(range(dataset.n), weights=iw, k=dataset.n)  # rand weighted idx
+                    # Broadcast if DDP
+                    if rank != -1:
+                        indices = (torch.tensor(dataset.indices) if rank == 0 else torch.zeros(dataset.n)).int()
+                        dist.broadcast(indices, 0)
+                        if rank != 0:
+                            dataset.indices = indices.cpu().numpy()
+                else:
+                    logger.warn(f"taks = {task}: only detection task supports image weight")
+
+            # Update mosaic border
+            # b = int(random.uniform(0.25 * imgsz, 0.75 * imgsz + gs) // gs * gs)
+            # dataset.mosaic_border = [b - imgsz, -b]  # height, width borders
+
+            # mean losses
             if task == 'detection':
-                # Generate indices
-                if rank in [-1, 0]:
-                    cw = model.class_weights.cpu().numpy() * (1 - maps) ** 2 / nc  # class weights
-                    iw = labels_to_image_weights(dataset.labels, nc=nc, class_weights=cw)  # image weights
-                    dataset.indices = random.choices(range(dataset.n), weights=iw, k=dataset.n)  # rand weighted idx
-                # Broadcast if DDP
-                if rank != -1:
-                    indices = (torch.tensor(dataset.indices) if rank == 0 else torch.zeros(dataset.n)).int()
-                    dist.broadcast(indices, 0)
-                    if rank != 0:
-                        dataset.indices = indices.cpu().numpy()
-            else:
-                logger.warn(f"taks = {task}: only detection task supports image weight")
-
-        # Update mosaic border
-        # b = int(random.uniform(0.25 * imgsz, 0.75 * imgsz + gs) // gs * gs)
-        # dataset.mosaic_border = [b - imgsz, -b]  # height, width borders
-
-        # mean losses
-        if task == 'detection':
-            mloss = torch.zeros(4, device=device)
-        elif task == 'classification':
-            mloss = torch.zeros(1, device=device)
-            macc = torch.zeros(1, device=device)
+                mloss = torch.zeros(4, device=device)
+            elif task == 'classification':
+                mloss = torch.zeros(1, device=device)
+                macc = torch.zeros(1, device=device)
 
-        # distribute data
-        if rank != -1:
-            dataloader.sampler.set_epoch(epoch)
+            # distribute data
+            if rank != -1:
+                dataloader.sampler.set_epoch(epoch)
 
-        # progress bar
-        pbar = enumerate(dataloader)
+            # progress bar
+            pbar = enumerate(dataloader)
 
-        logger.info(('\n' + '%10s' * 8) % ('TrainEpoch', 'GPU_Mem', 'Box', 'Obj', 'Cls', 'Total', 'Labels', 'Img_Size'))
-        # if rank in [-1, 0]:
-        #     pbar = tqdm(pbar, total=nb)  # progress bar
+            logger.info(('\n' + '%10s' * 8) % ('TrainEpoch', 'GPU_Mem', 'Box', 'Obj', 'Cls', 'Total', 'Labels', 'Img_Size'))
+            # if rank in [-1, 0]:
+            #     pbar = tqdm(pbar, total=nb)  # progress bar
 
-        train_loss = {}
-        # optimizer.zero_grad()
-        # training batches start ===============================================
-        if task == 'detection':
-            for i, (imgs, targets, paths, _) in pbar:
-                print(f"{i} {len(imgs)} imgs")
-                t_batch = time.time() #time_synchronized()
-                ni = i + nb * epoch  # number integrated batches (since train start)
-                imgs = imgs.to(device, non_blocking=True).float() / 255.0  # uint8 to float32, 0-255 to 0.0-1.0
-                # Warmup
-                if ni <= nw:
-                    xi = [0, nw]  # x interp
-                    # model.gr = np.interp(ni, xi, [0.0, 1.0])  # iou loss ratio (obj_loss = 1.0 or iou)
-                    accumulate = max(1, np.interp(ni, xi, [1, nbs / opt.total_batch_size]).round())
-                    for j, x in enumerate(optimizer.param_groups):
-                        # bias lr falls from 0.1 to lr0, all other lrs rise from 0.0 to lr0
-                        x['lr'] = np.interp(ni, xi, [hyp['warmup_bias_lr'] if j == 2 else 0.0, x['initial_lr'] * lf(epoch)])
-                        if 'momentum' in x:
-                            x['momentum'] = np.interp(ni, xi, [hyp['warmup_momentum'], hyp['momentum']])
-                            hyp[f'momentum_group{j}'] = x['momentum']
-                        else:
-                            hyp[f'momentum_group{j}'] = None
-                        hyp[f'lr_group{j}'] = x['lr']
-                    # status_update(userid, project_id,
-                    #           update_id="hyperparameter",
-                    #           update_content=hyp)
-
-                # Multi-scale
-                if opt.multi_scale:
-                    sz = random.randrange(imgsz * 0.5, imgsz * 1.5 + gs) // gs * gs  # size
-                    sf = sz / max(imgs.shape[2:])  # scale factor
-                    if sf != 1:
-                        ns = [math.ceil(x * sf / gs) * gs for x in imgs.shape[2:]]  # new shape (stretched to gs-multiple)
-                        imgs = F.interpolate(imgs, size=ns, mode='bilinear', align_corners=False)
-
-                # Forward
-                optimizer.zero_grad()
-                with amp.autocast(enabled=cuda):
-                    pred = model(imgs)  # forward
-                    print('-'*100)
-                    # if 'loss_ota' not in hyp or hyp['loss_ota'] == 1:
-                    if 'OTA' in opt.loss_name: #opt.loss_name == 'OTA':
-                        loss, loss_items = compute_loss_ota(pred, targets.to(device), imgs)  # loss scaled by batch_size
-                    else:
-                        loss, loss_items = compute_loss(pred, targets.to(device))  # loss scaled by batch_size
-                    if rank != -1:
-                        loss *= opt.world_size  # gradient averaged between devices in DDP mode
-                    if opt.quad:
-                        loss *= 4.
-                # Backward
-                scaler.scale(loss).backward()
-
-                # Optimize
-                # if ni % accumulate == 0:
-                if ni - last_opt_step >= accumulate:
-                    # https://pytorch.org/docs/master/notes/amp_examples.html
-                    scaler.unscale_(optimizer)  # unscale gradients
-                    torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=10.0)  # clip gradients                    
-                    scaler.step(optimizer)  # optimizer.step
-                    scaler.update()
+            train_loss = {}
+            # optimizer.zero_grad()
+            # training batches start ===============================================
+            if task == 'detection':
+                for i, (imgs, targets, paths, _) in pbar:
+                    print(f"{i} {len(imgs)} imgs")
+                    t_batch = time.time() #time_synchronized()
+                    ni = i + nb * epoch  # number integrated batches (since train start)
+                    imgs = imgs.to(device, non_blocking=True).float() / 255.0  # uint8 to float32, 0-255 to 0.0-1.0
+                    # Warmup
+                    if ni <= nw:
+                        xi = [0, nw]  # x interp
+                        # model.gr = np.interp(ni, xi, [0.0, 1.0])  # iou loss ratio (obj_loss = 1.0 or iou)
+                        accumulate = max(1, np.interp(ni, xi, [1, nbs / opt.total_batch_size]).round())
+                        for j, x in enumerate(optimizer.param_groups):
+                            # bias lr falls from 0.1 to lr0, all other lrs rise from 0.0 to lr0
+                            x['lr'] = np.interp(ni, xi, [hyp['warmup_bias_lr'] if j == 2 else 0.0, x['initial_lr'] * lf(epoch)])
+                            if 'momentum' in x:
+                                x['momentum'] = np.interp(ni, xi, [hyp['warmup_momentum'], hyp['momentum']])
+                                hyp[f'momentum_group{j}'] = x['momentum']
+                            else:
+                                hyp[f'momentum_group{j}'] = None
+                            hyp[f'lr_group{j}'] = x['lr']
+                        # status_update(userid, project_id,
+                        #           update_id="hyperparameter",
+                        #           update_content=hyp)
+
+                    # Multi-scale
+                    if opt.multi_scale:
+                        sz = random.randrange(imgsz * 0.5, imgsz * 1.5 + gs) // gs * gs  # size
+                        sf = sz / max(imgs.shape[2:])  # scale factor
+                        if sf != 1:
+                            ns = [math.ceil(x * sf / gs) * gs for x in imgs.shape[2:]]  # new shape (stretched to gs-multiple)
+                            imgs = F.interpolate(imgs, size=ns, mode='bilinear', align_corners=False)
+
+                    # Forward
                     optimizer.zero_grad()
-                    if ema:
-                        ema.update(model)
-                    last_opt_step = ni
-
-                # Report & Plot(option)
-                if rank in [-1, 0]:
-                    mem = '%.3gG' % (torch.cuda.memory_reserved() / 1E9 if torch.cuda.is_available() else 0)  # (GB)
-
-                    mloss = (mloss * i + loss_items) / (i + 1)  # update mean losses
-                    s = ('%10s' * 2 + '%10.4g' * 6) % (
-                        '%g/%g' % (epoch, epochs - 1), mem, *mloss, targets.shape[0], imgs.shape[-1])
-                    # pbar.set_description(s)
-                    mloss_list = mloss.to('cpu').numpy().tolist()
-                    train_loss['epoch'] = epoch + 1
-                    train_loss['total_epoch'] = epochs
-                    train_loss['gpu_mem'] = mem
-                    train_loss['box'] = mloss_list[0]
-                    train_loss['obj'] = mloss_list[1]
-                    train_loss['cls'] = mloss_list[2]
-                    train_loss['total'] = mloss_list[3]
-                    train_loss['label'] = targets.shape[0]
-                    train_loss['step'] = i + 1
-                    train_loss['total_step'] = nb
-                    train_loss['time'] = f"{(time.time() - t_batch):.1f} s"
-
-                    status_update(userid, project_id,
-                                  update_id="train_loss",
-                                  update_content=train_loss)
-                    logger.info(f'{s}')
-                    # Plot
-                    # if plots and ni < 10:
-                    #     f = save_dir / f'train_batch{ni}.jpg'  # filename
-                    #     Thread(target=plot_images, args=(imgs, targets, paths, f), daemon=True).start()
-                    #     if tb_writer:
-                    #         tb_writer.add_image(f, result, dataformats='HWC', global_step=epoch)
-                    #         tb_writer.add_graph(torch.jit.trace(model, imgs, strict=False), [])  # add model graph
-                    # elif plots and ni == 10 and wandb_logger.wandb:
-                    #     wandb_logger.log({"Mosaics": [wandb_logger.wandb.Image(str(x), caption=x.name) for x in
-                    #                                   save_dir.glob('train*.jpg') if x.exists()]})
-        elif task == 'classification':
-            accumulated_imgs_cnt = 0
-            tacc = 0
-            for i, (imgs, targets) in pbar:
-                t_batch = time.time() #time_synchronized()
-                ni = i + nb * epoch  # number integrated batches (since train start)
-                imgs = imgs.float().to(device, non_blocking=True)
-                targets = targets.to(device)
-
-                # Warmup
-                if ni <= nw:
-                    xi = [0, nw]  # x interp
-                    accumulate = max(1, np.interp(ni, xi, [1, nbs / opt.total_batch_size]).round())
-                    for j, x in enumerate(optimizer.param_groups):
-                        # bias lr falls from 0.1 to lr0, all other lrs rise from 0.0 to lr0
-                        x['lr'] = np.interp(ni, xi, [hyp['warmup_bias_lr'] if j == 2 else 0.0, x['initial_lr'] * lf(epoch)])
-                        if 'momentum' in x:
-                            x['momentum'] = np.interp(ni, xi, [hyp['warmup_momentum'], hyp['momentum']])
-                            hyp[f'momentum_group{j}'] = x['momentum']
+                    with amp.autocast(enabled=cuda):
+                        pred = model(imgs)  # forward
+                        print('-'*100)
+                        # if 'loss_ota' not in hyp or hyp['loss_ota'] == 1:
+                        if 'OTA' in opt.loss_name: #opt.loss_name == 'OTA':
+                            loss, loss_items = compute_loss_ota(pred, targets.to(device), imgs)  # loss scaled by batch_size
                         else:
-                            hyp[f'momentum_group{j}'] = None
-                        hyp[f'lr_group{j}'] = x['lr']
-                    # status_update(userid, project_id,
-                    #           update_id="hyperparameter",
-                    #           update_content=hyp)
-
-                # Forward
-                optimizer.zero_grad()
-                with amp.autocast(enabled=cuda):
-                    pred = model(imgs)  # forward
-                    loss = compute_loss(pred, targets)
-                    _, out = pred.max(1)  # top-1_pred_value, top-1_pred_cls_idx
-                    if rank != -1:
-                        loss *= opt.world_size  # gradient averaged between devices in DDP mode
-                    if opt.quad:
-                        loss *= 4.
-                    acc = torch.eq(out, targets).sum()
-                    # print(acc.shape, acc)
-                    # acc = out.eq(targets.view_as(out)).sum() #.item()
-
-
-                # Backward
-                scaler.scale(loss).backward()
-
-                # Optimize
-                if ni % accumulate == 0:
-                    scaler.step(optimizer)  # optimizer.step
-                    scaler.update()
-                    optimizer.zero_grad()
-                    if ema:
-                        ema.update(model)
-
-                # Print
-                if rank in [-1, 0]:
-                    mem = '%.3gG' % (torch.cuda.memory_reserved() / 1E9 if torch.cuda.is_available() else 0)  # (GB)
-                    mloss = (mloss * i + loss) / (i + 1)  # mean train loss
-                    macc = (macc * accumulated_imgs_cnt + acc) / (accumulated_imgs_cnt + len(imgs)) # mean train accuracy
-                    tacc += acc.item()
-                    accumulated_imgs_cnt += len(imgs)
-                    s = ('%10s' * 2 + '%10.4g' * 4) % (
-                        '%g/%g' % (epoch, epochs - 1), mem, mloss, macc, targets.shape[0], tacc) #imgs.shape[-1])
-                    mloss_item = mloss.item()
-                    macc_item = macc.item()
-                    train_loss['epoch'] = epoch + 1
-                    train_loss['total_epoch'] = epochs
-                    train_loss['gpu_mem'] = mem
-                    train_loss['box'] = accumulated_imgs_cnt # TODO: box -> images
-                    train_loss['obj'] = tacc # TODO: obj -> correct
-                    train_loss['cls'] = macc_item # TODO: cls -> acc
-                    train_loss['total'] = mloss_item # TODO: total -> loss
-                    train_loss['label'] = targets.shape[0]
-                    train_loss['step'] = i + 1
-                    train_loss['total_step'] = nb
-                    train_loss['time'] = f"{(time.time() - t_batch):.1f} s"
-
-                    status_update(userid, project_id,
-                                  update_id="train_loss",
-                                  update_content=train_loss)
-                    # Plot
-                    # if plots and ni < 10:
-                    #     f = save_dir / f'train_batch{ni}.jpg'  # filename
-                    #     Thread(target=plot_images, args=(imgs, targets, paths, f), daemon=True).start()
-                    #     if tb_writer:
-                    #         tb_writer.add_image(f, result, dataformats='HWC', global_step=epoch)
-                    #         tb_writer.add_graph(torch.jit.trace(model, imgs, strict=False), [])  # add model graph
-                    # elif plots and ni == 10 and wandb_logger.wandb:
-                    #     wandb_logger.log({"Mosaics": [wandb_logger.wandb.Image(str(x), caption=x.name) for x in
-                    #                                   save_dir.glob('train*.jpg') if x.exists()]})
-        # training batches end =================================================
-
-        # Scheduler
-        lr = [x['lr'] for x in optimizer.param_groups]  # for tensorboard
-        for i, lr_element in enumerate(lr):
-            hyp[f'lr_group{i}'] = lr_element
-        # status_update(userid, project_id,
-        #           update_id="hyperparameter",
-        #           update_content=hyp)
-        scheduler.step()
-
-        # (DDP process 0 or single-GPU) test ===================================
-        if rank in [-1, 0]:
-            # mAP
-            if task == 'detection':
-                ema.update_attr(model, include=['yaml', 'nc', 'hyp', 'gr', 'names', 'stride', 'class_weights'])
+                            loss, loss_items = compute_loss(pred, targets.to(device))  # loss scaled by batch_size
+                        if rank != -1:
+                            loss *= opt.world_size  # gradient averaged between devices in DDP mode
+                        if opt.quad:
+                            loss *= 4.
+                    # Backward
+                    scaler.scale(loss).backward()
+
+                    # Optimize
+                    # if ni % accumulate == 0:
+                    if ni - last_opt_step >= accumulate:
+                        # https://pytorch.org/docs/master/notes/amp_examples.html
+                        scaler.unscale_(optimizer)  # unscale gradients
+                        torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=10.0)  # clip gradients                    
+                        scaler.step(optimizer)  # optimizer.step
+                        scaler.update()
+                        optimizer.zero_grad()
+                        if ema:
+                            ema.update(model)
+                        last_opt_step = ni
+
+                    # Report & Plot(option)
+                    if rank in [-1, 0]:
+                        mem = '%.3gG' % (torch.cuda.memory_reserved() / 1E9 if torch.cuda.is_available() else 0)  # (GB)
+
+                        mloss = (mloss * i + loss_items) / (i + 1)  # update mean losses
+                        s = ('%10s' * 2 + '%10.4g' * 6) % (
+                            '%g/%g' % (epoch, epochs - 1), mem, *mloss, targets.shape[0], imgs.shape[-1])
+                        # pbar.set_description(s)
+                        mloss_list = mloss.to('cpu').numpy().tolist()
+                        train_loss['epoch'] = epoch + 1
+                        train_loss['total_epoch'] = epochs
+                        train_loss['gpu_mem'] = mem
+                        train_loss['box'] = mloss_list[0]
+                        train_loss['obj'] = mloss_list[1]
+                        train_loss['cls'] = mloss_list[2]
+                        train_loss['total'] = mloss_list[3]
+                        train_loss['label'] = targets.shape[0]
+                        train_loss['step'] = i + 1
+                        train_loss['total_step'] = nb
+                        train_loss['time'] = f"{(time.time() - t_batch):.1f} s"
+
+                        status_update(userid, project_id,
+                                      update_id="train_loss",
+                                      update_content=train_loss)
+                        logger.info(f'{s}')
+                        # Plot
+                        # if plots and ni < 10:
+                        #     f = save_dir / f'train_batch{ni}.jpg'  # filename
+                        #     Thread(target=plot_images, args=(imgs, targets, paths, f), daemon=True).start()
+                        #     if tb_writer:
+                        #         tb_writer.add_image(f, result, dataformats='HWC', global_step=epoch)
+                        #         tb_writer.add_graph(torch.jit.trace(model, imgs, strict=False), [])  # add model graph
+                        # elif plots and ni == 10 and wandb_logger.wandb:
+                        #     wandb_logger.log({"Mosaics": [wandb_logger.wandb.Image(str(x), caption=x.name) for x in
+                        #                                   save_dir.glob('train*.jpg') if x.exists()]})
             elif task == 'classification':
-                ema.update_attr(model, include=['yaml', 'nc', 'hyp', 'names', 'class_weights'])
-            final_epoch = (epoch + 1 == epochs) or stopper.possible_stop
-            if not opt.notest or final_epoch:  # Calculate mAP
-                # wandb_logger.current_epoch = epoch + 1
+                accumulated_imgs_cnt = 0
+                tacc = 0
+                for i, (imgs, targets) in pbar:
+                    t_batch = time.time() #time_synchronized()
+                    ni = i + nb * epoch  # number integrated batches (since train start)
+                    imgs = imgs.float().to(device, non_blocking=True)
+                    targets = targets.to(device)
+
+                    # Warmup
+                    if ni <= nw:
+                        xi = [0, nw]  # x interp
+                        accumulate = max(1, np.interp(ni, xi, [1, nbs / opt.total_batch_size]).round())
+                        for j, x in enumerate(optimizer.param_groups):
+                            # bias lr falls from 0.1 to lr0, all other lrs rise from 0.0 to lr0
+                            x['lr'] = np.interp(ni, xi, [hyp['warmup_bias_lr'] if j == 2 else 0.0, x['initial_lr'] * lf(epoch)])
+                            if 'momentum' in x:
+                                x['momentum'] = np.interp(ni, xi, [hyp['warmup_momentum'], hyp['momentum']])
+                                hyp[f'momentum_group{j}'] = x['momentum']
+                            else:
+                                hyp[f'momentum_group{j}'] = None
+                            hyp[f'lr_group{j}'] = x['lr']
+                        # status_update(userid, project_id,
+                        #           update_id="hyperparameter",
+                        #           update_content=hyp)
+
+                    # Forward
+                    optimizer.zero_grad()
+                    with amp.autocast(enabled=cuda):
+                        pred = model(imgs)  # forward
+                        loss = compute_loss(pred, targets)
+                        _, out = pred.max(1)  # top-1_pred_value, top-1_pred_cls_idx
+                        if rank != -1:
+                            loss *= opt.world_size  # gradient averaged between devices in DDP mode
+                        if opt.quad:
+                            loss *= 4.
+                        acc = torch.eq(out, targets).sum()
+                        # print(acc.shape, acc)
+                        # acc = out.eq(targets.view_as(out)).sum() #.item()
+
+
+                    # Backward
+                    scaler.scale(loss).backward()
+
+                    # Optimize
+                    if ni % accumulate == 0:
+                        scaler.step(optimizer)  # optimizer.step
+                        scaler.update()
+                        optimizer.zero_grad()
+                        if ema:
+                            ema.update(model)
+
+                    # Print
+                    if rank in [-1, 0]:
+                        mem = '%.3gG' % (torch.cuda.memory_reserved() / 1E9 if torch.cuda.is_available() else 0)  # (GB)
+                        mloss = (mloss * i + loss) / (i + 1)  # mean train loss
+                        macc = (macc * accumulated_imgs_cnt + acc) / (accumulated_imgs_cnt + len(imgs)) # mean train accuracy
+                        tacc += acc.item()
+                        accumulated_imgs_cnt += len(imgs)
+                        s = ('%10s' * 2 + '%10.4g' * 4) % (
+                            '%g/%g' % (epoch, epochs - 1), mem, mloss, macc, targets.shape[0], tacc) #imgs.shape[-1])
+                        mloss_item = mloss.item()
+                        macc_item = macc.item()
+                        train_loss['epoch'] = epoch + 1
+                        train_loss['total_epoch'] = epochs
+                        train_loss['gpu_mem'] = mem
+                        train_loss['box'] = accumulated_imgs_cnt # TODO: box -> images
+                        train_loss['obj'] = tacc # TODO: obj -> correct
+                        train_loss['cls'] = macc_item # TODO: cls -> acc
+                        train_loss['total'] = mloss_item # TODO: total -> loss
+                        train_loss['label'] = targets.shape[0]
+                        train_loss['step'] = i + 1
+                        train_loss['total_step'] = nb
+                        train_loss['time'] = f"{(time.time() - t_batch):.1f} s"
+
+                        status_update(userid, project_id,
+                                      update_id="train_loss",
+                                      update_content=train_loss)
+                        # Plot
+                        # if plots and ni < 10:
+                        #     f = save_dir / f'train_batch{ni}.jpg'  # filename
+                        #     Thread(target=plot_images, args=(imgs, targets, paths, f), daemon=True).start()
+                        #     if tb_writer:
+                        #         tb_writer.add_image(f, result, dataformats='HWC', global_step=epoch)
+                        #         tb_writer.add_graph(torch.jit.trace(model, imgs, strict=False), [])  # add model graph
+                        # elif plots and ni == 10 and wandb_logger.wandb:
+                        #     wandb_logger.log({"Mosaics": [wandb_logger.wandb.Image(str(x), caption=x.name) for x in
+                        #                                   save_dir.glob('train*.jpg') if x.exists()]})
+            # training batches end =================================================
+
+            # Scheduler
+            lr = [x['lr'] for x in optimizer.param_groups]  # for tensorboard
+            for i, lr_element in enumerate(lr):
+                hyp[f'lr_group{i}'] = lr_element
+            # status_update(userid, project_id,
+            #           update_id="hyperparameter",
+            #           update_content=hyp)
+            scheduler.step()
+
+            # (DDP process 0 or single-GPU) test ===================================
+            if rank in [-1, 0]:
+                # mAP
                 if task == 'detection':
-                    # results: tuple    (mp, mr, map50, map, box, obj, cls)
-                    # maps: numpy array (ap0, ap1, ..., ap79)  : mAP per cls
-                    # times: tuple      (inf, nms, total, imgsz, imgsz, batchsz)
-                    results, maps, times = test.test(proj_info,
-                                                     data_dict,
-                                                     batch_size=batch_size // opt.world_size, # multiplying by 2 may cause out of gpu memory
-                                                     imgsz=imgsz_test,
-                                                     model=ema.ema,
-                                                     single_cls=opt.single_cls,
-                                                     dataloader=testloader,
-                                                     save_dir=save_dir,
-                                                     verbose=nc < 50 and final_epoch,
-                                                     plots=plots and final_epoch,
-                                                     # wandb_logger=wandb_logger,
-                                                     half_precision=True,
-                                                     compute_loss=compute_loss,
-                                                     is_coco=is_coco,
-                                                     metric=opt.metric)
+                    ema.update_attr(model, include=['yaml', 'nc', 'hyp', 'gr', 'names', 'stride', 'class_weights'])
                 elif task == 'classification':
-                    # results: tuple - (val_accuracy, val_loss)
-                    # times:   float - total
-                    results, times = test.test_cls(proj_info,
-                                                   data_dict,
-                                                   batch_size=batch_size,
-                                                   imgsz=imgsz_test,
-                                                   model=ema.ema,
-                                                   dataloader=testloader,
-                                                   save_dir=save_dir,
-                                                   verbose=nc < 50 and final_epoch,
-                                                   plots=False, #plots and final_epoch,
-                                                   compute_loss=compute_loss,
-                                                   half_precision=True)
-
-            # Write
-            with open(results_file, 'a') as f:
+                    ema.update_attr(model, include=['yaml', 'nc', 'hyp', 'names', 'class_weights'])
+                final_epoch = (epoch + 1 == epochs) or stopper.possible_stop
+                if not opt.notest or final_epoch:  # Calculate mAP
+                    # wandb_logger.current_epoch = epoch + 1
+                    if task == 'detection':
+                        # results: tuple    (mp, mr, map50, map, box, obj, cls)
+                        # maps: numpy array (ap0, ap1, ..., ap79)  : mAP per cls
+                        # times: tuple      (inf, nms, total, imgsz, imgsz, batchsz)
+                        results, maps, times = test.test(proj_info,
+                                                         data_dict,
+                                                         batch_size=batch_size // opt.world_size, # multiplying by 2 may cause out of gpu memory
+                                                         imgsz=imgsz_test,
+                                                         model=ema.ema,
+                                                         single_cls=opt.single_cls,
+                                                         dataloader=testloader,
+                                                         save_dir=save_dir,
+                                                         verbose=nc < 50 and final_epoch,
+                                                         plots=plots and final_epoch,
+                                                         # wandb_logger=wandb_logger,
+                                                         half_precision=True,
+                                                         compute_loss=compute_loss,
+                                                         is_coco=is_coco,
+                                                         metric=opt.metric)
+                    elif task == 'classification':
+                        # results: tuple - (val_accuracy, val_loss)
+                        # times:   float - total
+                        results, times = test.test_cls(proj_info,
+                                                       data_dict,
+                                                       batch_size=batch_size,
+                                                       imgsz=imgsz_test,
+                                                       model=ema.ema,
+                                                       dataloader=testloader,
+                                                       save_dir=save_dir,
+                                                       verbose=nc < 50 and final_epoch,
+                                                       plots=False, #plots and final_epoch,
+                                                       compute_loss=compute_loss,
+                                                       half_precision=True)
+
+                # Write
+                with open(results_file, 'a') as f:
+                    if task == 'detection':
+                        f.write(s + '%10.4g' * 7 % results + '\n')  # append metrics, val_loss
+                    elif task == 'classification':
+                        f.write(s + '%10.4g' * 2 % results + '\n') # append val_acc, val_loss
+                if len(opt.name) and opt.bucket:
+                    os.system('gsutil cp %s gs://%s/results/results%s.txt' % (results_file, opt.bucket, opt.name))
+
+                # Log
                 if task == 'detection':
-                    f.write(s + '%10.4g' * 7 % results + '\n')  # append metrics, val_loss
+                    tags = ['train/box_loss', 'train/obj_loss', 'train/cls_loss',  # train loss
+                            'metrics/precision', 'metrics/recall', 'metrics/mAP_0.5', 'metrics/mAP_0.5_0.95',
+                            'val/box_loss', 'val/obj_loss', 'val/cls_loss',  # val loss
+                            'x/lr0', 'x/lr1', 'x/lr2']  # params
+                    zip_list = list(mloss[:-1]) + list(results) + lr
                 elif task == 'classification':
-                    f.write(s + '%10.4g' * 2 % results + '\n') # append val_acc, val_loss
-            if len(opt.name) and opt.bucket:
-                os.system('gsutil cp %s gs://%s/results/results%s.txt' % (results_file, opt.bucket, opt.name))
-
-            # Log
-            if task == 'detection':
-                tags = ['train/box_loss', 'train/obj_loss', 'train/cls_loss',  # train loss
-                        'metrics/precision', 'metrics/recall', 'metrics/mAP_0.5', 'metrics/mAP_0.5_0.95',
-                        'val/box_loss', 'val/obj_loss', 'val/cls_loss',  # val loss
-                        'x/lr0', 'x/lr1', 'x/lr2']  # params
-                zip_list = list(mloss[:-1]) + list(results) + lr
-            elif task == 'classification':
-                tags = ['train/acc', 'train/loss', # train accurarcy and loss
-                        'val/acc', 'val/loss', # val accurarcy and loss
-                        'x/lr0', 'x/lr1', 'x/lr2']  # params
-                zip_list = [macc, mloss] + list(results) + lr
-
-            # for x, tag in zip(list(mloss[:-1]) + list(results) + lr, tags):
-            for x, tag in zip(zip_list, tags):
-                if tb_writer:
-                    tb_writer.add_scalar(tag, x, epoch)  # tensorboard
-            #     if wandb_logger.wandb:
-            #         wandb_logger.log({tag: x})  # W&B
-
-            epoch_summary = {}
-            epoch_summary['total_epoch'] = epochs
-            epoch_summary['current_epoch'] = epoch + 1
-            if task == 'detection':
-                epoch_summary['train_loss_box'] = mloss_list[0]
-                epoch_summary['train_loss_obj'] = mloss_list[1]
-                epoch_summary['train_loss_cls'] = mloss_list[2]
-                epoch_summary['train_loss_total'] = mloss_list[3]
-                epoch_summary['val_acc_P'] = results[0]
-                epoch_summary['val_acc_R'] = results[1]
-                epoch_summary['val_acc_map50'] = results[2]
-                epoch_summary['val_acc_map'] = results[3]
-            elif task == 'classification':
-                epoch_summary['train_loss_total'] = mloss_item
-                epoch_summary['val_acc_map50'] = macc_item # results[1]
-                epoch_summary['val_acc_map'] = results[0]
-            epoch_summary['epoch_time'] = (time.time() - t_epoch) # unit: sec
-            epoch_summary['total_time'] = (time.time() - t0) / 3600 # unit: hour
-            status_update(userid, project_id,
-                          update_id="epoch_summary",
-                          update_content=epoch_summary)
+                    tags = ['train/acc', 'train/loss', # train accurarcy and loss
+                            'val/acc', 'val/loss', # val accurarcy and loss
+                            'x/lr0', 'x/lr1', 'x/lr2']  # params
+                    zip_list = [macc, mloss] + list(results) + lr
+
+                # for x, tag in zip(list(mloss[:-1]) + list(results) + lr, tags):
+                for x, tag in zip(zip_list, tags):
+                    if tb_writer:
+                        tb_writer.add_scalar(tag, x, epoch)  # tensorboard
+                #     if wandb_logger.wandb:
+                #         wandb_logger.log({tag: x})  # W&B
+
+                epoch_summary = {}
+                epoch_summary['total_epoch'] = epochs
+                epoch_summary['current_epoch'] = epoch + 1
+                if task == 'detection':
+                    epoch_summary['train_loss_box'] = mloss_list[0]
+                    epoch_summary['train_loss_obj'] = mloss_list[1]
+                    epoch_summary['train_loss_cls'] = mloss_list[2]
+                    epoch_summary['train_loss_total'] = mloss_list[3]
+                    epoch_summary['val_acc_P'] = results[0]
+                    epoch_summary['val_acc_R'] = results[1]
+                    epoch_summary['val_acc_map50'] = results[2]
+                    epoch_summary['val_acc_map'] = results[3]
+                elif task == 'classification':
+                    epoch_summary['train_loss_total'] = mloss_item
+                    epoch_summary['val_acc_map50'] = macc_item # results[1]
+                    epoch_summary['val_acc_map'] = results[0]
+                epoch_summary['epoch_time'] = (time.time() - t_epoch) # unit: sec
+                epoch_summary['total_time'] = (time.time() - t0) / 3600 # unit: hour
+                status_update(userid, project_id,
+                              update_id="epoch_summary",
+                              update_content=epoch_summary)
 
-            # Update best mAP
-            if task == 'detection':
-                fi = fitness(np.array(results).reshape(1, -1))  # weighted combination of [P, R, mAP@.5, mAP@.5-.95]
-            elif task == 'classification':
-                fi = results[0] # validation accuracy itself
-            stop = stopper(epoch=epoch, fitness=fi)
-            if fi > best_fitness:
-                best_fitness = fi
-            # wandb_logger.end_epoch(best_result=best_fitness == fi)
-
-            # Save model
-            if (not opt.nosave) or (final_epoch and not opt.evolve):  # if save
-                ckpt = {'epoch': epoch,
-                        'best_fitness': best_fitness,
-                        'training_results': results_file.read_text(),
-                        'model': deepcopy(model.module if is_parallel(model) else model).half(),
-                        'ema': deepcopy(ema.ema).half(),
-                        # 'model': deepcopy(model.module if is_parallel(model) else model),
-                        # 'ema': deepcopy(ema.ema),
-                        'updates': ema.updates,
-                        'optimizer': optimizer.state_dict(),}
-                        # 'wandb_id': wandb_logger.wandb_run.id if wandb_logger.wandb else None}
-
-                # Save last, best and delete
-                # torch.save(ckpt, last)
-                if best_fitness == fi:
-                    torch.save(ckpt, best)
-                    mb = os.path.getsize(best) / 1E6  # filesize
-                    logger.info(f'epoch {epoch} : {best} {mb:.1f} MB')
-                if not opt.nosave:
-                    torch.save(ckpt, last)
-                # if (best_fitness == fi) and (epoch >= 200):
-                #     torch.save(ckpt, wdir / 'best_{:03d}.pt'.format(epoch))
-                # if epoch == 0:
-                #     torch.save(ckpt, wdir / 'epoch_{:03d}.pt'.format(epoch))
-                # elif ((epoch+1) % 25) == 0:
-                #     torch.save(ckpt, wdir / 'epoch_{:03d}.pt'.format(epoch))
-                # elif epoch >= (epochs-5):
-                #     torch.save(ckpt, wdir / 'epoch_{:03d}.pt'.format(epoch))
-                # if wandb_logger.wandb:
-                #     if ((epoch + 1) % opt.save_period == 0 and not final_epoch) and opt.save_period != -1:
-                #         wandb_logger.log_model(
-                #             last.parent, opt, epoch, fi, best_model=best_fitness == fi)
-                del ckpt
-
-                # Save epoch internally
-                info = Info.objects.get(userid=userid, project_id=project_id)
-                info.epoch = epoch
-                info.save()
+                # Update best mAP
+                if task == 'detection':
+                    fi = fitness(np.array(results).reshape(1, -1))  # weighted combination of [P, R, mAP@.5, mAP@.5-.95]
+                elif task == 'classification':
+                    fi = results[0] # validation accuracy itself
+                stop = stopper(epoch=epoch, fitness=fi)
+                if fi > best_fitness:
+                    best_fitness = fi
+                # wandb_logger.end_epoch(best_result=best_fitness == fi)
+
+                # Save model
+                if (not opt.nosave) or (final_epoch and not opt.evolve):  # if save
+                    # model and ema are staged to CPU as half, like deepcopy(model).half()
+                    ckpt = {'epoch': epoch,
+                            'best_fitness': best_fitness,
+                            'training_results': results_file.read_text(),
+                            'model': model.module if is_parallel(model) else model,
+                            'ema': ema.ema,
+                            # 'model': deepcopy(model.module if is_parallel(model) else model),
+                            # 'ema': deepcopy(ema.ema),
+                            'updates': ema.updates,
+                            'optimizer': optimizer.state_dict(),}
+                            # 'wandb_id': wandb_logger.wandb_run.id if wandb_logger.wandb else None}
+
+                    # Save last, best and delete
+                    # torch.save(ckpt, last)
+                    # Save epoch internally once last.pt is on disk
+                    def on_saved(paths, epoch=epoch):
+                        logger.info(f'epoch {epoch} : saved {", ".join(Path(p).name for p in paths)}')
+                        Info.objects.filter(userid=userid, project_id=project_id).update(epoch=epoch)
+                        close_old_connections()
+                    ckpt_writer.save(ckpt,
+                                     [best if best_fitness == fi else None, last if not opt.nosave else None],
+                                     on_saved=on_saved)
+                    # if (best_fitness == fi) and (epoch >= 200):
+                    #     torch.save(ckpt, wdir / 'best_{:03d}.pt'.format(epoch))
+                    # if epoch == 0:
+                    #     torch.save(ckpt, wdir / 'epoch_{:03d}.pt'.format(epoch))
+                    # elif ((epoch+1) % 25) == 0:
+                    #     torch.save(ckpt, wdir / 'epoch_{:03d}.pt'.format(epoch))
+                    # elif epoch >= (epochs-5):
+                    #     torch.save(ckpt, wdir / 'epoch_{:03d}.pt'.format(epoch))
+                    # if wandb_logger.wandb:
+                    #     if ((epoch + 1) % opt.save_period == 0 and not final_epoch) and opt.save_period != -1:
+                    #         wandb_logger.log_model(
+                    #             last.parent, opt, epoch, fi, best_model=best_fitness == fi)
+                    del ckpt
         
-            # EarlyStopping
-            if rank != -1: # if DDP training
-                broadcast_list = [stop if rank == 0 else None]
-                dist.broadcast_object_list(broadcast_list, 0)
-                if rank != 0:
-                    stop = broadcast_list[0]
-            if stop:
-                logger.info(f"early stopping...")
-                break
-        # end validation =======================================================
+                # EarlyStopping
+                if rank != -1: # if DDP training
+                    broadcast_list = [stop if rank == 0 else None]
+                    dist.broadcast_object_list(broadcast_list, 0)
+                    if rank != 0:
+                        stop = broadcast_list[0]
+                if stop:
+                    logger.info(f"early stopping...")
+                    break
+            # end validation =======================================================
+    finally:
+        ckpt_writer.close() # wait for the last checkpoint, also when an epoch raises
 
     # end training -------------------------------------------------------------
 
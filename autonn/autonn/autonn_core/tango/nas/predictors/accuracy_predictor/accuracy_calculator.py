@@ -25,6 +25,7 @@ from tango.utils.datasets import create_dataloader
 from tango.utils.general import colorstr, check_img_size
 from tango.utils.torch_utils import select_device
 from tango.common.models.experimental import attempt_load
+from .evaluation_service import EvaluationService
 
 logger = logging.getLogger(__name__)
 
@@ -98,6 +99,9 @@ class AccuracyCalculator():
         #                                     workers=opt.workers,
         #                                     pad=0.5,
         #                                     prefix='val')[0]
+
+        # memoized, multi-GPU evaluation of the subnets
+        self.service = EvaluationService(self.predict_accuracy_once, proj_info, hyp, opt, data_dict)
         
     # TODO : add finetune function
     def finetune_subnet(self, subnet):
@@ -152,6 +156,13 @@ class AccuracyCalculator():
 
     #     return acc_list
     
+    def predict_accuracy(self, sample_list):
+        # [(subnet_pt, map)] of each sample, from the cache or fine-tuned (in parallel)
+        return self.service.evaluate(sample_list)
+
+    def close(self):
+        self.service.close()
+
     def predict_accuracy_once(self, sample):
         # activate the subnet
         self.supernet.set_active_subnet(sample['d'])
@@ -0,0 +1,219 @@
+'''
+Subnet evaluation service for the evolution search.
+[TENACE] fine-tuning a subnet is by far the most expensive step of NAS, so
+         1) results are memoized per (supernet checkpoint, depth list) in a file
+            which outlives a search() run, and
+         2) the subnets which are not in the cache are fine-tuned in parallel,
+            one worker process per visible GPU.
+'''
+
+import os
+import json
+import queue
+import hashlib
+import logging
+import argparse
+from copy import deepcopy
+from pathlib import Path
+
+import torch
+import torch.multiprocessing as mp
+
+logger = logging.getLogger(__name__)
+
+COMMON_ROOT = Path("/shared/common")
+EVAL_CACHE_FILE = 'nas_accuracy.json'
+
+
+def file_hash(path, chunk_size=1 << 20):
+    # sha1 of a checkpoint file, None if it is not a file
+    if not path or not os.path.isfile(path):
+        return None
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def visible_gpus():
+    # physical ids of the GPUs this process may use
+    if not torch.cuda.is_available():
+        return []
+    env = os.environ.get('CUDA_VISIBLE_DEVICES', '')
+    if env and env != '-1':
+        return [g.strip() for g in env.split(',') if g.strip()]
+    return [str(i) for i in range(torch.cuda.device_count())]
+
+
+class EvaluationCache:
+    '''
+    { supernet key : { depth list : [accuracy, subnet_pt] } } saved as json
+    an entry is valid only while its subnet .pt exists
+    '''
+    def __init__(self, path, supernet_key):
+        self.path = Path(path) if path else None
+        self.supernet_key = supernet_key
+        self.data = self._load()
+
+    def _load(self):
+        if self.path is None or not self.path.is_file():
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warn(f'NAS: cannot read {self.path}: {e}')
+            return {}
+
+    def _save(self):
+        if self.path is None:
+            return
+        tmp = self.path.with_suffix('.tmp')
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(tmp, 'w') as f:
+                json.dump(self.data, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logger.warn(f'NAS: cannot write {self.path}: {e}')
+
+    @staticmethod
+    def encode(d):
+        return ''.join(str(x) for x in d)
+
+    def get(self, d):
+        entry = self.data.get(self.supernet_key, {}).get(self.encode(d))
+        if entry is None or not os.path.isfile(entry[1]):
+            return None
+        return entry[1], entry[0]  # subnet_pt, accuracy
+
+    def put(self, d, subnet_pt, acc):
+        self.data.setdefault(self.supernet_key, {})[self.encode(d)] = [float(acc), str(subnet_pt)]
+        self._save()
+
+
+def _worker(gpu, weights, proj_info, hyp, opt, data_dict, tasks, results):
+    # fine-tunes the depth lists of 'tasks' on one GPU
+    os.environ['CUDA_VISIBLE_DEVICES'] = gpu
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    import django
+    django.setup()
+    from tango.main import finetune
+    from tango.common.models.experimental import attempt_load
+
+    opt.device = gpu
+    supernet = attempt_load(weights, map_location='cpu', fused=False)
+    while True:
+        d = tasks.get()
+        if d is None:
+            break
+        try:
+            supernet.set_active_subnet(d)
+            subnet = supernet.get_active_subnet()
+            subnet_pt, finetune_results = finetune.finetune(proj_info, subnet, hyp, opt, data_dict, tb_writer=None)
+            results.put((d, subnet_pt, finetune_results[3], None))
+        except Exception as e:
+            results.put((d, None, None, f'{type(e).__name__}: {e}'))
+
+
+class EvaluationService:
+    '''
+    Evaluates subnets with 'evaluate_fn' (fine-tuning + test), memoized and spread over the GPUs
+
+    Args:
+        evaluate_fn: sample -> (subnet_pt, accuracy), used when running in this process
+        proj_info, hyp, opt, data_dict: what a worker process needs to fine-tune a subnet
+    '''
+    def __init__(self, evaluate_fn, proj_info, hyp, opt, data_dict):
+        self.evaluate_fn = evaluate_fn
+        self.proj_info, self.hyp, self.opt, self.data_dict = proj_info, hyp, opt, data_dict
+
+        self.weights = str(opt.weights) if getattr(opt, 'weights', None) else None
+        ckpt_hash = file_hash(self.weights)
+        if ckpt_hash is None:
+            logger.info(f'NAS: supernet is not a checkpoint file, accuracy cache kept in memory only')
+            cache_path = None
+            ckpt_hash = 'memory'
+        else:
+            cache_path = COMMON_ROOT / proj_info['userid'] / proj_info['project_id'] / EVAL_CACHE_FILE
+        self.cache = EvaluationCache(cache_path, f"{ckpt_hash}|{getattr(opt, 'finetune_epochs', '')}")
+
+        self.gpus = visible_gpus() if self.weights and os.path.isfile(self.weights) else []
+        self.workers = []
+
+    def evaluate(self, samples):
+        '''
+        Returns [(subnet_pt, accuracy)] in the order of samples
+        '''
+        found, todo = {}, []
+        for sample in samples:
+            d = tuple(sample['d'])
+            if d in found or d in todo:
+                continue
+            hit = self.cache.get(d)
+            if hit is not None:
+                found[d] = hit
+            else:
+                todo.append(d)
+        logger.info(f'NAS: {len(samples)} subnets, {len(found)} cached, {len(todo)} to fine-tune')
+
+        if len(self.gpus) > 1 and len(todo) > 1:
+            found.update(self._evaluate_parallel(todo))
+        else:
+            for d in todo:
+                found[d] = self._evaluate_here(d)
+        return [found[tuple(sample['d'])] for sample in samples]
+
+    def _evaluate_here(self, d):
+        subnet_pt, acc = self.evaluate_fn({'d': list(d)})
+        self.cache.put(d, subnet_pt, acc)
+        return subnet_pt, acc
+
+    def _start_workers(self):
+        if self.workers:
+            return
+        ctx = mp.get_context('spawn')  # CUDA is already initialized in this process
+        self.tasks, self.results = ctx.Queue(), ctx.Queue()
+        opt = argparse.Namespace(**vars(self.opt))
+        for gpu in self.gpus:
+            p = ctx.Process(target=_worker,
+                            args=(gpu, self.weights, self.proj_info, self.hyp, deepcopy(opt), self.data_dict,
+                                  self.tasks, self.results),
+                            name=f'NAS_EVAL_GPU{gpu}')
+            p.start()
+            self.workers.append(p)
+        logger.info(f'NAS: started {len(self.workers)} evaluation workers on GPU {",".join(self.gpus)}')
+
+    def _evaluate_parallel(self, todo):
+        self._start_workers()
+        for d in todo:
+            self.tasks.put(list(d))
+        found, pending = {}, set(todo)
+        while pending:
+            try:
+                d, subnet_pt, acc, error = self.results.get(timeout=60)
+            except queue.Empty:
+                if any(p.is_alive() for p in self.workers):
+                    continue
+                logger.warn(f'NAS: evaluation workers exited, fine-tuning {len(pending)} subnets here')
+                self.workers = []
+                for d in list(pending):
+                    found[d] = self._evaluate_here(d)
+                break
+            d = tuple(d)
+            pending.discard(d)
+            if error is not None:
+                logger.warn(f'NAS: worker failed on {list(d)} ({error}), fine-tuning it here')
+                found[d] = self._evaluate_here(d)
+                continue
+            self.cache.put(d, subnet_pt, acc)
+            found[d] = (subnet_pt, acc)
+        return found
+
+    def close(self):
+        for _ in self.workers:
+            self.tasks.put(None)
+        for p in self.workers:
+            p.join()
+        self.workers = []
@@ -4,43 +4,140 @@ It will be replaced with code of a trained predictor network later.
 '''
 import json
 import os
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import copy
 
 class LatencyPredictor:
-    def __init__(self, target, target_acc, device):
+    """
+    Backbone + head latency MLPs of a target, on any device
+
+    The two MLPs are fused into one block-diagonal MLP (FusedNet), so a query
+    (one architecture or a whole batch) is a single forward pass.
+    """
+    def __init__(self, target, target_acc, device='cpu'):
         path = os.path.dirname(os.path.realpath(__file__))
         bpred_path = os.path.join(path, "trained_lat_pred/{}_{}_backbone.pt".format(target, target_acc))
         hpred_path = os.path.join(path, "trained_lat_pred/{}_{}_head.pt".format(target, target_acc))
 
+        device = torch.device(device) if device else torch.device('cpu')
+        if device.type == 'cuda' and not torch.cuda.is_available():
+            device = torch.device('cpu')
         self.device = device
         self.b_net = Net(
             nfeat=20,
             hw_embed_on=False,
             hw_embed_dim=0,
             layer_size=64
-        ).cuda()
+        )
         self.h_net = Net(
             nfeat=28,
             hw_embed_on=False,
             hw_embed_dim=0,
             layer_size=64
-        ).cuda()
+        )
 
-        self.b_net.load_state_dict(torch.load(bpred_path))
-        self.h_net.load_state_dict(torch.load(hpred_path))
+        self.b_net.load_state_dict(torch.load(bpred_path, map_location='cpu'))
+        self.h_net.load_state_dict(torch.load(hpred_path, map_location='cpu'))
         self.b_net.eval()
         self.h_net.eval()
+        self.net = FusedNet(self.b_net, self.h_net).to(self.device).eval()
 
+    @torch.no_grad()
     def predict_efficiency(self, arch):
         b_feat, h_feat = arch_to_feat(arch, self.device)
-        latency_b = self.b_net(b_feat)
-        latency_h = self.h_net(h_feat)
+        return self.net(torch.cat((b_feat, h_feat))[None]).view(1)
+
+    @torch.no_grad()
+    def predict_efficiency_batch(self, depths):
+        """
+        Predicts the latency of many architectures in one forward pass
+
+        Args:
+            depths: (N, 8) int tensor or array, depth list 'd' of each architecture
+
+        Returns:
+            (N,) tensor of latencies
+        """
+        b_feat, h_feat = archs_to_feat(depths, self.device)
+        return self.net(torch.cat((b_feat, h_feat), 1)).view(-1)
+
+    def export(self, prefix):
+        """
+        Saves the fused MLP as {prefix}.torchscript and {prefix}.npz, see load_latency_predictor()
+        """
+        net = copy.deepcopy(self.net).cpu()
+        torch.jit.script(net).save(f'{prefix}.torchscript')
+        np.savez(f'{prefix}.npz', **{k: v.numpy() for k, v in net.state_dict().items()})
+        return f'{prefix}.torchscript', f'{prefix}.npz'
+
+
+class FusedNet(nn.Module):
+    """
+    Backbone and head Nets (without hw embedding) as one MLP
+
+    Hidden layers are block-diagonal (no cross terms), the output layer adds both
+    latencies: FusedNet([b_feat, h_feat]) == b_net(b_feat) + h_net(h_feat).
+    """
+    def __init__(self, b_net, h_net):
+        super(FusedNet, self).__init__()
+        assert not b_net.hw_embed_on and not h_net.hw_embed_on
+        self.fc = nn.ModuleList()
+        for name in ['fc1', 'fc2', 'fc3', 'fc4']:
+            b, h = getattr(b_net, name), getattr(h_net, name)
+            fc = nn.Linear(b.in_features + h.in_features, b.out_features + h.out_features)
+            with torch.no_grad():
+                fc.weight.copy_(torch.block_diag(b.weight, h.weight))
+                fc.bias.copy_(torch.cat((b.bias, h.bias)))
+            self.fc.append(fc)
+        self.out = nn.Linear(b_net.fc5.in_features + h_net.fc5.in_features, 1)
+        with torch.no_grad():
+            self.out.weight.copy_(torch.cat((b_net.fc5.weight, h_net.fc5.weight), 1))
+            self.out.bias.copy_(b_net.fc5.bias + h_net.fc5.bias)
+
+    def forward(self, x):
+        for fc in self.fc:
+            x = F.relu(fc(x))
+        return self.out(x)
+
+
+class NumpyLatencyPredictor:
+    """
+    FusedNet exported to .npz, evaluated with NumPy (no torch device needed)
+    """
+    def __init__(self, path):
+        w = np.load(path)
+        self.layers = [(w[f'fc.{i}.weight'].T, w[f'fc.{i}.bias']) for i in range(4)]
+        self.out = (w['out.weight'].T, w['out.bias'])
+
+    def predict_efficiency_batch(self, depths):
+        b_feat, h_feat = archs_to_feat(depths, 'cpu')
+        x = torch.cat((b_feat, h_feat), 1).numpy()
+        for weight, bias in self.layers:
+            x = np.maximum(x @ weight + bias, 0)
+        return torch.from_numpy(x @ self.out[0] + self.out[1]).view(-1)
+
+    def predict_efficiency(self, arch):
+        return self.predict_efficiency_batch([arch['d']]).view(1)
+
+
+class TorchScriptLatencyPredictor(LatencyPredictor):
+    """
+    FusedNet exported to TorchScript
+    """
+    def __init__(self, path, device='cpu'):
+        self.device = torch.device(device)
+        self.net = torch.jit.load(path, map_location=self.device).eval()
+
+
+def load_latency_predictor(path, device='cpu'):
+    # predictor from a file written by LatencyPredictor.export()
+    if str(path).endswith('.npz'):
+        return NumpyLatencyPredictor(path)
+    return TorchScriptLatencyPredictor(path, device)
 
-        return latency_b + latency_h
-    
 def arch_to_feat(arch, device):
     # This function converts a backbone arch_encoding to a feature vector (20-D).
     d_list = copy.deepcopy(arch['d'])
@@ -60,6 +157,24 @@ def arch_to_feat(arch, device):
     return torch.Tensor(b_onehot).to(device).float(), torch.Tensor(h_onehot).to(device).float()
 
 
+def archs_to_feat(depths, device):
+    # Batched arch_to_feat(): (N, 8) depth lists to (N, 20) backbone and (N, 28) head feature vectors.
+    d = torch.as_tensor(depths, dtype=torch.long).to(device) - 1
+    n = d.shape[0]
+    rows = torch.arange(n, device=d.device)
+
+    b_onehot = torch.zeros(n, 20, device=d.device)
+    h_onehot = torch.zeros(n, 28, device=d.device)
+
+    for i in range(4):
+        b_onehot[rows, i*5 + d[:, i]] = 1
+
+    for i in range(4):
+        b_onehot[rows, i*5 + d[:, i+4]] = 1
+
+    return b_onehot, h_onehot
+
+
 class Net(nn.Module):
     """
     The base model for MAML (Meta-SGD) for meta-NAS-predictor.
@@ -1,4 +1,5 @@
 import copy
+import itertools
 import random
 from tqdm import tqdm, trange
 import numpy as np
@@ -50,8 +51,38 @@ class ArchManager:
 
     # def random_resample_resolution(self, sample):
     #     sample["r"][0] = random.choice(self.resolutions)
-    
-    
+
+    def all_depths(self):
+        # every depth list of the search space (3^4 x 5^4 = 50625)
+        return list(itertools.product(*[self.depths[0]] * self.num_blocks[0],
+                                      *[self.depths[1]] * self.num_blocks[1]))
+
+
+class LatencyTable:
+    """
+    Predicted latency of every architecture of the search space
+
+    The whole space is small enough to go through the latency predictor in one
+    batched forward pass, so the constraint checks of the search become lookups.
+    """
+    def __init__(self, arch_manager, efficiency_predictor):
+        self.depths = arch_manager.all_depths()
+        self.index = {d: i for i, d in enumerate(self.depths)}
+        self.latency = efficiency_predictor.predict_efficiency_batch(self.depths).float().cpu().numpy()
+        self.order = np.argsort(self.latency, kind='stable')  # indices by increasing latency
+
+    def __len__(self):
+        return len(self.depths)
+
+    def lookup(self, d):
+        return float(self.latency[self.index[tuple(d)]])
+
+    def feasible(self, constraint):
+        # indices of the architectures whose latency <= constraint
+        n = np.searchsorted(self.latency[self.order], constraint, side='right')
+        return self.order[:n]
+
+
 class EvolutionFinder:
 
     valid_constraint_range = {
@@ -83,6 +114,11 @@ class EvolutionFinder:
         self.arch_manager = ArchManager()
         self.num_blocks = self.arch_manager.num_blocks # [4, 4]
 
+        self.latency_table = LatencyTable(self.arch_manager, self.efficiency_predictor)
+        self.feasible = None
+        logger.info(f"latency table: {len(self.latency_table)} architectures, "
+                    f"{self.latency_table.latency.min():.1f} ~ {self.latency_table.latency.max():.1f}")
+
         self.population_size = kwargs.get("population_size", 1)
         self.num_generations = kwargs.get("num_generations", 500)
         self.parent_ratio = kwargs.get("parent_ratio", 1.)
@@ -132,14 +168,31 @@ class EvolutionFinder:
 
     def set_efficiency_constraint(self, new_constraint):
         self.efficiency_constraint = new_constraint
+        self.feasible = None
+
+    def feasible_indices(self):
+        # latency table indices of the architectures meeting the constraint
+        if self.feasible is None:
+            self.feasible = self.latency_table.feasible(self.efficiency_constraint)
+            if not len(self.feasible):
+                raise ValueError(f"no architecture meets the efficiency constraint {self.efficiency_constraint} "
+                                 f"(min. {self.latency_table.latency.min():.1f})")
+        return self.feasible
 
     def random_sample(self):
-        constraint = self.efficiency_constraint
+        # draw among the feasible architectures only, avoiding the ones already sampled while possible
+        feasible = self.feasible_indices()
+        sampled = set(tuple(d) for d in self.arch_manager.sample_list)
         while True:
-            sample = self.arch_manager.random_sample()
-            efficiency = self.efficiency_predictor.predict_efficiency(sample)
-            if efficiency <= constraint:
-                return sample, efficiency
+            d = self.latency_table.depths[random.choice(feasible)]
+            if d not in sampled or len(sampled) >= len(feasible):
+                break
+        sample = {
+            "d": list(d),
+        }
+        self.arch_manager.sample_list.append(sample["d"])
+        logger.info(sample)
+        return sample, self.latency_table.lookup(d)
 
     def mutate_sample(self, sample):
         constraint = self.efficiency_constraint
@@ -150,7 +203,7 @@ class EvolutionFinder:
                 if random.random() < self.mutate_prob:
                     self.arch_manager.random_resample_depth(new_sample, i)
 
-            efficiency = self.efficiency_predictor.predict_efficiency(new_sample)
+            efficiency = self.latency_table.lookup(new_sample["d"])
             if efficiency <= constraint:
                 return new_sample, efficiency
 
@@ -166,7 +219,7 @@ class EvolutionFinder:
                         [sample1[key][i], sample2[key][i]]
                     )
 
-            efficiency = self.efficiency_predictor.predict_efficiency(new_sample)
+            efficiency = self.latency_table.lookup(new_sample["d"])
             if efficiency <= constraint:
                 return new_sample, efficiency
 
@@ -183,10 +236,10 @@ class EvolutionFinder:
         child_pool = []
         best_info = None
 
-        for _ in trange(population_size, desc="Generate random population..."):
-            sample, efficiency = self.random_sample()
-            subnet, acc = self.accuracy_predictor.predict_accuracy_once(sample)
-            population.append( (acc, sample, efficiency.item(), subnet) )
+        samples = [self.random_sample() for _ in trange(population_size, desc="Generate random population...")]
+        results = self.accuracy_predictor.predict_accuracy([sample for sample, _ in samples])
+        for (sample, efficiency), (subnet, acc) in zip(samples, results):
+            population.append( (acc, sample, efficiency, subnet) )
 
         if verbose:
             for i, (a, s, e, n) in enumerate(population):
@@ -229,8 +282,9 @@ class EvolutionFinder:
                 child_pool.append(new_sample)
                 efficiency_pool.append(efficiency)
 
-            for i in trange(population_size, desc=f"[{iter+1}|{max_time_budget}] Mutate and Crossover..."):
-                subnet, acc = self.accuracy_predictor.predict_accuracy_once(child_pool[i])
-                population.append( (acc, child_pool[i], efficiency_pool[i].item(), subnet) )
+            logger.info(f"[{iter+1}|{max_time_budget}] Mutate and Crossover...")
+            results = self.accuracy_predictor.predict_accuracy(child_pool)
+            for i, (subnet, acc) in enumerate(results):
+                population.append( (acc, child_pool[i], efficiency_pool[i], subnet) )
 
         return best_valids, best_info   # best_acc_history, (acc, config, flops, subnet)
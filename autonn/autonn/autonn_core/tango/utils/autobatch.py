@@ -1,16 +1,26 @@
 # Simplified Version of autobatch.py of Yolov5, AGPL-3.0 license
 import torch
+import fcntl
 import gc
+import json
+import hashlib
 import logging
+import os
+
+import numpy as np
 
 from copy import deepcopy
-from tango.main import status_update
+from tango.main import status_update, COMMON_ROOT
 from tango.utils.general import colorstr
 
 
 DEBUG = True
 PREFIX = colorstr('AutoBatch: ')
 
+ESTIMATE_BATCH_SIZES = (1, 2, 4, 8)  # batch sizes profiled to fit the memory model
+ESTIMATE_CACHE = COMMON_ROOT / 'autobatch.json'
+PROFILE_STORE = COMMON_ROOT / 'batchsize_profile.json'  # max batch sizes, shared with BMS
+
 logger = logging.getLogger(__name__)
 
 class TestFuncGen:
@@ -63,11 +73,197 @@ def binary_search(uid, pid, low, high, test_func, want_to_get):
                       update_id="batchsize",
                       update_content=batchsize_content)
 
-def get_batch_size_for_gpu(uid, pid, model, ch, imgsz, bs_factor=0.8, amp_enabled=True, max_search=True):
+def get_batch_size_for_gpu(uid, pid, model, ch, imgsz, bs_factor=0.8, amp_enabled=True, max_search=True, mode='search', cfg=None):
+    if mode == 'estimate':
+        return autobatch_estimate(uid, pid, model, ch, imgsz, bs_factor, amp_enabled=amp_enabled, cfg=cfg)
     with torch.cuda.amp.autocast(enabled=amp_enabled):
-        return autobatch(uid, pid, model, ch, imgsz, bs_factor, max_search=max_search)
+        return autobatch(uid, pid, model, ch, imgsz, bs_factor, max_search=max_search, amp_enabled=amp_enabled, cfg=cfg)
+
+def profile_key(cfg, imgsz, amp_enabled, device):
+    # (model yaml md5, imgsz, amp, gpu model), BMS builds the same key from the same basemodel.yaml
+    with open(cfg, 'rb') as f:
+        h = hashlib.md5(f.read()).hexdigest()
+    return f'{h}|{imgsz}|{"amp" if amp_enabled else "fp32"}|{torch.cuda.get_device_name(device)}'
+
+def hardware_id(device):
+    # a profile is invalid on a gpu with the same name but different memory or architecture
+    p = torch.cuda.get_device_properties(device)
+    return f'{p.total_memory}|{p.major}.{p.minor}'
+
+def load_profile(key, device):
+    """
+    Max batch size (per gpu, without margin) of PROFILE_STORE, None if not profiled on this hardware
+    """
+    try:
+        with open(PROFILE_STORE) as f:
+            entry = json.load(f).get(key)
+    except (OSError, ValueError):
+        return None
+    if entry is None:
+        return None
+    if entry.get('hardware') != hardware_id(device):
+        logger.info(f'{PREFIX}hardware changed since profiled by {entry.get("source")}, profiling again')
+        return None
+    return int(entry['batch_size'])
+
+def save_profile(key, device, batch_size):
+    try:
+        # BMS and other AutoNN processes update the same store, hold its lock from read to replace
+        with open(f'{PROFILE_STORE}.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(PROFILE_STORE) as f:
+                    store = json.load(f)
+            except (OSError, ValueError):
+                store = {}
+            store[key] = {'batch_size': int(batch_size), 'hardware': hardware_id(device), 'source': 'autonn'}
+            tmp = f'{PROFILE_STORE}.{os.getpid()}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(store, f, indent=2)
+            os.replace(tmp, PROFILE_STORE)
+    except OSError as e:
+        logger.warning(f'{PREFIX}failed to save {PROFILE_STORE}: {e}')
+
+def model_key(model):
+    # architecture hash: the model yaml when there is one, the module tree otherwise
+    m = model.module if hasattr(model, 'module') else model
+    desc = json.dumps(m.yaml, sort_keys=True, default=str) if isinstance(getattr(m, 'yaml', None), dict) else repr(m)
+    return hashlib.md5(desc.encode()).hexdigest()
+
+def load_estimate_cache():
+    try:
+        with open(ESTIMATE_CACHE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_estimate_cache(key, memory_model):
+    try:
+        # other AutoNN processes update the same cache, hold its lock from read to replace
+        with open(f'{ESTIMATE_CACHE}.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            cache = load_estimate_cache()
+            cache[key] = memory_model
+            tmp = f'{ESTIMATE_CACHE}.{os.getpid()}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(cache, f, indent=2)
+            os.replace(tmp, ESTIMATE_CACHE)
+    except OSError as e:
+        logger.warning(f'{PREFIX}failed to save {ESTIMATE_CACHE}: {e}')
+
+def profile_memory(model, ch, imgsz, device, amp_enabled=True, batch_sizes=ESTIMATE_BATCH_SIZES):
+    """
+    Peak memory of one forward/backward pass for a few small batch sizes
+
+    Returns:
+        [(batch_size, peak memory in bytes), ...], stops at the first OOM
+    """
+    results = []
+    model.train()
+    for b in batch_sizes:
+        img = torch.zeros(b, ch, imgsz, imgsz, device=device).float()
+        try:
+            torch.cuda.synchronize(device)
+            torch.cuda.reset_peak_memory_stats(device)
+            with torch.cuda.amp.autocast(enabled=amp_enabled):
+                y = model(img)
+                y = y[1] if isinstance(y, list) else y
+                loss = (sum(yi.sum() for yi in y) if isinstance(y, list) else y).sum()
+            loss.backward()
+            torch.cuda.synchronize(device)
+            results.append((b, torch.cuda.max_memory_allocated(device)))
+            if DEBUG: logger.info(f'{PREFIX} batch size {b}: peak {results[-1][1] / (1 << 30):.3f}G')
+        except RuntimeError as e:
+            if DEBUG: logger.info(f'{PREFIX} batch size {b}: fail ({e})')
+            break
+        finally:
+            del img
+            y = loss = None
+            model.zero_grad(set_to_none=True)
+    torch.cuda.empty_cache()
+    return results
+
+def fit_memory_model(results):
+    """
+    Least-squares fit of peak memory = slope * batch_size + intercept
+    """
+    x, y = np.array(results, dtype=np.float64).T
+    slope, intercept = np.polyfit(x, y, 1) if len(x) > 1 else (y[0], 0.)
+    return {'slope': float(max(slope, 1.)), 'intercept': float(intercept)}
+
+def autobatch_estimate(uid, pid, model, ch, imgsz, bs_factor=0.8, amp_enabled=True, batch_size=16, cfg=None):
+    """
+    Batch size from a linear memory model instead of probing until OOM
+
+    The peak memory of a few small batches is fitted per device type and cached
+    in ESTIMATE_CACHE keyed by (model architecture, imgsz, amp, device name), so
+    a rerun of the same model on the same kind of GPU does not profile at all.
+    A max batch size already in PROFILE_STORE (from BMS or a search run) is used
+    as is; the estimated one is not recorded there, since it extrapolates the
+    memory free at the moment and BMS would trust it as a probed maximum.
+    Each GPU gets the largest batch its free memory holds (x bs_factor) and,
+    since DDP uses one batch size for all ranks, the smallest of them is used.
+
+    Returns:
+        total batch size for all GPUs, like autobatch()
+    """
+    device = next(model.parameters()).device
+    if device.type == 'cpu' or not torch.cuda.is_available():
+        logger.info(f'{PREFIX}CUDA not detected, using default CPU batch size {batch_size}')
+        return batch_size
+    if torch.backends.cudnn.benchmark:
+        logger.info(f'{PREFIX}requires cudnn.benchmark=False, using default batch size {batch_size}')
+        return batch_size
+
+    gb = 1 << 30
+    arch = model_key(model)
+    cache = load_estimate_cache()
+    per_gpu = {}
+    for i in range(torch.cuda.device_count()):
+        d = torch.device('cuda', i)
+        name = torch.cuda.get_device_name(d)
+        profile = profile_key(cfg, imgsz, amp_enabled, d) if cfg and os.path.isfile(cfg) else None
+        profiled = load_profile(profile, d) if profile else None
+        if profiled is not None:
+            per_gpu[i] = max(int(profiled * bs_factor), 1)
+            logger.info(f'{PREFIX}CUDA:{i} ({name}) max batch size {profiled} from {PROFILE_STORE}, '
+                        f'batch size {per_gpu[i]}')
+            continue
+        key = f'{arch}|{imgsz}|{"amp" if amp_enabled else "fp32"}|{name}'
+        memory_model = cache.get(key)
+        if memory_model is None:
+            m = model if d == device else deepcopy(model).to(d)
+            results = profile_memory(m, ch, imgsz, d, amp_enabled)
+            if m is not model:
+                del m
+                torch.cuda.empty_cache()
+            if not results:
+                logger.info(f'{PREFIX}CUDA:{i} ({name}) can not fit batch size {ESTIMATE_BATCH_SIZES[0]}')
+                per_gpu[i] = 1
+                continue
+            memory_model = fit_memory_model(results)
+            cache[key] = memory_model
+            save_estimate_cache(key, memory_model)
+        else:
+            logger.info(f'{PREFIX}CUDA:{i} ({name}) memory model from cache')
+
+        free, total = torch.cuda.mem_get_info(d)
+        usable = free + torch.cuda.memory_reserved(d) # memory this process already holds is usable too
+        b_max = (usable - memory_model['intercept']) / memory_model['slope']
+        per_gpu[i] = max(int(b_max * bs_factor), 1)
+        logger.info(f'{PREFIX}CUDA:{i} ({name}) {total / gb:.2f}G total, {usable / gb:.2f}G usable, '
+                    f'{memory_model["slope"] / gb:.3f}G/img + {memory_model["intercept"] / gb:.2f}G '
+                    f'-> max {b_max:.1f}, batch size {per_gpu[i]}')
 
-def autobatch(uid, pid, model, ch, imgsz, bs_factor=0.8, batch_size=16, max_search=True):
+    final_batch_size = min(per_gpu.values())
+    status_update(uid, pid,
+                  update_id="batchsize",
+                  update_content={'low': final_batch_size, 'high': final_batch_size})
+    gc.collect()
+    logger.info(f'{PREFIX}Final Batch Size = {final_batch_size * len(per_gpu)} ({final_batch_size} x {len(per_gpu)} GPU)')
+    return final_batch_size * len(per_gpu)
+
+def autobatch(uid, pid, model, ch, imgsz, bs_factor=0.8, batch_size=16, max_search=True, amp_enabled=True, cfg=None):
     # Check device
     # device = torch.device(f'cuda:0')
     device = next(model.parameters()).device
@@ -90,6 +286,21 @@ def autobatch(uid, pid, model, ch, imgsz, bs_factor=0.8, batch_size=16, max_sear
     f = t - (r + a)                             # free = total - (reserved + allocated)
     logger.info(f'\n{PREFIX}{d} ({properties.name}) {t:.2f}G total, {r:.2f}G reserved, {a:.2f}G allocated, {f:.2f}G free')
 
+    # Look up the max batch size profiled by BMS or a previous run
+    key = profile_key(cfg, imgsz, amp_enabled, device) if cfg and os.path.isfile(cfg) else None
+    profiled = load_profile(key, device) if key else None
+    if profiled is not None:
+        logger.info(f'{PREFIX}Max batch size {profiled} from {PROFILE_STORE}')
+        status_update(uid, pid,
+                      update_id="batchsize",
+                      update_content={'low': profiled, 'high': profiled})
+        if max_search:
+            final_batch_size = profiled * bs_factor
+        else:
+            final_batch_size = 1 << (profiled.bit_length() - 1) # what doubling would find
+        gc.collect()
+        logger.info(f'{PREFIX}Final Batch Size = {int(final_batch_size * num_dev)}')
+        return final_batch_size * num_dev
 
     # model.to(device)
     model.train()
@@ -127,6 +338,8 @@ def autobatch(uid, pid, model, ch, imgsz, bs_factor=0.8, batch_size=16, max_sear
     if max_search: # search maximum batch size (allow size other than multiple of 2)
         test_func = TestFuncGen(model, ch, imgsz)
         final_batch_size = binary_search(uid, pid, final_batch_size, batch_size, test_func, want_to_get=True)
+        if key:
+            save_profile(key, device, final_batch_size)
         logger.info(f'{PREFIX} Make margin to avoid CUDA Out-of-memory '
                     f'(max {final_batch_size} x margin factor {bs_factor})')
         final_batch_size *= bs_factor # need some spare
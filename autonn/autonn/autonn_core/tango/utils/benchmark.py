@@ -0,0 +1,195 @@
+import fcntl
+import gc
+import json
+import time
+import hashlib
+import logging
+import os
+import platform
+import yaml
+
+import numpy as np
+import torch
+
+from tango.main import COMMON_ROOT
+from tango.utils.general import colorstr
+
+
+PREFIX = colorstr('Benchmark: ')
+
+BENCHMARK_BATCH_SIZE = 8    # batch size for throughput
+BENCHMARK_TRAIN_BATCH_SIZE = 2  # smallest training batch, for the training memory footprint
+BENCHMARK_WARMUP = 3
+BENCHMARK_ITERS = 10
+BENCHMARK_CACHE = COMMON_ROOT / 'benchmark.json'
+
+logger = logging.getLogger(__name__)
+
+
+def cfg_key(cfg):
+    # md5 of a model yaml file
+    with open(cfg, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+def device_name(device):
+    if device.type == 'cuda':
+        return torch.cuda.get_device_name(device)
+    return f'cpu ({platform.processor() or platform.machine()})'
+
+def load_benchmark_cache():
+    try:
+        with open(BENCHMARK_CACHE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_benchmark_cache(key, result):
+    try:
+        # other AutoNN processes update the same cache, hold its lock from read to replace
+        with open(f'{BENCHMARK_CACHE}.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            cache = load_benchmark_cache()
+            cache[key] = result
+            tmp = f'{BENCHMARK_CACHE}.{os.getpid()}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(cache, f, indent=2)
+            os.replace(tmp, BENCHMARK_CACHE)
+    except OSError as e:
+        logger.warning(f'{PREFIX}failed to save {BENCHMARK_CACHE}: {e}')
+
+def build_model(cfg, task):
+    # the model as the yaml declares it (ch, nc), so the result depends on the yaml only
+    from tango.common.models.yolo import Model
+    from tango.common.models.resnet_cifar10 import ClassifyModel
+    if task == 'classification':
+        return ClassifyModel(cfg)
+    return Model(cfg)
+
+def time_forward(model, img, device, iters):
+    # median seconds of one forward pass
+    times = []
+    for _ in range(iters):
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        t = time.perf_counter()
+        model(img)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        times.append(time.perf_counter() - t)
+    return float(np.median(times))
+
+def measure(model, ch, imgsz, device, batch_size=BENCHMARK_BATCH_SIZE,
+            warmup=BENCHMARK_WARMUP, iters=BENCHMARK_ITERS):
+    """
+    Inference latency, peak memory, training memory and throughput of a model with synthetic batches
+
+    Returns:
+        {'params', 'latency_ms' (batch 1), 'peak_mem' (bytes at batch 1, None on cpu),
+         'train_mem' (bytes of a forward + backward pass at BENCHMARK_TRAIN_BATCH_SIZE, None on cpu),
+         'throughput' (img/s at the largest batch that fits), 'batch_size'}
+    """
+    cuda = device.type == 'cuda'
+    model = model.to(device).eval()
+    result = {'params': int(sum(p.numel() for p in model.parameters()))}
+    with torch.no_grad():
+        img = torch.zeros(1, ch, imgsz, imgsz, device=device)
+        for _ in range(warmup):
+            model(img)
+        if cuda:
+            torch.cuda.synchronize(device)
+            torch.cuda.reset_peak_memory_stats(device)
+        t = time_forward(model, img, device, iters)
+        result['latency_ms'] = t * 1E3
+        result['peak_mem'] = torch.cuda.max_memory_allocated(device) if cuda else None
+        result['throughput'], result['batch_size'] = 1. / t, 1
+        del img
+
+        try:
+            img = torch.zeros(batch_size, ch, imgsz, imgsz, device=device)
+            model(img)
+            t = time_forward(model, img, device, iters)
+            result['throughput'], result['batch_size'] = batch_size / t, batch_size
+        except RuntimeError as e:
+            logger.info(f'{PREFIX}batch size {batch_size}: fail ({e}), throughput of batch size 1 is used')
+        finally:
+            img = None
+
+    result['train_mem'] = train_memory(model, ch, imgsz, device) if cuda else None
+    return result
+
+def train_memory(model, ch, imgsz, device, batch_size=BENCHMARK_TRAIN_BATCH_SIZE):
+    # peak memory of one training step (forward + backward), inf if it does not fit this device
+    model.train()
+    torch.cuda.synchronize(device)
+    torch.cuda.reset_peak_memory_stats(device)
+    try:
+        y = model(torch.zeros(batch_size, ch, imgsz, imgsz, device=device))
+        sum(t.float().sum() for t in flatten_output(y)).backward()
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device)
+    except RuntimeError as e:
+        logger.info(f'{PREFIX}training step of batch size {batch_size}: fail ({e})')
+        return float('inf')
+    finally:
+        y = None
+        model.zero_grad(set_to_none=True)
+        model.eval()
+
+def flatten_output(y):
+    # tensors of a (nested) model output
+    if isinstance(y, (list, tuple)):
+        return [t for x in y for t in flatten_output(x)]
+    return [y]
+
+def benchmark_cfg(cfg, task, device=None):
+    """
+    measure() of a candidate yaml, cached in BENCHMARK_CACHE per (yaml, device, imgsz)
+    """
+    if device is None:
+        device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    with open(cfg) as f:
+        d = yaml.safe_load(f)
+    ch, imgsz = d.get('ch', 3), d['imgsz']
+
+    name = device_name(device)
+    key = f'{cfg_key(cfg)}|{name}|{imgsz}'
+    cache = load_benchmark_cache()
+    if 'train_mem' in cache.get(key, {}):
+        logger.info(f'{PREFIX}{os.path.basename(cfg)} on {name} from cache')
+        return cache[key]
+
+    model = None
+    try:
+        model = build_model(cfg, task)
+        result = measure(model, ch, imgsz, device)
+    except RuntimeError as e:
+        logger.warning(f'{PREFIX}{os.path.basename(cfg)} on {name} failed: {e}')
+        return None  # not cached, the device may just be busy
+    finally:
+        del model
+        gc.collect()
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+    mem = f'{result["peak_mem"] / (1 << 30):.2f}G' if result['peak_mem'] is not None else '-'
+    train_mem = f'{result["train_mem"] / (1 << 30):.2f}G' if result['train_mem'] is not None else '-'
+    logger.info(f'{PREFIX}{os.path.basename(cfg)} on {name} imgsz {imgsz}: '
+                f'{result["params"] / 1E6:.1f}M params, {result["latency_ms"]:.1f}ms, '
+                f'{result["throughput"]:.1f}img/s (batch {result["batch_size"]}), peak {mem}, training {train_mem}')
+    save_benchmark_cache(key, result)
+    return result
+
+def meets_target(result, latency_ms=None, memory_gb=None):
+    """
+    Whether a benchmark result fits the latency budget (ms) and memory (GB) of the target
+
+    The model is trained on the target, so the memory is compared with its training footprint
+    """
+    if result is None:
+        return False
+    if latency_ms is not None and result['latency_ms'] > float(latency_ms):
+        return False
+    if memory_gb is not None and result.get('train_mem') is not None \
+            and result['train_mem'] > float(memory_gb) * (1 << 30):
+        return False
+    return True
@@ -0,0 +1,141 @@
+# Asynchronous checkpoint writer
+
+import io
+import itertools
+import logging
+import os
+import queue
+import threading
+from copy import deepcopy
+
+import torch
+import torch.nn as nn
+
+logger = logging.getLogger(__name__)
+
+
+class CheckpointWriter:
+    """
+    Saves training checkpoints from a background thread
+
+    save() only stages the tensors of a checkpoint in CPU memory (pinned and
+    reused between epochs) on the training thread: nn.Module values are
+    converted to half precision like deepcopy(model).half() did, everything
+    else keeps its dtype. Pickling and file I/O happen in a daemon thread.
+    A checkpoint going to several paths (best.pt and last.pt) is serialized
+    once. Each file is written under a temporary name and renamed, so a crash
+    never leaves a torn .pt.
+    """
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = None
+        self._staged = {}       # (id(tensor), half): CPU staging tensor of the previous save()
+
+    # ---- training thread --------------------------------------------------
+
+    def save(self, ckpt, paths, on_saved=None):
+        """
+        Queue a checkpoint
+
+        Waits for the previous checkpoint first, since it is staged in the same buffers.
+
+        Args:
+            ckpt (dict): checkpoint, values may be nn.Module, tensors or nested dict/list of tensors
+            paths (list): files to write (duplicates and None are skipped)
+            on_saved (callable): called from the writer thread with the written paths
+        """
+        paths = list(dict.fromkeys(str(p) for p in paths if p))
+        if not paths:
+            if on_saved is not None:
+                on_saved(paths)
+            return
+        self.flush()
+
+        staged = {}
+        snapshot = {k: self._module(v, staged) if isinstance(v, nn.Module) else self._tree(v, staged)
+                    for k, v in ckpt.items()}
+        self._staged = staged
+        event = None
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            event = torch.cuda.Event()
+            event.record()  # non_blocking copies are complete once this event is
+
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='CheckpointWriter', daemon=True)
+            self._thread.start()
+        self._queue.put((snapshot, paths, event, on_saved))
+
+    def flush(self):
+        """
+        Wait until every queued checkpoint is on disk
+        """
+        self._queue.join()
+
+    def close(self):
+        """
+        Flush and stop the writer thread
+        """
+        self.flush()
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._thread = None
+        self._staged = {}
+
+    def _stage(self, t, half, staged):
+        dtype = torch.float16 if half and t.is_floating_point() else t.dtype
+        key = (id(t), half)
+        buf = self._staged.get(key)
+        if buf is None or buf.shape != t.shape or buf.dtype != dtype:
+            buf = torch.empty(t.shape, dtype=dtype, pin_memory=t.is_cuda)
+        buf.copy_(t.detach(), non_blocking=True)
+        staged[key] = buf
+        return buf
+
+    def _module(self, module, staged):
+        # deepcopy(module).half() without copying the tensors on the GPU: they are mapped to staging buffers
+        memo = {}
+        for t in itertools.chain(module.parameters(), module.buffers()):
+            buf = self._stage(t, True, staged)
+            memo[id(t)] = nn.Parameter(buf, requires_grad=t.requires_grad) if isinstance(t, nn.Parameter) else buf
+        return deepcopy(module, memo)
+
+    def _tree(self, obj, staged):
+        if isinstance(obj, torch.Tensor):
+            return self._stage(obj, False, staged)
+        if isinstance(obj, dict):
+            return {k: self._tree(v, staged) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._tree(v, staged) for v in obj)
+        return obj
+
+    # ---- writer thread ----------------------------------------------------
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                ckpt, paths, event, on_saved = item
+                if event is not None:
+                    event.synchronize()
+                self._write(ckpt, paths)
+                if on_saved is not None:
+                    on_saved(paths)
+            except Exception as e:
+                logger.warning(f'CheckpointWriter: failed to save {item[1]}: {e}')
+            finally:
+                self._queue.task_done()
+
+    @staticmethod
+    def _write(ckpt, paths):
+        buffer = io.BytesIO()
+        torch.save(ckpt, buffer)  # serialized once for all paths
+        data = buffer.getbuffer()
+        for path in paths:
+            tmp = path + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        logger.info(f'CheckpointWriter: {", ".join(paths)} {data.nbytes / 1E6:.1f} MB')
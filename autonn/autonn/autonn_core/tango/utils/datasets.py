@@ -1,6 +1,7 @@
 # Dataset utils and dataloaders
 
 import glob
+import hashlib
 import logging
 import math
 import os
@@ -43,6 +44,9 @@ from tango.utils.torch_utils import torch_distributed_zero_first
 help_url = 'https://github.com/ultralytics/yolov5/wiki/Train-Custom-Data'
 img_formats = ['bmp', 'jpg', 'jpeg', 'png', 'tif', 'tiff', 'dng', 'webp', 'mpo']  # acceptable image suffixes
 vid_formats = ['mov', 'avi', 'mp4', 'mpg', 'mpeg', 'm4v', 'wmv', 'mkv']  # acceptable video suffixes
+NUM_THREADS = min(8, max(1, (os.cpu_count() or 1) - 1))  # dataset verification threads
+VERIFY_CHUNKSIZE = 64  # max image-label pairs handed to a verification thread at once
+LABEL_CACHE_VERSION = 0.2  # bump whenever the *.cache layout written by cache_labels() changes
 
 logger = logging.getLogger(__name__)
 
@@ -52,9 +56,73 @@ for orientation in ExifTags.TAGS.keys():
         break
 
 
+def file_stamp(f):
+    # Returns (size, mtime_ns) of a file or None if it does not exist
+    try:
+        s = os.stat(f)
+        return s.st_size, s.st_mtime_ns
+    except OSError:
+        return None
+
+
 def get_hash(files):
-    # Returns a single hash value of a list of files
-    return sum(os.path.getsize(f) for f in files if os.path.isfile(f))
+    # Returns a single hash value of a list of files (paths, sizes and modification times)
+    h = hashlib.md5()
+    for f in files:
+        h.update(f'{f}:{file_stamp(f)};'.encode())
+    return h.hexdigest()
+
+
+def load_label_cache(path):
+    # Returns a label cache previously saved by LoadImagesAndLabels.cache_labels(), None if unusable
+    try:
+        cache = torch.load(path)
+    except Exception:
+        return None
+    if not isinstance(cache, dict) or cache.get('version') != LABEL_CACHE_VERSION:
+        return None  # cache from an older (or unknown) format, scan again from scratch
+    return cache
+
+
+def verify_image_label(args):
+    # Verify one image-label pair, returns (im_file, labels, shape, segments, nm, nf, ne, nc, message)
+    (im_file, lb_file), prefix = args
+    nm, nf, ne, nc = 0, 0, 0, 0  # number missing, found, empty, corrupt
+    try:
+        # verify images
+        im = Image.open(im_file)
+        im.verify()  # PIL verify
+        shape = exif_size(im)  # image size
+        segments = []  # instance segments
+        assert (shape[0] > 9) & (shape[1] > 9), f'image size {shape} <10 pixels'
+        assert im.format.lower() in img_formats, f'invalid image format {im.format}'
+
+        # verify labels
+        if os.path.isfile(lb_file):
+            nf = 1  # label found
+            with open(lb_file, 'r') as f:
+                l = [x.split() for x in f.read().strip().splitlines()]
+                if any([len(x) > 8 for x in l]):  # is segment
+                    classes = np.array([x[0] for x in l], dtype=np.float32)
+                    segments = [np.array(x[1:], dtype=np.float32).reshape(-1, 2) for x in l]  # (cls, xy1...)
+                    l = np.concatenate((classes.reshape(-1, 1), segments2boxes(segments)), 1)  # (cls, xywh)
+                l = np.array(l, dtype=np.float32)
+            if len(l):
+                assert l.shape[1] == 5, 'labels require 5 columns each'
+                assert (l >= 0).all(), 'negative labels'
+                assert (l[:, 1:] <= 1).all(), 'non-normalized or out of bounds coordinate labels'
+                assert np.unique(l, axis=0).shape[0] == l.shape[0], 'duplicate labels'
+            else:
+                ne = 1  # label empty
+                l = np.zeros((0, 5), dtype=np.float32)
+        else:
+            nm = 1  # label missing
+            l = np.zeros((0, 5), dtype=np.float32)
+        return im_file, l, shape, segments, nm, nf, ne, nc, ''
+    except Exception as e:
+        nc = 1
+        msg = f'Dataset_{prefix}: WARNING: Ignoring corrupted image and/or label {im_file}: {e}'
+        return im_file, None, None, None, nm, nf, ne, nc, msg
 
 
 def exif_size(img):
@@ -87,6 +155,7 @@ def create_dataloader(uid, pid, path, imgsz, batch_size, stride, opt, hyp=None,
                                       stride=int(stride),
                                       pad=pad,
                                       image_weights=image_weights,
+                                      workers=max(1, workers),  # label verification threads
                                       prefix=prefix)
 
     batch_size = min(batch_size, len(dataset))
@@ -363,11 +432,101 @@ def img2label_paths(img_paths):
     return ['txt'.join(x.replace(sa, sb, 1).rsplit(x.split('.')[-1], 1)) for x in img_paths]
 
 
+class ImageStore:
+    """ Packed, memory-mapped store of resized dataset images
+
+    Every image is kept back to back in one '*.imgs' file and a '*.imgs.idx' index holds the byte offset,
+    resized shape and original hw of each one. The data file is mapped read-only, so all DataLoader workers
+    and every later run on the same images (train, finetune, test) share one copy in the page cache.
+
+    Args:
+        path (Path): data file, the index is written next to it
+    """
+    version = 0.1  # bump whenever the index layout changes
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.index_path = self.path.with_suffix(self.path.suffix + '.idx')
+        self.index = None  # {im_file: entry number}
+        self.mm = None  # np.memmap, opened lazily in each process
+
+    @staticmethod
+    def key(img_files, img_size, augment):
+        # images are stored already resized, so the interpolation mode (augment) is part of the key as well
+        return f'{get_hash(sorted(img_files))}:{img_size}:{int(bool(augment))}'
+
+    def load(self, key):
+        # Returns True if a store matching key exists on disk and is complete
+        try:
+            idx = torch.load(self.index_path)
+        except Exception:
+            return False
+        if idx.get('version') != self.version or idx.get('key') != key:
+            return False
+        if not self.path.is_file() or self.path.stat().st_size != idx['nbytes']:
+            return False  # interrupted or overwritten
+        self._set_index(idx)
+        return True
+
+    def build(self, key, img_files, load_fn, workers=NUM_THREADS, prefix=''):
+        # Decodes every image with load_fn(i) -> (img, hw0, hw) and packs them into a single file
+        n = len(img_files)
+        offsets = np.zeros(n, dtype=np.int64)  # byte offset of each image
+        shapes = np.zeros((n, 3), dtype=np.int64)  # resized h, w, c
+        hw0 = np.zeros((n, 2), dtype=np.int64)  # original h, w
+        tmp = Path(f'{self.path}.{os.getpid()}.tmp')
+        nbytes = 0
+        try:
+            with open(tmp, 'wb') as f, ThreadPool(workers) as pool:
+                pbar = tqdm(enumerate(pool.imap(load_fn, range(n))), total=n)
+                for i, (img, h0w0, _) in pbar:
+                    img = np.ascontiguousarray(img)
+                    if img.ndim == 2:
+                        img = img[..., None]
+                    offsets[i], shapes[i], hw0[i] = nbytes, img.shape, h0w0
+                    f.write(img.tobytes())
+                    nbytes += img.nbytes
+                    pbar.desc = f'{prefix}Packing images into {self.path.name} ({nbytes / 1E9:.1f}GB)'
+                pbar.close()
+        except Exception:
+            tmp.unlink(missing_ok=True)
+            raise
+        idx = {'version': self.version, 'key': key, 'files': list(img_files),
+               'offsets': offsets, 'shapes': shapes, 'hw0': hw0, 'nbytes': nbytes}
+        os.replace(tmp, self.path)  # atomic, readers never see a half written store
+        tmp = Path(f'{self.index_path}.{os.getpid()}.tmp')
+        torch.save(idx, tmp)
+        os.replace(tmp, self.index_path)
+        self._set_index(idx)
+        return nbytes
+
+    def _set_index(self, idx):
+        self.files = idx['files']
+        self.offsets, self.shapes, self.hw0 = idx['offsets'], idx['shapes'], idx['hw0']
+        self.index = {f: i for i, f in enumerate(self.files)}
+        self.mm = None
+
+    def get(self, im_file):
+        # Returns (img, hw_original, hw_resized) of im_file, img is a read-only view into the mapped file
+        if self.mm is None:
+            self.mm = np.memmap(self.path, dtype=np.uint8, mode='r')
+        i = self.index[im_file]
+        shape = tuple(self.shapes[i])
+        img = self.mm[self.offsets[i]:self.offsets[i] + int(np.prod(shape))].reshape(shape)
+        return img, tuple(self.hw0[i]), shape[:2]
+
+    def __getstate__(self):
+        # do not pickle the mapping into DataLoader workers, each worker maps the file on first access
+        state = self.__dict__.copy()
+        state['mm'] = None
+        return state
+
+
 class LoadImagesAndLabels(Dataset):  # for training/testing
     def __init__(self, uid, pid, path, img_size=640, batch_size=16,
                  augment=False, hyp=None, rect=False, image_weights=False,
                  cache_images=False, single_cls=False, stride=32, pad=0.0,
-                 prefix=''):
+                 workers=NUM_THREADS, prefix=''):
         self.userid = uid
         self.project_id = pid
         self.img_size = img_size
@@ -379,6 +538,7 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
         self.mosaic_border = [-img_size // 2, -img_size // 2]
         self.stride = stride
         self.path = path        
+        self.workers = workers  # threads used by cache_labels() to verify images and labels
         #self.albumentations = Albumentations() if augment else None
 
         try:
@@ -405,13 +565,9 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
         # Check cache
         self.label_files = img2label_paths(self.img_files)  # labels
         cache_path = (p if p.is_file() else Path(self.label_files[0]).parent).with_suffix('.cache')  # cached labels
-        # if cache_path.is_file():
-        #     cache, exists = torch.load(cache_path), True  # load
-        #     if cache['hash'] != get_hash(self.label_files + self.img_files) or 'version' not in cache:  # changed
-        #        cache, exists = self.cache_labels(cache_path, prefix), False  # re-cache
-        # else:
-        #     cache, exists = self.cache_labels(cache_path, prefix), False  # cache
-        cache, exists = self.cache_labels(cache_path, prefix), False
+        cache, exists = (load_label_cache(cache_path) if cache_path.is_file() else None), True  # load
+        if cache is None or cache['hash'] != get_hash(self.label_files + self.img_files):  # missing or changed
+            cache, exists = self.cache_labels(cache_path, prefix, prev=cache), False  # re-scan new/changed files only
 
         # Display cache
         nf, nm, ne, nc, n = cache.pop('results')  # found, missing, empty, corrupted, total
@@ -434,6 +590,7 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
         # Read cache
         cache.pop('hash')  # remove hash
         cache.pop('version')  # remove version
+        cache.pop('stamps')  # remove per-file stamps
         labels, shapes, self.segments = zip(*cache.values())
         self.labels = list(labels)
         self.shapes = np.array(shapes, dtype=np.float64)
@@ -475,8 +632,27 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             self.batch_shapes = np.ceil(np.array(shapes) * img_size / stride + pad).astype(int) * stride
 
         # Cache images into memory for faster training (WARNING: large datasets may exceed system RAM)
+        # 'mmap' packs the resized images into one file next to the images, mapped read-only and shared by workers
         self.imgs = [None] * n
-        if cache_images:
+        self.img_store = None
+        if cache_images == 'mmap':
+            suffix = '_aug' if augment else ''  # images are resized with a different interpolation when augmenting
+            # splits listed from the same image folder (txt lists) get a store each, named by their file list
+            files_id = hashlib.md5('\n'.join(sorted(self.img_files)).encode()).hexdigest()[:8]
+            store = ImageStore(Path(Path(self.img_files[0]).parent.as_posix() + f'_{img_size}{suffix}_{files_id}.imgs'))
+            key = ImageStore.key(self.img_files, img_size, augment)
+            if store.load(key):
+                self.img_store = store
+                logger.info(f'Dataset_{prefix}: Using packed images {store.path}')
+            else:
+                try:
+                    nbytes = store.build(key, self.img_files, lambda i: load_image(self, i), self.workers, prefix)
+                    self.img_store = store
+                    logger.info(f'Dataset_{prefix}: Packed images into {store.path} ({nbytes / 1E9:.1f}GB)')
+                except Exception as e:
+                    logger.warning(f'Dataset_{prefix}: WARNING: Failed to pack images into {store.path}, '
+                                   f'images are not cached: {e}')
+        elif cache_images:
             if cache_images == 'disk':
                 self.im_cache_dir = Path(Path(self.img_files[0]).parent.as_posix() + '_npy')
                 self.img_npy = [self.im_cache_dir / Path(f).with_suffix('.npy').name for f in self.img_files]
@@ -497,63 +673,65 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
                     pbar.desc = f'{prefix}Caching images ({gb / 1E9:.1f}GB)'
             pbar.close()
 
-    def cache_labels(self, path=Path('./labels.cache'), prefix=''):
+    def cache_labels(self, path=Path('./labels.cache'), prefix='', prev=None):
         # Cache dataset labels, check images and read shapes
+        # prev: a cache loaded from disk, entries of files whose (size, mtime) did not change are reused as they are
         x = {}  # dict
-        nm, nf, ne, nc = 0, 0, 0, 0  # number missing, found, empty, duplicate
+        stamps = {}  # im_file: (image stamp, label stamp)
+        prev_stamps = prev.get('stamps', {}) if prev else {}
+        nm, nf, ne, nc, nr = 0, 0, 0, 0, 0  # number missing, found, empty, duplicate, reused
         # pbar = tqdm(zip(self.img_files, self.label_files), desc='Scanning images', total=len(self.img_files))
         # for i, (im_file, lb_file) in enumerate(pbar):
         dataset_info = {}
         dataset_info['total'] = len(self.img_files)
         logger.info(f'\nDataset_{prefix}: Scanning {path.parent / path.stem} images and labels... ')
-        for i, (im_file, lb_file) in enumerate(zip(self.img_files, self.label_files)):
-            try:
-                # verify images
-                im = Image.open(im_file)
-                im.verify()  # PIL verify
-                shape = exif_size(im)  # image size
-                segments = []  # instance segments
-                assert (shape[0] > 9) & (shape[1] > 9), f'image size {shape} <10 pixels'
-                assert im.format.lower() in img_formats, f'invalid image format {im.format}'
-
-                # verify labels
-                if os.path.isfile(lb_file):
-                    nf += 1  # label found
-                    with open(lb_file, 'r') as f:
-                        l = [x.split() for x in f.read().strip().splitlines()]
-                        if any([len(x) > 8 for x in l]):  # is segment
-                            classes = np.array([x[0] for x in l], dtype=np.float32)
-                            segments = [np.array(x[1:], dtype=np.float32).reshape(-1, 2) for x in l]  # (cls, xy1...)
-                            l = np.concatenate((classes.reshape(-1, 1), segments2boxes(segments)), 1)  # (cls, xywh)
-                        l = np.array(l, dtype=np.float32)
-                    if len(l):
-                        assert l.shape[1] == 5, 'labels require 5 columns each'
-                        assert (l >= 0).all(), 'negative labels'
-                        assert (l[:, 1:] <= 1).all(), 'non-normalized or out of bounds coordinate labels'
-                        assert np.unique(l, axis=0).shape[0] == l.shape[0], 'duplicate labels'
+        files = list(zip(self.img_files, self.label_files))
+        file_stamps = [(file_stamp(im_file), file_stamp(lb_file)) for im_file, lb_file in files]
+        reuse = [prev_stamps.get(im_file) == stamp and im_file in prev
+                 for (im_file, _), stamp in zip(files, file_stamps)]
+        todo = [f for f, r in zip(files, reuse) if not r]  # new or changed since the last scan
+
+        # verify in parallel, imap() hands results back in submission order
+        nw = max(1, min(self.workers, len(todo)))
+        chunksize = max(1, min(VERIFY_CHUNKSIZE, len(todo) // (nw * 4)))
+        with ThreadPool(nw) as pool:
+            results = pool.imap(verify_image_label, zip(todo, repeat(prefix)), chunksize=chunksize)
+            for i, ((im_file, lb_file), stamp, r) in enumerate(zip(files, file_stamps, reuse)):
+                if r:  # unchanged since the last scan
+                    l = prev[im_file][0]
+                    if stamp[1] is None:
+                        nm += 1  # label missing
                     else:
-                        ne += 1  # label empty
-                        l = np.zeros((0, 5), dtype=np.float32)
+                        nf += 1  # label found
+                        if not len(l):
+                            ne += 1  # label empty
+                    x[im_file] = prev[im_file]
+                    stamps[im_file] = stamp
+                    nr += 1
                 else:
-                    nm += 1  # label missing
-                    l = np.zeros((0, 5), dtype=np.float32)
-                x[im_file] = [l, shape, segments]
-            except Exception as e:
-                nc += 1
-                print(f'Dataset_{prefix}: WARNING: Ignoring corrupted image and/or label {im_file}: {e}')
-
-            if (i+1) % 5000 == 0:
-                dataset_info['current'] = i+1
-                dataset_info['found'] = nf
-                dataset_info['missing'] = nm
-                dataset_info['empty'] = ne
-                dataset_info['corrupted'] = nc
-
-                status_update(self.userid, self.project_id,
-                              update_id=f"{prefix}_dataset",
-                              update_content=dataset_info)
-
-                logger.info(f'Dataset_{prefix}: {nf} found, {nm} missing, {ne} empty, {nc} corrupted')
+                    _, l, shape, segments, nm_f, nf_f, ne_f, nc_f, msg = next(results)
+                    nm += nm_f
+                    nf += nf_f
+                    ne += ne_f
+                    nc += nc_f
+                    if msg:
+                        print(msg)
+                    if not nc_f:
+                        x[im_file] = [l, shape, segments]
+                        stamps[im_file] = stamp
+
+                if (i+1) % 5000 == 0:
+                    dataset_info['current'] = i+1
+                    dataset_info['found'] = nf
+                    dataset_info['missing'] = nm
+                    dataset_info['empty'] = ne
+                    dataset_info['corrupted'] = nc
+
+                    status_update(self.userid, self.project_id,
+                                  update_id=f"{prefix}_dataset",
+                                  update_content=dataset_info)
+
+                    logger.info(f'Dataset_{prefix}: {nf} found, {nm} missing, {ne} empty, {nc} corrupted')
 
         #     pbar.desc = f"{prefix}Scanning '{path.parent / path.stem}' images and labels... " \
         #                 f"{nf} found, {nm} missing, {ne} empty, {nc} corrupted"
@@ -564,9 +742,13 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
 
         x['hash'] = get_hash(self.label_files + self.img_files)
         x['results'] = nf, nm, ne, nc, i + 1
-        x['version'] = 0.1  # cache version
-        torch.save(x, path)  # save for next time
-        # logging.info(f'{prefix}New cache created: {path}')
+        x['version'] = LABEL_CACHE_VERSION  # cache version
+        x['stamps'] = stamps
+        try:
+            torch.save(x, path)  # save for next time
+            logger.info(f'Dataset_{prefix}: New cache created: {path} ({nr} of {i + 1} entries reused)')
+        except Exception as e:
+            logger.warning(f'Dataset_{prefix}: WARNING: Cache directory {path.parent} is not writeable: {e}')
 
         dataset_info['current'] = i+1
         dataset_info['found'] = nf
@@ -725,6 +907,8 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
 def load_image(self, index):
     # loads 1 image from dataset, returns img, original hw, resized hw
     img = self.imgs[index]
+    if img is None and getattr(self, 'img_store', None) is not None:  # packed, memory-mapped
+        return self.img_store.get(self.img_files[index])
     if img is None:  # not cached
         path = self.img_files[index]
         img = cv2.imread(path)  # BGR
@@ -529,6 +529,37 @@ def box_iou(box1, box2):
     return inter / (area1[:, None] + area2 - inter)  # iou = inter / (area1 + area2 - inter)
 
 
+def match_predictions(pbox, pcls, pimg, tbox, tcls, timg, iouv):
+    """
+    Greedy prediction-to-target matching of a whole batch, on device
+    A prediction is matched to its best IoU target of the same image and class
+    when that IoU is over iouv[0] and no earlier prediction (lower index, i.e.
+    higher confidence after NMS) took the target; it is then correct at every
+    threshold of iouv its IoU is over.
+    Arguments:
+        pbox (Tensor[N, 4]), pcls (Tensor[N]), pimg (Tensor[N]): predictions (x1, y1, x2, y2), class, image index
+        tbox (Tensor[M, 4]), tcls (Tensor[M]), timg (Tensor[M]): targets (x1, y1, x2, y2), class, image index
+        iouv (Tensor[niou]): IoU thresholds
+    Returns:
+        correct (Tensor[N, niou]): bool
+    """
+    n = pbox.shape[0]
+    correct = torch.zeros(n, iouv.numel(), dtype=torch.bool, device=iouv.device)
+    if n == 0 or tbox.shape[0] == 0:
+        return correct
+
+    iou = box_iou(pbox, tbox)
+    iou[(pimg[:, None] != timg[None]) | (pcls[:, None] != tcls[None])] = -1.  # other image or class
+    ious, i = iou.max(1)  # best ious, target indices
+    candidate = ious > iouv[0]
+    index = torch.arange(n, device=iou.device)
+    first = torch.full((tbox.shape[0],), n, dtype=torch.long, device=iou.device)
+    first.scatter_reduce_(0, i[candidate], index[candidate], reduce='amin')  # first prediction per target
+    matched = candidate & (first[i] == index)
+    correct[matched] = ious[matched, None] > iouv
+    return correct
+
+
 def wh_iou(wh1, wh2):
     # Returns the nxm IoU matrix. wh1 is nx2, wh2 is mx2
     wh1 = wh1[:, None]  # [N,1,2]
@@ -973,6 +1004,105 @@ def non_max_suppression_v9(
     return output
 
 
+def non_max_suppression_batched(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False,
+                                multi_label=False, labels=(), max_det=300, v9=False):
+    """
+    Runs Non-Maximum Suppression (NMS) on the inference results of a whole batch at once
+
+    Same filtering as non_max_suppression() (v7) / non_max_suppression_v9() (v9), but the candidates
+    of all images go through a single torchvision.ops.nms() call, offset by (image, class) so that
+    boxes of different images or classes never suppress each other. There is no python loop over
+    the images and no time limit, and the result stays on the device of prediction.
+
+    Args:
+        prediction: (bs, n, 5+nc) [xywh, obj, cls] (v7) or (bs, 4+nc, n) [xywh, cls] (v9)
+        labels: apriori labels per image [cls, xywh] for autolabelling
+        max_det: maximum number of detections per image
+        v9: prediction is in the v9 layout
+
+    Returns:
+         (bs, max_det, 6) tensor [xyxy, conf, cls], zero-padded after the detections of each image
+         (bs,) tensor, number of detections per image
+    """
+
+    if isinstance(prediction, (list, tuple)):  # YOLO model in validation model, output = (inference_out, loss_out)
+        prediction = prediction[0]  # select only inference output
+
+    # Settings
+    max_wh = 7680 if v9 else 4096  # (pixels) maximum box width and height
+    max_nms = 30000  # maximum number of boxes per image into torchvision.ops.nms()
+
+    if v9:
+        prediction = prediction.transpose(1, 2)  # (bs, 4+nc, n) to (bs, n, 4+nc)
+        scores = prediction[..., 4:]
+    else:
+        obj = prediction[..., 4:5]
+        scores = obj.expand_as(prediction[..., 5:]) if prediction.shape[2] == 6 else prediction[..., 5:] * obj
+    bs, _, nc = scores.shape
+    multi_label &= nc > 1  # multiple labels per box
+    device = prediction.device
+
+    # Candidates of the whole batch : image index, box index, class, conf
+    if multi_label:
+        b, a, c = (scores > conf_thres).nonzero(as_tuple=False).T
+        conf = scores[b, a, c]
+    else:  # best class only
+        conf, c = scores.max(2)
+        b, a = (conf > conf_thres).nonzero(as_tuple=False).T
+        conf, c = conf[b, a], c[b, a]
+    box = xywh2xyxy(prediction[b, a, :4])
+
+    # Cat apriori labels if autolabelling
+    if labels and any(len(lb) for lb in labels):
+        lb = torch.cat([l for l in labels if len(l)])
+        lb_img = torch.cat([torch.full((len(l),), i, device=device) for i, l in enumerate(labels) if len(l)])
+        b = torch.cat((b, lb_img.long()))
+        box = torch.cat((box, xywh2xyxy(lb[:, 1:5]).to(box.dtype)))
+        conf = torch.cat((conf, torch.ones(len(lb), device=device, dtype=conf.dtype)))
+        c = torch.cat((c, lb[:, 0].long()))
+
+    # Filter by class
+    if classes is not None:
+        i = (c[:, None] == torch.tensor(classes, device=device)).any(1)
+        b, box, conf, c = b[i], box[i], conf[i], c[i]
+
+    output = torch.zeros((bs, max_det, 6), device=device, dtype=prediction.dtype)
+    if not len(b):  # no boxes
+        return output, torch.zeros(bs, device=device, dtype=torch.long)
+
+    # Keep the max_nms most confident boxes of each image
+    i = _rank_per_image(b, conf, bs) < max_nms
+    if not i.all():
+        b, box, conf, c = b[i], box[i], conf[i], c[i]
+
+    # Batched NMS : one offset per (image, class), wide enough for any box
+    idx = b if agnostic else b * nc + c
+    offset = idx[:, None] * max_wh
+    if (idx.max() + 1) * max_wh > 2 ** 24:  # float32 loses pixel precision past 2^24
+        i = torchvision.ops.nms(box.double() + offset, conf.double(), iou_thres)
+    else:
+        i = torchvision.ops.nms(box.float() + offset, conf.float(), iou_thres)
+    b, box, conf, c = b[i], box[i], conf[i], c[i]
+
+    # Limit detections and pad
+    rank = _rank_per_image(b, conf, bs)
+    i = rank < max_det
+    b, rank = b[i], rank[i]
+    output[b, rank] = torch.cat((box[i], conf[i, None], c[i, None].to(box.dtype)), 1).to(output.dtype)
+    return output, torch.bincount(b, minlength=bs)
+
+
+def _rank_per_image(b, conf, bs):
+    # rank of each box by descending conf among the boxes of its image
+    order = conf.argsort(descending=True)
+    order = order[b[order].argsort(stable=True)]  # grouped by image, by descending conf within an image
+    counts = torch.bincount(b, minlength=bs)
+    start = counts.cumsum(0) - counts
+    rank = torch.empty_like(order)
+    rank[order] = torch.arange(len(order), device=b.device) - start[b[order]]
+    return rank
+
+
 def strip_optimizer(f='best.pt', s=''):  # from utils.general import *; strip_optimizer()
     # Strip optimizer from 'f' to finalize training, optionally save as 's'
     x = torch.load(f, map_location=torch.device('cpu'))
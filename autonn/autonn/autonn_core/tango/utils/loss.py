@@ -626,6 +626,142 @@ class ComputeLoss:
         return tcls, tbox, indices, anch
 
 
+OTA_CLS_CHUNK = 32  # classes per chunk of the class cost, bounds its temporary memory to (batch x candidates x chunk)
+
+
+def build_targets_ota(p, targets, imgs, indices, anch, decode, nc, iou_topk=10):
+    """
+    Batched SimOTA assignment shared by ComputeLossOTA, ComputeLossBinOTA and ComputeLossAuxOTA
+
+    Candidates (find_3_positive / find_5_positive) and targets are padded per
+    image, so the costs of the whole batch are computed in one pass and the
+    dynamic-k selection and conflict resolution run without host syncs.
+    The pairwise class cost sum_c BCE(x_c, onehot(k)_c) is computed as
+    sum_c BCE(x_c, 0) - BCE(x_k, 0) + BCE(x_k, 1), where the sum only depends on
+    the candidate; this avoids the (gts x candidates x nc) one-hot and
+    probability tensors.
+
+    Arguments:
+        p: predictions of every layer
+        targets: (image, class, x, y, w, h) normalized
+        imgs: images of the batch
+        indices, anch: candidates and their anchors from find_*_positive()
+        decode: (layer, predictions of the candidates, grid xy, anchors) -> (xyxy boxes in pixels, obj logit, cls logits)
+        nc: number of classes
+        iou_topk: number of best IoUs summed into the dynamic k of a target
+    Returns:
+        matching_bs, matching_as, matching_gjs, matching_gis, matching_targets, matching_anchs (lists of nl tensors)
+    """
+    device = targets.device
+    nl, bsz = len(p), p[0].shape[0]
+
+    # decode the candidates of every layer
+    cands = [[] for _ in range(9)]
+    for i, pi in enumerate(p):
+        b, a, gj, gi = indices[i]
+        fg_pred = pi[b, a, gj, gi]
+        grid = torch.stack([gi, gj], dim=1)
+        pxyxy, p_obj, p_cls = decode(i, fg_pred, grid, anch[i])
+        for c, x in zip(cands, (b, a, gj, gi, anch[i], torch.full_like(b, i), pxyxy, p_obj, p_cls)):
+            c.append(x)
+    if not len(targets) or not sum(len(b) for b in cands[0]):
+        empty = torch.tensor([], device=device, dtype=torch.int64)
+        return tuple([empty] * nl for _ in range(6))
+
+    # group candidates and targets by image, keeping their order within an image
+    b = torch.cat(cands[0], 0)
+    order = torch.sort(b, stable=True)[1]
+    b, a, gj, gi, all_anch, layer, pxyxy, p_obj, p_cls = [torch.cat(c, 0)[order] for c in cands]
+    targets = targets[torch.sort(targets[:, 0].long(), stable=True)[1]]
+    tb = targets[:, 0].long()
+
+    # pad to (images, max candidates) and (images, max targets)
+    n_c, n_t = torch.bincount(b, minlength=bsz), torch.bincount(tb, minlength=bsz)
+    c_start = n_c.cumsum(0) - n_c
+    A, G = int(n_c.max()), int(n_t.max())
+    c_pos = torch.arange(len(b), device=device) - c_start[b]
+    t_pos = torch.arange(len(tb), device=device) - (n_t.cumsum(0) - n_t)[tb]
+
+    valid_c = torch.zeros(bsz, A, dtype=torch.bool, device=device)
+    valid_c[b, c_pos] = True
+    valid_t = torch.zeros(bsz, G, dtype=torch.bool, device=device)
+    valid_t[tb, t_pos] = True
+    valid = valid_t[:, :, None] & valid_c[:, None, :]
+    t_index = torch.zeros(bsz, G, dtype=torch.long, device=device)
+    t_index[tb, t_pos] = torch.arange(len(tb), device=device)
+    tcls = torch.zeros(bsz, G, dtype=torch.long, device=device)
+    tcls[tb, t_pos] = targets[:, 1].long()
+
+    txyxy = xywh2xyxy(targets[:, 2:6] * imgs.shape[2])
+    tbox = txyxy.new_zeros(bsz, G, 4)
+    tbox[tb, t_pos] = txyxy
+    pbox = pxyxy.new_zeros(bsz, A, 4)
+    pbox[b, c_pos] = pxyxy
+
+    # IoU cost (same arithmetic as box_iou)
+    area_t = (tbox[..., 2] - tbox[..., 0]) * (tbox[..., 3] - tbox[..., 1])
+    area_p = (pbox[..., 2] - pbox[..., 0]) * (pbox[..., 3] - pbox[..., 1])
+    inter = (torch.min(tbox[:, :, None, 2:], pbox[:, None, :, 2:]) - torch.max(tbox[:, :, None, :2], pbox[:, None, :, :2])).clamp(0).prod(3)
+    pair_wise_iou = inter / (area_t[:, :, None] + area_p[:, None, :] - inter)
+    pair_wise_iou = torch.where(valid, pair_wise_iou, torch.zeros_like(pair_wise_iou))
+    pair_wise_iou_loss = -torch.log(pair_wise_iou + 1e-8)
+
+    top_k, _ = torch.topk(pair_wise_iou, min(iou_topk, A), dim=2)
+    dynamic_ks = torch.clamp(top_k.sum(2).int(), min=1)  # <= number of candidates of the image
+
+    # class cost: y = sqrt(sigmoid(cls) * sigmoid(obj)), x = logit(y)
+    obj = pxyxy.new_zeros(bsz, A, 1, dtype=torch.float)
+    obj[b, c_pos] = p_obj.float().sigmoid()
+    cls = p_cls.new_zeros(bsz, A, nc, dtype=torch.float)
+    cls[b, c_pos] = p_cls.float()
+
+    def logit(c):
+        # y in [eps, 1 - eps]: saturated probabilities give a large but finite cost, never inf or nan
+        eps = torch.finfo(torch.float).eps
+        y = (c.sigmoid() * obj).sqrt().clamp(eps, 1 - eps)
+        return torch.log(y / (1 - y))
+
+    neg = torch.zeros(bsz, A, device=device)  # sum_c BCE(x_c, 0)
+    for c0 in range(0, nc, OTA_CLS_CHUNK):
+        x = logit(cls[..., c0:c0 + OTA_CLS_CHUNK])
+        neg += F.binary_cross_entropy_with_logits(x, torch.zeros_like(x), reduction="none").sum(-1)
+    x = logit(cls.gather(2, tcls[:, None, :].expand(bsz, A, G))).transpose(1, 2)  # (images, targets, candidates)
+    pair_wise_cls_loss = (neg[:, None, :]
+                          - F.binary_cross_entropy_with_logits(x, torch.zeros_like(x), reduction="none")
+                          + F.binary_cross_entropy_with_logits(x, torch.ones_like(x), reduction="none"))
+    del cls, x
+
+    cost = pair_wise_cls_loss + 3.0 * pair_wise_iou_loss
+    cost = torch.where(valid, cost, torch.full_like(cost, float('inf')))
+
+    # dynamic k: the k lowest costs of every target
+    k = min(iou_topk, A)
+    _, pos_idx = torch.topk(cost, k, dim=2, largest=False)
+    take = (torch.arange(k, device=device)[None, None] < dynamic_ks[..., None]) & valid_t[..., None]
+    matching_matrix = torch.zeros_like(cost, dtype=torch.bool).scatter_(2, pos_idx, take)
+
+    # a candidate matched by several targets keeps the one with the lowest cost
+    multi = matching_matrix.sum(1) > 1
+    best = F.one_hot(cost.argmin(1), G).transpose(1, 2).bool()
+    matching_matrix = torch.where(multi[:, None, :], best, matching_matrix)
+    fg_mask_inboxes = matching_matrix.any(1) & valid_c
+    matched_gt_inds = matching_matrix.float().argmax(1)
+
+    fg_b, fg_pos = fg_mask_inboxes.nonzero(as_tuple=True)  # image-major, candidate order within an image
+    fg = c_start[fg_b] + fg_pos
+    matched_targets = targets[t_index[fg_b, matched_gt_inds[fg_b, fg_pos]]]
+    from_which_layer = layer[fg]
+
+    matching = tuple([] for _ in range(6))
+    for i in range(nl):
+        layer_idx = fg[from_which_layer == i]
+        for m, x in zip(matching, (b, a, gj, gi)):
+            m.append(x[layer_idx])
+        matching[4].append(matched_targets[from_which_layer == i])
+        matching[5].append(all_anch[layer_idx])
+    return matching
+
+
 class ComputeLossOTA:
     # Compute losses
     def __init__(self, model, autobalance=False):
@@ -715,155 +851,15 @@ class ComputeLossOTA:
         #indices, anch = self.find_4_positive(p, targets)
         #indices, anch = self.find_5_positive(p, targets)
         #indices, anch = self.find_9_positive(p, targets)
-        device = torch.device(targets.device)
-        matching_bs = [[] for pp in p]
-        matching_as = [[] for pp in p]
-        matching_gjs = [[] for pp in p]
-        matching_gis = [[] for pp in p]
-        matching_targets = [[] for pp in p]
-        matching_anchs = [[] for pp in p]
-        
-        nl = len(p)    
-    
-        for batch_idx in range(p[0].shape[0]):
-        
-            b_idx = targets[:, 0]==batch_idx
-            this_target = targets[b_idx]
-            if this_target.shape[0] == 0:
-                continue
-                
-            txywh = this_target[:, 2:6] * imgs[batch_idx].shape[1]
-            txyxy = xywh2xyxy(txywh)
-
-            pxyxys = []
-            p_cls = []
-            p_obj = []
-            from_which_layer = []
-            all_b = []
-            all_a = []
-            all_gj = []
-            all_gi = []
-            all_anch = []
-            
-            for i, pi in enumerate(p):
-                
-                b, a, gj, gi = indices[i]
-                idx = (b == batch_idx)
-                b, a, gj, gi = b[idx], a[idx], gj[idx], gi[idx]                
-                all_b.append(b)
-                all_a.append(a)
-                all_gj.append(gj)
-                all_gi.append(gi)
-                all_anch.append(anch[i][idx])
-                from_which_layer.append((torch.ones(size=(len(b),)) * i).to(device))
-                
-                fg_pred = pi[b, a, gj, gi]                
-                p_obj.append(fg_pred[:, 4:5])
-                p_cls.append(fg_pred[:, 5:])
-                
-                grid = torch.stack([gi, gj], dim=1)
-                pxy = (fg_pred[:, :2].sigmoid() * 2. - 0.5 + grid) * self.stride[i] #/ 8.
-                #pxy = (fg_pred[:, :2].sigmoid() * 3. - 1. + grid) * self.stride[i]
-                pwh = (fg_pred[:, 2:4].sigmoid() * 2) ** 2 * anch[i][idx] * self.stride[i] #/ 8.
-                pxywh = torch.cat([pxy, pwh], dim=-1)
-                pxyxy = xywh2xyxy(pxywh)
-                pxyxys.append(pxyxy)
-            
-            pxyxys = torch.cat(pxyxys, dim=0)
-            if pxyxys.shape[0] == 0:
-                continue
-            p_obj = torch.cat(p_obj, dim=0)
-            p_cls = torch.cat(p_cls, dim=0)
-            from_which_layer = torch.cat(from_which_layer, dim=0)
-            all_b = torch.cat(all_b, dim=0)
-            all_a = torch.cat(all_a, dim=0)
-            all_gj = torch.cat(all_gj, dim=0)
-            all_gi = torch.cat(all_gi, dim=0)
-            all_anch = torch.cat(all_anch, dim=0)
-        
-            pair_wise_iou = box_iou(txyxy, pxyxys)
-
-            pair_wise_iou_loss = -torch.log(pair_wise_iou + 1e-8)
-
-            top_k, _ = torch.topk(pair_wise_iou, min(10, pair_wise_iou.shape[1]), dim=1)
-            dynamic_ks = torch.clamp(top_k.sum(1).int(), min=1)
-
-            gt_cls_per_image = (
-                F.one_hot(this_target[:, 1].to(torch.int64), self.nc)
-                .float()
-                .unsqueeze(1)
-                .repeat(1, pxyxys.shape[0], 1)
-            )
-
-            num_gt = this_target.shape[0]
-            cls_preds_ = (
-                p_cls.float().unsqueeze(0).repeat(num_gt, 1, 1).sigmoid_()
-                * p_obj.unsqueeze(0).repeat(num_gt, 1, 1).sigmoid_()
-            )
-
-            y = cls_preds_.sqrt_()
-            pair_wise_cls_loss = F.binary_cross_entropy_with_logits(
-               torch.log(y/(1-y)) , gt_cls_per_image, reduction="none"
-            ).sum(-1)
-            del cls_preds_
-        
-            cost = (
-                pair_wise_cls_loss
-                + 3.0 * pair_wise_iou_loss
-            )
-
-            matching_matrix = torch.zeros_like(cost, device=device)
-
-            for gt_idx in range(num_gt):
-                _, pos_idx = torch.topk(
-                    cost[gt_idx], k=dynamic_ks[gt_idx].item(), largest=False
-                )
-                matching_matrix[gt_idx][pos_idx] = 1.0
-
-            del top_k, dynamic_ks
-            anchor_matching_gt = matching_matrix.sum(0)
-            if (anchor_matching_gt > 1).sum() > 0:
-                _, cost_argmin = torch.min(cost[:, anchor_matching_gt > 1], dim=0)
-                matching_matrix[:, anchor_matching_gt > 1] *= 0.0
-                matching_matrix[cost_argmin, anchor_matching_gt > 1] = 1.0
-            fg_mask_inboxes = (matching_matrix.sum(0) > 0.0).to(device)
-            matched_gt_inds = matching_matrix[:, fg_mask_inboxes].argmax(0)
-        
-            from_which_layer = from_which_layer[fg_mask_inboxes]
-            all_b = all_b[fg_mask_inboxes]
-            all_a = all_a[fg_mask_inboxes]
-            all_gj = all_gj[fg_mask_inboxes]
-            all_gi = all_gi[fg_mask_inboxes]
-            all_anch = all_anch[fg_mask_inboxes]
-        
-            this_target = this_target[matched_gt_inds]
-        
-            for i in range(nl):
-                layer_idx = from_which_layer == i
-                matching_bs[i].append(all_b[layer_idx])
-                matching_as[i].append(all_a[layer_idx])
-                matching_gjs[i].append(all_gj[layer_idx])
-                matching_gis[i].append(all_gi[layer_idx])
-                matching_targets[i].append(this_target[layer_idx])
-                matching_anchs[i].append(all_anch[layer_idx])
-
-        for i in range(nl):
-            if matching_targets[i] != []:
-                matching_bs[i] = torch.cat(matching_bs[i], dim=0)
-                matching_as[i] = torch.cat(matching_as[i], dim=0)
-                matching_gjs[i] = torch.cat(matching_gjs[i], dim=0)
-                matching_gis[i] = torch.cat(matching_gis[i], dim=0)
-                matching_targets[i] = torch.cat(matching_targets[i], dim=0)
-                matching_anchs[i] = torch.cat(matching_anchs[i], dim=0)
-            else:
-                matching_bs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_as[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_gjs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_gis[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_targets[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_anchs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
+        return build_targets_ota(p, targets, imgs, indices, anch, self.decode_ota, self.nc, iou_topk=10)
 
-        return matching_bs, matching_as, matching_gjs, matching_gis, matching_targets, matching_anchs           
+    def decode_ota(self, i, fg_pred, grid, anch):
+        # candidate predictions -> xyxy boxes (pixels), obj logit, cls logits
+        pxy = (fg_pred[:, :2].sigmoid() * 2. - 0.5 + grid) * self.stride[i] #/ 8.
+        #pxy = (fg_pred[:, :2].sigmoid() * 3. - 1. + grid) * self.stride[i]
+        pwh = (fg_pred[:, 2:4].sigmoid() * 2) ** 2 * anch * self.stride[i] #/ 8.
+        pxywh = torch.cat([pxy, pwh], dim=-1)
+        return xywh2xyxy(pxywh), fg_pred[:, 4:5], fg_pred[:, 5:]
 
     def find_3_positive(self, p, targets):
         # Build targets for compute_loss(), input targets(image,class,x,y,w,h)
@@ -1033,164 +1029,18 @@ class ComputeLossBinOTA:
 
     def build_targets(self, p, targets, imgs):
         
-        #indices, anch = self.find_positive(p, targets)
         indices, anch = self.find_3_positive(p, targets)
-        #indices, anch = self.find_4_positive(p, targets)
-        #indices, anch = self.find_5_positive(p, targets)
-        #indices, anch = self.find_9_positive(p, targets)
-
-        matching_bs = [[] for pp in p]
-        matching_as = [[] for pp in p]
-        matching_gjs = [[] for pp in p]
-        matching_gis = [[] for pp in p]
-        matching_targets = [[] for pp in p]
-        matching_anchs = [[] for pp in p]
-        
-        nl = len(p)    
-    
-        for batch_idx in range(p[0].shape[0]):
-        
-            b_idx = targets[:, 0]==batch_idx
-            this_target = targets[b_idx]
-            if this_target.shape[0] == 0:
-                continue
-                
-            txywh = this_target[:, 2:6] * imgs[batch_idx].shape[1]
-            txyxy = xywh2xyxy(txywh)
-
-            pxyxys = []
-            p_cls = []
-            p_obj = []
-            from_which_layer = []
-            all_b = []
-            all_a = []
-            all_gj = []
-            all_gi = []
-            all_anch = []
-            
-            for i, pi in enumerate(p):
-                
-                obj_idx = self.wh_bin_sigmoid.get_length()*2 + 2
-                
-                b, a, gj, gi = indices[i]
-                idx = (b == batch_idx)
-                b, a, gj, gi = b[idx], a[idx], gj[idx], gi[idx]                
-                all_b.append(b)
-                all_a.append(a)
-                all_gj.append(gj)
-                all_gi.append(gi)
-                all_anch.append(anch[i][idx])
-                from_which_layer.append(torch.ones(size=(len(b),)) * i)
-                
-                fg_pred = pi[b, a, gj, gi]                
-                p_obj.append(fg_pred[:, obj_idx:(obj_idx+1)])
-                p_cls.append(fg_pred[:, (obj_idx+1):])
-                
-                grid = torch.stack([gi, gj], dim=1)
-                pxy = (fg_pred[:, :2].sigmoid() * 2. - 0.5 + grid) * self.stride[i] #/ 8.
-                #pwh = (fg_pred[:, 2:4].sigmoid() * 2) ** 2 * anch[i][idx] * self.stride[i] #/ 8.
-                pw = self.wh_bin_sigmoid.forward(fg_pred[..., 2:(3+self.bin_count)].sigmoid()) * anch[i][idx][:, 0] * self.stride[i]
-                ph = self.wh_bin_sigmoid.forward(fg_pred[..., (3+self.bin_count):obj_idx].sigmoid()) * anch[i][idx][:, 1] * self.stride[i]
-                
-                pxywh = torch.cat([pxy, pw.unsqueeze(1), ph.unsqueeze(1)], dim=-1)
-                pxyxy = xywh2xyxy(pxywh)
-                pxyxys.append(pxyxy)
-            
-            pxyxys = torch.cat(pxyxys, dim=0)
-            if pxyxys.shape[0] == 0:
-                continue
-            p_obj = torch.cat(p_obj, dim=0)
-            p_cls = torch.cat(p_cls, dim=0)
-            from_which_layer = torch.cat(from_which_layer, dim=0)
-            all_b = torch.cat(all_b, dim=0)
-            all_a = torch.cat(all_a, dim=0)
-            all_gj = torch.cat(all_gj, dim=0)
-            all_gi = torch.cat(all_gi, dim=0)
-            all_anch = torch.cat(all_anch, dim=0)
-        
-            pair_wise_iou = box_iou(txyxy, pxyxys)
-
-            pair_wise_iou_loss = -torch.log(pair_wise_iou + 1e-8)
-
-            top_k, _ = torch.topk(pair_wise_iou, min(10, pair_wise_iou.shape[1]), dim=1)
-            dynamic_ks = torch.clamp(top_k.sum(1).int(), min=1)
-
-            gt_cls_per_image = (
-                F.one_hot(this_target[:, 1].to(torch.int64), self.nc)
-                .float()
-                .unsqueeze(1)
-                .repeat(1, pxyxys.shape[0], 1)
-            )
-
-            num_gt = this_target.shape[0]            
-            cls_preds_ = (
-                p_cls.float().unsqueeze(0).repeat(num_gt, 1, 1).sigmoid_()
-                * p_obj.unsqueeze(0).repeat(num_gt, 1, 1).sigmoid_()
-            )
-
-            y = cls_preds_.sqrt_()
-            pair_wise_cls_loss = F.binary_cross_entropy_with_logits(
-               torch.log(y/(1-y)) , gt_cls_per_image, reduction="none"
-            ).sum(-1)
-            del cls_preds_
-        
-            cost = (
-                pair_wise_cls_loss
-                + 3.0 * pair_wise_iou_loss
-            )
-
-            matching_matrix = torch.zeros_like(cost)
-
-            for gt_idx in range(num_gt):
-                _, pos_idx = torch.topk(
-                    cost[gt_idx], k=dynamic_ks[gt_idx].item(), largest=False
-                )
-                matching_matrix[gt_idx][pos_idx] = 1.0
-
-            del top_k, dynamic_ks
-            anchor_matching_gt = matching_matrix.sum(0)
-            if (anchor_matching_gt > 1).sum() > 0:
-                _, cost_argmin = torch.min(cost[:, anchor_matching_gt > 1], dim=0)
-                matching_matrix[:, anchor_matching_gt > 1] *= 0.0
-                matching_matrix[cost_argmin, anchor_matching_gt > 1] = 1.0
-            fg_mask_inboxes = matching_matrix.sum(0) > 0.0
-            matched_gt_inds = matching_matrix[:, fg_mask_inboxes].argmax(0)
-        
-            from_which_layer = from_which_layer[fg_mask_inboxes]
-            all_b = all_b[fg_mask_inboxes]
-            all_a = all_a[fg_mask_inboxes]
-            all_gj = all_gj[fg_mask_inboxes]
-            all_gi = all_gi[fg_mask_inboxes]
-            all_anch = all_anch[fg_mask_inboxes]
-        
-            this_target = this_target[matched_gt_inds]
-        
-            for i in range(nl):
-                layer_idx = from_which_layer == i
-                matching_bs[i].append(all_b[layer_idx])
-                matching_as[i].append(all_a[layer_idx])
-                matching_gjs[i].append(all_gj[layer_idx])
-                matching_gis[i].append(all_gi[layer_idx])
-                matching_targets[i].append(this_target[layer_idx])
-                matching_anchs[i].append(all_anch[layer_idx])
-
-        for i in range(nl):
-            if matching_targets[i] != []:
-                matching_bs[i] = torch.cat(matching_bs[i], dim=0)
-                matching_as[i] = torch.cat(matching_as[i], dim=0)
-                matching_gjs[i] = torch.cat(matching_gjs[i], dim=0)
-                matching_gis[i] = torch.cat(matching_gis[i], dim=0)
-                matching_targets[i] = torch.cat(matching_targets[i], dim=0)
-                matching_anchs[i] = torch.cat(matching_anchs[i], dim=0)
-            else:
-                matching_bs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_as[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_gjs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_gis[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_targets[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_anchs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-
-        return matching_bs, matching_as, matching_gjs, matching_gis, matching_targets, matching_anchs       
+        return build_targets_ota(p, targets, imgs, indices, anch, self.decode_ota, self.nc, iou_topk=10)
+
+    def decode_ota(self, i, fg_pred, grid, anch):
+        # candidate predictions -> xyxy boxes (pixels), obj logit, cls logits
+        obj_idx = self.wh_bin_sigmoid.get_length()*2 + 2
+        pxy = (fg_pred[:, :2].sigmoid() * 2. - 0.5 + grid) * self.stride[i] #/ 8.
+        #pwh = (fg_pred[:, 2:4].sigmoid() * 2) ** 2 * anch * self.stride[i] #/ 8.
+        pw = self.wh_bin_sigmoid.forward(fg_pred[..., 2:(3+self.bin_count)].sigmoid()) * anch[:, 0] * self.stride[i]
+        ph = self.wh_bin_sigmoid.forward(fg_pred[..., (3+self.bin_count):obj_idx].sigmoid()) * anch[:, 1] * self.stride[i]
+        pxywh = torch.cat([pxy, pw.unsqueeze(1), ph.unsqueeze(1)], dim=-1)
+        return xywh2xyxy(pxywh), fg_pred[:, obj_idx:(obj_idx+1)], fg_pred[:, (obj_idx+1):]
 
     def find_3_positive(self, p, targets):
         # Build targets for compute_loss(), input targets(image,class,x,y,w,h)
@@ -1360,308 +1210,20 @@ class ComputeLossAuxOTA:
     def build_targets(self, p, targets, imgs):
         
         indices, anch = self.find_3_positive(p, targets)
+        return build_targets_ota(p, targets, imgs, indices, anch, self.decode_ota, self.nc, iou_topk=20)
 
-        matching_bs = [[] for pp in p]
-        matching_as = [[] for pp in p]
-        matching_gjs = [[] for pp in p]
-        matching_gis = [[] for pp in p]
-        matching_targets = [[] for pp in p]
-        matching_anchs = [[] for pp in p]
-        
-        nl = len(p)    
-    
-        for batch_idx in range(p[0].shape[0]):
-        
-            b_idx = targets[:, 0]==batch_idx
-            this_target = targets[b_idx]
-            if this_target.shape[0] == 0:
-                continue
-                
-            txywh = this_target[:, 2:6] * imgs[batch_idx].shape[1]
-            txyxy = xywh2xyxy(txywh)
-
-            pxyxys = []
-            p_cls = []
-            p_obj = []
-            from_which_layer = []
-            all_b = []
-            all_a = []
-            all_gj = []
-            all_gi = []
-            all_anch = []
-            
-            for i, pi in enumerate(p):
-                
-                b, a, gj, gi = indices[i]
-                idx = (b == batch_idx)
-                b, a, gj, gi = b[idx], a[idx], gj[idx], gi[idx]                
-                all_b.append(b)
-                all_a.append(a)
-                all_gj.append(gj)
-                all_gi.append(gi)
-                all_anch.append(anch[i][idx])
-                from_which_layer.append(torch.ones(size=(len(b),)) * i)
-                
-                fg_pred = pi[b, a, gj, gi]                
-                p_obj.append(fg_pred[:, 4:5])
-                p_cls.append(fg_pred[:, 5:])
-                
-                grid = torch.stack([gi, gj], dim=1)
-                pxy = (fg_pred[:, :2].sigmoid() * 2. - 0.5 + grid) * self.stride[i] #/ 8.
-                #pxy = (fg_pred[:, :2].sigmoid() * 3. - 1. + grid) * self.stride[i]
-                pwh = (fg_pred[:, 2:4].sigmoid() * 2) ** 2 * anch[i][idx] * self.stride[i] #/ 8.
-                pxywh = torch.cat([pxy, pwh], dim=-1)
-                pxyxy = xywh2xyxy(pxywh)
-                pxyxys.append(pxyxy)
-            
-            pxyxys = torch.cat(pxyxys, dim=0)
-            if pxyxys.shape[0] == 0:
-                continue
-            p_obj = torch.cat(p_obj, dim=0)
-            p_cls = torch.cat(p_cls, dim=0)
-            from_which_layer = torch.cat(from_which_layer, dim=0)
-            all_b = torch.cat(all_b, dim=0)
-            all_a = torch.cat(all_a, dim=0)
-            all_gj = torch.cat(all_gj, dim=0)
-            all_gi = torch.cat(all_gi, dim=0)
-            all_anch = torch.cat(all_anch, dim=0)
-        
-            pair_wise_iou = box_iou(txyxy, pxyxys)
-
-            pair_wise_iou_loss = -torch.log(pair_wise_iou + 1e-8)
-
-            top_k, _ = torch.topk(pair_wise_iou, min(20, pair_wise_iou.shape[1]), dim=1)
-            dynamic_ks = torch.clamp(top_k.sum(1).int(), min=1)
-
-            gt_cls_per_image = (
-                F.one_hot(this_target[:, 1].to(torch.int64), self.nc)
-                .float()
-                .unsqueeze(1)
-                .repeat(1, pxyxys.shape[0], 1)
-            )
-
-            num_gt = this_target.shape[0]
-            cls_preds_ = (
-                p_cls.float().unsqueeze(0).repeat(num_gt, 1, 1).sigmoid_()
-                * p_obj.unsqueeze(0).repeat(num_gt, 1, 1).sigmoid_()
-            )
-
-            y = cls_preds_.sqrt_()
-            pair_wise_cls_loss = F.binary_cross_entropy_with_logits(
-               torch.log(y/(1-y)) , gt_cls_per_image, reduction="none"
-            ).sum(-1)
-            del cls_preds_
-        
-            cost = (
-                pair_wise_cls_loss
-                + 3.0 * pair_wise_iou_loss
-            )
-
-            matching_matrix = torch.zeros_like(cost, device='cpu')
-
-            for gt_idx in range(num_gt):
-                _, pos_idx = torch.topk(
-                    cost[gt_idx], k=dynamic_ks[gt_idx].item(), largest=False
-                )
-                matching_matrix[gt_idx][pos_idx] = 1.0
-
-            del top_k, dynamic_ks
-            anchor_matching_gt = matching_matrix.sum(0)
-            if (anchor_matching_gt > 1).sum() > 0:
-                _, cost_argmin = torch.min(cost[:, anchor_matching_gt > 1], dim=0)
-                matching_matrix[:, anchor_matching_gt > 1] *= 0.0
-                matching_matrix[cost_argmin, anchor_matching_gt > 1] = 1.0
-            fg_mask_inboxes = matching_matrix.sum(0) > 0.0
-            matched_gt_inds = matching_matrix[:, fg_mask_inboxes].argmax(0)
-        
-            from_which_layer = from_which_layer[fg_mask_inboxes]
-            all_b = all_b[fg_mask_inboxes]
-            all_a = all_a[fg_mask_inboxes]
-            all_gj = all_gj[fg_mask_inboxes]
-            all_gi = all_gi[fg_mask_inboxes]
-            all_anch = all_anch[fg_mask_inboxes]
-        
-            this_target = this_target[matched_gt_inds]
-        
-            for i in range(nl):
-                layer_idx = from_which_layer == i
-                matching_bs[i].append(all_b[layer_idx])
-                matching_as[i].append(all_a[layer_idx])
-                matching_gjs[i].append(all_gj[layer_idx])
-                matching_gis[i].append(all_gi[layer_idx])
-                matching_targets[i].append(this_target[layer_idx])
-                matching_anchs[i].append(all_anch[layer_idx])
-
-        for i in range(nl):
-            if matching_targets[i] != []:
-                matching_bs[i] = torch.cat(matching_bs[i], dim=0)
-                matching_as[i] = torch.cat(matching_as[i], dim=0)
-                matching_gjs[i] = torch.cat(matching_gjs[i], dim=0)
-                matching_gis[i] = torch.cat(matching_gis[i], dim=0)
-                matching_targets[i] = torch.cat(matching_targets[i], dim=0)
-                matching_anchs[i] = torch.cat(matching_anchs[i], dim=0)
-            else:
-                matching_bs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_as[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_gjs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_gis[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_targets[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_anchs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-
-        return matching_bs, matching_as, matching_gjs, matching_gis, matching_targets, matching_anchs
+    def decode_ota(self, i, fg_pred, grid, anch):
+        # candidate predictions -> xyxy boxes (pixels), obj logit, cls logits
+        pxy = (fg_pred[:, :2].sigmoid() * 2. - 0.5 + grid) * self.stride[i] #/ 8.
+        #pxy = (fg_pred[:, :2].sigmoid() * 3. - 1. + grid) * self.stride[i]
+        pwh = (fg_pred[:, 2:4].sigmoid() * 2) ** 2 * anch * self.stride[i] #/ 8.
+        pxywh = torch.cat([pxy, pwh], dim=-1)
+        return xywh2xyxy(pxywh), fg_pred[:, 4:5], fg_pred[:, 5:]
 
     def build_targets2(self, p, targets, imgs):
         
         indices, anch = self.find_5_positive(p, targets)
-
-        matching_bs = [[] for pp in p]
-        matching_as = [[] for pp in p]
-        matching_gjs = [[] for pp in p]
-        matching_gis = [[] for pp in p]
-        matching_targets = [[] for pp in p]
-        matching_anchs = [[] for pp in p]
-        
-        nl = len(p)    
-    
-        for batch_idx in range(p[0].shape[0]):
-        
-            b_idx = targets[:, 0]==batch_idx
-            this_target = targets[b_idx]
-            if this_target.shape[0] == 0:
-                continue
-                
-            txywh = this_target[:, 2:6] * imgs[batch_idx].shape[1]
-            txyxy = xywh2xyxy(txywh)
-
-            pxyxys = []
-            p_cls = []
-            p_obj = []
-            from_which_layer = []
-            all_b = []
-            all_a = []
-            all_gj = []
-            all_gi = []
-            all_anch = []
-            
-            for i, pi in enumerate(p):
-                
-                b, a, gj, gi = indices[i]
-                idx = (b == batch_idx)
-                b, a, gj, gi = b[idx], a[idx], gj[idx], gi[idx]                
-                all_b.append(b)
-                all_a.append(a)
-                all_gj.append(gj)
-                all_gi.append(gi)
-                all_anch.append(anch[i][idx])
-                from_which_layer.append(torch.ones(size=(len(b),)) * i)
-                
-                fg_pred = pi[b, a, gj, gi]                
-                p_obj.append(fg_pred[:, 4:5])
-                p_cls.append(fg_pred[:, 5:])
-                
-                grid = torch.stack([gi, gj], dim=1)
-                pxy = (fg_pred[:, :2].sigmoid() * 2. - 0.5 + grid) * self.stride[i] #/ 8.
-                #pxy = (fg_pred[:, :2].sigmoid() * 3. - 1. + grid) * self.stride[i]
-                pwh = (fg_pred[:, 2:4].sigmoid() * 2) ** 2 * anch[i][idx] * self.stride[i] #/ 8.
-                pxywh = torch.cat([pxy, pwh], dim=-1)
-                pxyxy = xywh2xyxy(pxywh)
-                pxyxys.append(pxyxy)
-            
-            pxyxys = torch.cat(pxyxys, dim=0)
-            if pxyxys.shape[0] == 0:
-                continue
-            p_obj = torch.cat(p_obj, dim=0)
-            p_cls = torch.cat(p_cls, dim=0)
-            from_which_layer = torch.cat(from_which_layer, dim=0)
-            all_b = torch.cat(all_b, dim=0)
-            all_a = torch.cat(all_a, dim=0)
-            all_gj = torch.cat(all_gj, dim=0)
-            all_gi = torch.cat(all_gi, dim=0)
-            all_anch = torch.cat(all_anch, dim=0)
-        
-            pair_wise_iou = box_iou(txyxy, pxyxys)
-
-            pair_wise_iou_loss = -torch.log(pair_wise_iou + 1e-8)
-
-            top_k, _ = torch.topk(pair_wise_iou, min(20, pair_wise_iou.shape[1]), dim=1)
-            dynamic_ks = torch.clamp(top_k.sum(1).int(), min=1)
-
-            gt_cls_per_image = (
-                F.one_hot(this_target[:, 1].to(torch.int64), self.nc)
-                .float()
-                .unsqueeze(1)
-                .repeat(1, pxyxys.shape[0], 1)
-            )
-
-            num_gt = this_target.shape[0]
-            cls_preds_ = (
-                p_cls.float().unsqueeze(0).repeat(num_gt, 1, 1).sigmoid_()
-                * p_obj.unsqueeze(0).repeat(num_gt, 1, 1).sigmoid_()
-            )
-
-            y = cls_preds_.sqrt_()
-            pair_wise_cls_loss = F.binary_cross_entropy_with_logits(
-               torch.log(y/(1-y)) , gt_cls_per_image, reduction="none"
-            ).sum(-1)
-            del cls_preds_
-        
-            cost = (
-                pair_wise_cls_loss
-                + 3.0 * pair_wise_iou_loss
-            )
-
-            matching_matrix = torch.zeros_like(cost, device='cpu')
-
-            for gt_idx in range(num_gt):
-                _, pos_idx = torch.topk(
-                    cost[gt_idx], k=dynamic_ks[gt_idx].item(), largest=False
-                )
-                matching_matrix[gt_idx][pos_idx] = 1.0
-
-            del top_k, dynamic_ks
-            anchor_matching_gt = matching_matrix.sum(0)
-            if (anchor_matching_gt > 1).sum() > 0:
-                _, cost_argmin = torch.min(cost[:, anchor_matching_gt > 1], dim=0)
-                matching_matrix[:, anchor_matching_gt > 1] *= 0.0
-                matching_matrix[cost_argmin, anchor_matching_gt > 1] = 1.0
-            fg_mask_inboxes = matching_matrix.sum(0) > 0.0
-            matched_gt_inds = matching_matrix[:, fg_mask_inboxes].argmax(0)
-        
-            from_which_layer = from_which_layer[fg_mask_inboxes]
-            all_b = all_b[fg_mask_inboxes]
-            all_a = all_a[fg_mask_inboxes]
-            all_gj = all_gj[fg_mask_inboxes]
-            all_gi = all_gi[fg_mask_inboxes]
-            all_anch = all_anch[fg_mask_inboxes]
-        
-            this_target = this_target[matched_gt_inds]
-        
-            for i in range(nl):
-                layer_idx = from_which_layer == i
-                matching_bs[i].append(all_b[layer_idx])
-                matching_as[i].append(all_a[layer_idx])
-                matching_gjs[i].append(all_gj[layer_idx])
-                matching_gis[i].append(all_gi[layer_idx])
-                matching_targets[i].append(this_target[layer_idx])
-                matching_anchs[i].append(all_anch[layer_idx])
-
-        for i in range(nl):
-            if matching_targets[i] != []:
-                matching_bs[i] = torch.cat(matching_bs[i], dim=0)
-                matching_as[i] = torch.cat(matching_as[i], dim=0)
-                matching_gjs[i] = torch.cat(matching_gjs[i], dim=0)
-                matching_gis[i] = torch.cat(matching_gis[i], dim=0)
-                matching_targets[i] = torch.cat(matching_targets[i], dim=0)
-                matching_anchs[i] = torch.cat(matching_anchs[i], dim=0)
-            else:
-                matching_bs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_as[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_gjs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_gis[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_targets[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-                matching_anchs[i] = torch.tensor([], device='cuda:0', dtype=torch.int64)
-
-        return matching_bs, matching_as, matching_gjs, matching_gis, matching_targets, matching_anchs              
+        return build_targets_ota(p, targets, imgs, indices, anch, self.decode_ota, self.nc, iou_topk=20)
 
     def find_5_positive(self, p, targets):
         # Build targets for compute_loss(), input targets(image,class,x,y,w,h)
@@ -62,23 +62,7 @@ def ap_per_class(tp, conf, pred_cls, target_cls, metric='v5', plot=False, save_d
         if n_p == 0 or n_l == 0:
             continue
         else:
-            # Accumulate FPs and TPs
-            fpc = (1 - tp[i]).cumsum(0)
-            tpc = tp[i].cumsum(0)
-
-            # Recall
-            recall = tpc / (n_l + 1e-16)  # recall curve
-            r[ci] = np.interp(-px, -conf[i], recall[:, 0], left=0)  # negative x, xp because xp decreases
-
-            # Precision
-            precision = tpc / (tpc + fpc)  # precision curve
-            p[ci] = np.interp(-px, -conf[i], precision[:, 0], left=1)  # p at pr_score
-
-            # AP from recall-precision curve
-            for j in range(tp.shape[1]):
-                ap[ci, j], mpre, mrec = compute_ap(recall[:, j], precision[:, j], metric=metric)
-                if plot and j == 0:
-                    py.append(np.interp(px, mrec, mpre))  # precision at mAP@0.5
+            _pr_per_class(tp[i], conf[i], n_l, px, ap[ci], p[ci], r[ci], py if plot else None, metric)
 
     # Compute F1 (harmonic mean of precision and recall)
     f1 = 2 * p * r / (p + r + 1e-16)
@@ -93,6 +77,108 @@ def ap_per_class(tp, conf, pred_cls, target_cls, metric='v5', plot=False, save_d
     return p[:, i], r[:, i], ap, f1[:, i], unique_classes.astype('int32')
 
 
+def _pr_per_class(tp, conf, n_l, px, ap, p, r, py=None, metric='v5'):
+    # P/R curves and APs of one class, tp and conf sorted by decreasing confidence
+    # results are written into the ap, p, r rows
+    # Accumulate FPs and TPs
+    fpc = (1 - tp).cumsum(0)
+    tpc = tp.cumsum(0)
+
+    # Recall
+    recall = tpc / (n_l + 1e-16)  # recall curve
+    r[:] = np.interp(-px, -conf, recall[:, 0], left=0)  # negative x, xp because xp decreases
+
+    # Precision
+    precision = tpc / (tpc + fpc)  # precision curve
+    p[:] = np.interp(-px, -conf, precision[:, 0], left=1)  # p at pr_score
+
+    # AP from recall-precision curve
+    for j in range(tp.shape[1]):
+        ap[j], mpre, mrec = compute_ap(recall[:, j], precision[:, j], metric=metric)
+        if py is not None and j == 0:
+            py.append(np.interp(px, mrec, mpre))  # precision at mAP@0.5
+
+
+class APAccumulator:
+    """ Incremental ap_per_class() for running validation metrics
+    update() costs O(batch): it adds the batch to running per-class TP and prediction
+    counts over CONF_BINS confidence bins. snapshot() turns the cumulative counts into
+    P/R curves and mAP in O(classes x bins), however many batches were seen, so the
+    running numbers are those of ap_per_class() with the confidences quantized to the
+    bins. stats() returns the concatenated statistics for the final ap_per_class(),
+    so the final numbers are exactly those of ap_per_class().
+    """
+    CONF_BINS = 1000
+
+    def __init__(self, niou, metric='v5'):
+        self.niou = niou
+        self.metric = metric
+        self.chunks = []        # (tp, conf, pred_cls, target_cls) per image, for stats()
+        self.tp = np.zeros((0, self.CONF_BINS, niou))   # class, conf bin, iou: true positives
+        self.n_pred = np.zeros((0, self.CONF_BINS))     # class, conf bin: predictions
+        self.n_labels = np.zeros(0, dtype=np.int64)     # labels per class
+
+    def _grow(self, nc):
+        if nc > len(self.n_labels):
+            k = nc - len(self.n_labels)
+            self.n_labels = np.pad(self.n_labels, (0, k))
+            self.tp = np.pad(self.tp, ((0, k), (0, 0), (0, 0)))
+            self.n_pred = np.pad(self.n_pred, ((0, k), (0, 0)))
+
+    def update(self, tp, conf, pred_cls, target_cls):
+        # Statistics of one image (correct, conf, pcls, tcls), as appended to 'stats' in test()
+        tp, conf, pred_cls = [x.numpy() if isinstance(x, torch.Tensor) else np.asarray(x) for x in (tp, conf, pred_cls)]
+        target_cls = np.asarray(target_cls)
+        self.chunks.append((tp, conf, pred_cls, target_cls))
+        if len(target_cls):
+            n = np.bincount(target_cls.astype(np.int64))
+            self._grow(len(n))
+            self.n_labels[:len(n)] += n
+        if len(conf):
+            c = pred_cls.astype(np.int64)
+            self._grow(int(c.max()) + 1)
+            b = np.clip((conf * self.CONF_BINS).astype(np.int64), 0, self.CONF_BINS - 1)
+            np.add.at(self.tp, (c, b), tp.astype(np.float64))
+            np.add.at(self.n_pred, (c, b), 1)
+
+    def snapshot(self):
+        """ Running metrics over all updates so far
+        # Returns
+            mp, mr, map50, map (mean P, R, mAP@0.5, mAP@0.5:0.95 over the labelled classes)
+        """
+        classes = np.nonzero(self.n_labels)[0]
+        if not len(classes) or not self.n_pred.any():
+            return 0., 0., 0., 0.
+
+        px, nc = np.linspace(0, 1, 1000), len(classes)
+        ap, p, r = np.zeros((nc, self.niou)), np.zeros((nc, 1000)), np.zeros((nc, 1000))
+        bin_conf = (np.arange(self.CONF_BINS) + 0.5) / self.CONF_BINS
+        for ci, c in enumerate(classes):
+            n_pred = self.n_pred[c, ::-1]  # decreasing confidence
+            used = n_pred > 0
+            if not used.any():
+                continue
+            # cumulative counts at the end of each non-empty bin
+            tpc = self.tp[c, ::-1].cumsum(0)[used]
+            npc = n_pred.cumsum(0)[used]
+            conf = bin_conf[::-1][used]
+
+            recall = tpc / (self.n_labels[c] + 1e-16)
+            precision = tpc / npc[:, None]
+            r[ci] = np.interp(-px, -conf, recall[:, 0], left=0)
+            p[ci] = np.interp(-px, -conf, precision[:, 0], left=1)
+            for j in range(self.niou):
+                ap[ci, j] = compute_ap(recall[:, j], precision[:, j], metric=self.metric)[0]
+
+        f1 = 2 * p * r / (p + r + 1e-16)
+        i = smooth(f1.mean(0), 0.1).argmax()  # max F1 index
+        return p[:, i].mean(), r[:, i].mean(), ap[:, 0].mean(), ap.mean(1).mean()
+
+    def stats(self):
+        # [tp, conf, pred_cls, target_cls] concatenated over all updates, for ap_per_class()
+        return [np.concatenate(x, 0) for x in zip(*self.chunks)]
+
+
 def compute_ap(recall, precision, metric='v5'):
     """ Compute the average precision, given the recall and precision curves
     # Arguments
@@ -1,3 +1,233 @@
-from django.test import TestCase
+import torch
+import torch.nn.functional as F
+from django.test import SimpleTestCase
 
-# Create your tests here.
+from .tango import main  # noqa: F401, adds autonn_core to sys.path for the tango.* imports below
+from tango.utils.general import (box_iou, match_predictions, non_max_suppression, non_max_suppression_batched,
+                                 non_max_suppression_v9, xywh2xyxy)
+from tango.utils.loss import ComputeLossOTA, build_targets_ota
+
+
+def ota_per_image(p, targets, imgs, indices, anch, decode, nc):
+    # SimOTA assignment as ComputeLossOTA.build_targets() did it before build_targets_ota(), one image at a time
+    device = targets.device
+    nl = len(p)
+    matching = tuple([[] for _ in range(nl)] for _ in range(6))
+    for batch_idx in range(p[0].shape[0]):
+        this_target = targets[targets[:, 0] == batch_idx]
+        if this_target.shape[0] == 0:
+            continue
+        txyxy = xywh2xyxy(this_target[:, 2:6] * imgs[batch_idx].shape[1])
+
+        pxyxys, p_cls, p_obj, from_which_layer = [], [], [], []
+        all_b, all_a, all_gj, all_gi, all_anch = [], [], [], [], []
+        for i, pi in enumerate(p):
+            b, a, gj, gi = indices[i]
+            idx = b == batch_idx
+            b, a, gj, gi = b[idx], a[idx], gj[idx], gi[idx]
+            all_b.append(b)
+            all_a.append(a)
+            all_gj.append(gj)
+            all_gi.append(gi)
+            all_anch.append(anch[i][idx])
+            from_which_layer.append(torch.full_like(b, i))
+            pxyxy, obj, cls = decode(i, pi[b, a, gj, gi], torch.stack([gi, gj], dim=1), anch[i][idx])
+            pxyxys.append(pxyxy)
+            p_obj.append(obj)
+            p_cls.append(cls)
+        pxyxys = torch.cat(pxyxys, dim=0)
+        if pxyxys.shape[0] == 0:
+            continue
+        p_obj, p_cls = torch.cat(p_obj, dim=0), torch.cat(p_cls, dim=0)
+        from_which_layer = torch.cat(from_which_layer, dim=0)
+        all_b, all_a = torch.cat(all_b, dim=0), torch.cat(all_a, dim=0)
+        all_gj, all_gi = torch.cat(all_gj, dim=0), torch.cat(all_gi, dim=0)
+        all_anch = torch.cat(all_anch, dim=0)
+
+        pair_wise_iou = box_iou(txyxy, pxyxys)
+        pair_wise_iou_loss = -torch.log(pair_wise_iou + 1e-8)
+        top_k, _ = torch.topk(pair_wise_iou, min(10, pair_wise_iou.shape[1]), dim=1)
+        dynamic_ks = torch.clamp(top_k.sum(1).int(), min=1)
+
+        num_gt = this_target.shape[0]
+        gt_cls_per_image = F.one_hot(this_target[:, 1].to(torch.int64), nc).float().unsqueeze(1) \
+            .repeat(1, pxyxys.shape[0], 1)
+        y = (p_cls.float().unsqueeze(0).repeat(num_gt, 1, 1).sigmoid_()
+             * p_obj.unsqueeze(0).repeat(num_gt, 1, 1).sigmoid_()).sqrt_()
+        pair_wise_cls_loss = F.binary_cross_entropy_with_logits(
+            torch.log(y / (1 - y)), gt_cls_per_image, reduction="none").sum(-1)
+        cost = pair_wise_cls_loss + 3.0 * pair_wise_iou_loss
+
+        matching_matrix = torch.zeros_like(cost, device=device)
+        for gt_idx in range(num_gt):
+            _, pos_idx = torch.topk(cost[gt_idx], k=dynamic_ks[gt_idx].item(), largest=False)
+            matching_matrix[gt_idx][pos_idx] = 1.0
+        anchor_matching_gt = matching_matrix.sum(0)
+        if (anchor_matching_gt > 1).sum() > 0:
+            _, cost_argmin = torch.min(cost[:, anchor_matching_gt > 1], dim=0)
+            matching_matrix[:, anchor_matching_gt > 1] *= 0.0
+            matching_matrix[cost_argmin, anchor_matching_gt > 1] = 1.0
+        fg_mask_inboxes = matching_matrix.sum(0) > 0.0
+        matched_gt_inds = matching_matrix[:, fg_mask_inboxes].argmax(0)
+
+        from_which_layer = from_which_layer[fg_mask_inboxes]
+        this_target = this_target[matched_gt_inds]
+        for i in range(nl):
+            layer_idx = from_which_layer == i
+            for m, x in zip(matching[:4], (all_b, all_a, all_gj, all_gi)):
+                m[i].append(x[fg_mask_inboxes][layer_idx])
+            matching[4][i].append(this_target[layer_idx])
+            matching[5][i].append(all_anch[fg_mask_inboxes][layer_idx])
+    return tuple([torch.cat(x, 0) if len(x) else torch.zeros(0) for x in m] for m in matching)
+
+
+def match_per_image(pbox, pcls, pimg, tbox, tcls, timg, iouv):
+    # greedy matching as test() did it before match_predictions(), one image and class at a time
+    correct = torch.zeros(pbox.shape[0], iouv.numel(), dtype=torch.bool)
+    for img in torch.unique(timg):
+        pi_img = (pimg == img).nonzero(as_tuple=False).view(-1)
+        ti_img = (timg == img).nonzero(as_tuple=False).view(-1)
+        detected = []
+        detected_set = set()
+        for cls in torch.unique(tcls[ti_img]):
+            ti = ti_img[tcls[ti_img] == cls]
+            pi = pi_img[pcls[pi_img] == cls]
+            if pi.shape[0]:
+                ious, i = box_iou(pbox[pi], tbox[ti]).max(1)
+                for j in (ious > iouv[0]).nonzero(as_tuple=False):
+                    d = ti[i[j]]
+                    if d.item() not in detected_set:
+                        detected_set.add(d.item())
+                        detected.append(d)
+                        correct[pi[j]] = ious[j] > iouv
+                        if len(detected) == len(ti_img):
+                            break
+    return correct
+
+
+def random_boxes(n, size=640):
+    xy = torch.rand(n, 2) * size
+    wh = torch.rand(n, 2) * size / 4 + 4
+    return torch.cat((xy, xy + wh), 1)
+
+
+class BuildTargetsOTATest(SimpleTestCase):
+    nc, na, strides = 5, 3, (8, 16, 32)
+
+    def setUp(self):
+        torch.manual_seed(0)
+        # the parts of ComputeLossOTA that find_3_positive() and decode_ota() use, without a model
+        self.loss = ComputeLossOTA.__new__(ComputeLossOTA)
+        self.loss.nc, self.loss.na, self.loss.nl = self.nc, self.na, len(self.strides)
+        self.loss.stride = torch.tensor(self.strides, dtype=torch.float)
+        self.loss.anchors = torch.tensor([[10, 13, 16, 30, 33, 23],
+                                          [30, 61, 62, 45, 59, 119],
+                                          [116, 90, 156, 198, 373, 326]], dtype=torch.float).view(3, 3, 2) \
+            / self.loss.stride.view(-1, 1, 1)
+        self.loss.hyp = {'anchor_t': 4.0}
+
+    def batch(self, bs=4, imgsz=320, nt=24, scale=1.):
+        p = [torch.randn(bs, self.na, imgsz // s, imgsz // s, 5 + self.nc) * scale for s in self.strides]
+        targets = torch.cat((torch.randint(0, bs, (nt, 1)).float(),
+                             torch.randint(0, self.nc, (nt, 1)).float(),
+                             torch.rand(nt, 2) * 0.8 + 0.1,
+                             torch.rand(nt, 2) * 0.3 + 0.02), 1)
+        return p, targets, torch.zeros(bs, 3, imgsz, imgsz)
+
+    def assign(self, assigner, p, targets, imgs):
+        indices, anch = self.loss.find_3_positive(p, targets)
+        matching = assigner(p, targets, imgs, indices, anch, self.loss.decode_ota, self.nc)
+        # one (image, anchor, gj, gi, target..., anchor wh...) row per match and layer, in a fixed order:
+        # duplicate candidates have equal costs, and the two assigners may pick a different one of them
+        rows = []
+        for i in range(len(p)):
+            n = len(matching[0][i])
+            x = torch.cat([m[i].float().view(n, -1) if n else torch.zeros(0, 1) for m in matching], 1)
+            rows.append(sorted(map(tuple, x.tolist())))
+        return rows
+
+    def test_same_as_per_image(self):
+        for _ in range(3):
+            p, targets, imgs = self.batch()
+            self.assertEqual(self.assign(build_targets_ota, p, targets, imgs),
+                             self.assign(ota_per_image, p, targets, imgs))
+
+    def test_image_without_targets(self):
+        p, targets, imgs = self.batch()
+        targets = targets[targets[:, 0] != 1]
+        self.assertEqual(self.assign(build_targets_ota, p, targets, imgs),
+                         self.assign(ota_per_image, p, targets, imgs))
+
+    def test_saturated_predictions(self):
+        # obj/cls logits far out of the sigmoid range give the same (bounded) class cost to every
+        # candidate instead of inf - inf = nan, so the assignment only follows the IoU cost,
+        # exactly as with equal unsaturated logits
+        p, targets, imgs = self.batch()
+        saturated = [pi.clone() for pi in p]
+        for pi, si in zip(p, saturated):
+            pi[..., 4:] = 0.
+            si[..., 4:] = 100.
+        self.assertEqual(self.assign(build_targets_ota, saturated, targets, imgs),
+                         self.assign(ota_per_image, p, targets, imgs))
+
+class MatchPredictionsTest(SimpleTestCase):
+    def test_same_as_per_image(self):
+        torch.manual_seed(0)
+        iouv = torch.linspace(0.5, 0.95, 10)
+        for _ in range(5):
+            tbox = random_boxes(40)
+            tcls, timg = torch.randint(0, 3, (40,)), torch.randint(0, 4, (40,))
+            # predictions near the targets, so most of them are over iouv[0], and some random ones
+            near = torch.randint(0, 40, (120,))
+            pbox = torch.cat((tbox[near] + torch.randn(120, 4) * 8, random_boxes(30)))
+            pcls = torch.cat((tcls[near], torch.randint(0, 3, (30,))))
+            pimg = torch.cat((timg[near], torch.randint(0, 4, (30,))))
+            self.assertTrue(torch.equal(match_predictions(pbox, pcls, pimg, tbox, tcls, timg, iouv),
+                                        match_per_image(pbox, pcls, pimg, tbox, tcls, timg, iouv)))
+
+    def test_no_targets(self):
+        iouv = torch.linspace(0.5, 0.95, 10)
+        correct = match_predictions(random_boxes(5), torch.zeros(5), torch.zeros(5),
+                                    torch.zeros(0, 4), torch.zeros(0), torch.zeros(0), iouv)
+        self.assertEqual(correct.shape, (5, 10))
+        self.assertFalse(correct.any())
+
+
+class NonMaxSuppressionBatchedTest(SimpleTestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+
+    def prediction(self, bs=4, n=600, nc=3):
+        # clusters of overlapping boxes, so NMS has something to suppress; whole-pixel corners stay
+        # exact after the (image, class) offsets, so both functions compute the same IoUs
+        centers = torch.rand(bs, n // 20, 1, 2) * 600 + 20
+        xy = (centers + torch.randn(bs, n // 20, 20, 2) * 6).view(bs, n, 2).round()
+        wh = torch.randint(10, 30, (bs, n, 2)).float() * 2
+        return torch.cat((xy, wh, torch.rand(bs, n, 1 + nc)), 2)
+
+    def assertSameDetections(self, batched, per_image):
+        out, counts = batched
+        self.assertEqual(counts.tolist(), [len(d) for d in per_image])
+        for o, n, d in zip(out, counts.tolist(), per_image):
+            self.assertTrue(torch.allclose(o[:n], d, atol=1e-4))
+            self.assertFalse(o[n:].any())  # zero padding
+
+    def test_same_as_per_image(self):
+        for multi_label in (False, True):
+            pred = self.prediction()
+            self.assertSameDetections(non_max_suppression_batched(pred.clone(), multi_label=multi_label),
+                                      non_max_suppression(pred.clone(), multi_label=multi_label))
+
+    def test_same_as_per_image_v9(self):
+        pred = self.prediction()
+        pred = torch.cat((pred[..., :4], pred[..., 5:]), 2).transpose(1, 2)  # (bs, 4+nc, n), no obj
+        for multi_label in (False, True):
+            self.assertSameDetections(non_max_suppression_batched(pred.clone(), multi_label=multi_label, v9=True),
+                                      non_max_suppression_v9(pred.clone(), multi_label=multi_label))
+
+    def test_no_boxes(self):
+        pred = self.prediction()
+        pred[..., 4] = 0.
+        out, counts = non_max_suppression_batched(pred)
+        self.assertEqual(out.shape, (4, 300, 6))
+        self.assertFalse(counts.any())
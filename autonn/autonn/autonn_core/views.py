@@ -17,6 +17,7 @@ from .serializers import NodeSerializer
 from .serializers import EdgeSerializer
 from .serializers import PthSerializer
 
+from .tango.main import status_flush
 from .tango.main.select import run_autonn
 from .tango.main.visualize import export_pth, export_yml
 
@@ -375,6 +376,7 @@ def process_autonn(userid, project_id):
     try:
         # ------- actual process --------
         run_autonn(userid, project_id, resume=resume, viz2code=False, nas=False, hpo=False)
+        status_flush()  # deliver queued status updates before the final report
 
         info = Info.objects.get(userid=userid, project_id=project_id)
         info.progress = 'autonn ends'
@@ -385,6 +387,7 @@ def process_autonn(userid, project_id):
 
     except Exception as e:
         print(f"[AutoNN process_autonn] exception: {e}")
+        status_flush()  # queued progress must not overwrite 'oom' below
 
         import torch, gc
         if torch.cuda.is_available():
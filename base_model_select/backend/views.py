@@ -18,6 +18,7 @@ from pathlib import Path
 
 from . import models
 from batch_test.batch_size_test import run_batch_test
+from batch_test.benchmark import run_benchmark, meets_target
 
 
 PREFIX = '[ BMS ]'
@@ -50,6 +51,18 @@ model_to_size_table = {
         "odroidn2": "20",
     },
 }
+model_candidates = {  # small to large
+    "yolov7": ["-tiny", "x", "-w6", "-e6e"],
+    "resnet": ["20", "32", "44", "50", "56", "110", "152", "200"],
+}
+# default latency budget (ms, batch 1) when project_info has no 'latency';
+# only for targets which run on this kind of host, since the benchmark measures this device
+target_latency_table = {
+    "cloud": 33.0,  # 30 fps
+    "k8s": 33.0,
+    "pcweb": 33.0,
+    "pc": 33.0,
+}
 
 
 @api_view(['POST'])
@@ -272,6 +285,9 @@ def create_basemodel_yaml(yaml_path, userid, project_id, manual_select=None):
     if manual_select==None:
         model = task_to_model_table[task]
         model_size = model_to_size_table[model][target]
+        latency = proj_info.get('latency') or target_latency_table.get(target)
+        if latency:
+            model_size = benchmark_select(model, task, latency, proj_info.get('memory'), model_size)
     else:
         model = manual_select['model']
         model_size = manual_select['size']
@@ -299,6 +315,32 @@ def create_basemodel_yaml(yaml_path, userid, project_id, manual_select=None):
     return target_path
 
 
+def benchmark_select(model, task, latency, memory, default_size):
+    '''
+    the largest candidate which meets the latency budget (ms) and the memory
+    (GB, training footprint) of the target, measured on this device;
+    the size of model_to_size_table is only a default, the memory bounds the candidates,
+    and the smallest one is used if none meets the target
+    '''
+    sizes = [s for s in model_candidates[model]
+             if os.path.isfile(f'basemodel_yaml/{model}/{model}{s}.yaml')]
+    if len(sizes) < 2:
+        return default_size
+
+    print(f'{PREFIX} Benchmarking {model} {sizes} for latency <= {latency}ms, memory <= {memory}G')
+    for size in reversed(sizes):
+        source_path = f'basemodel_yaml/{model}/{model}{size}.yaml'
+        if task == 'detection':
+            with open(source_path, 'r') as f:
+                imgsz = yaml.load(f, Loader=yaml.FullLoader)['imgsz']
+        else:
+            imgsz = 256
+        if meets_target(run_benchmark(source_path, task, imgsz), latency, memory):
+            return size
+    print(f'{PREFIX} No candidate meets the target, {model}{sizes[0]} is used')
+    return sizes[0]
+
+
 def get_user_requirements(userid, projid):
     common_root = Path('/shared/common/')
     proj_path = common_root / userid / projid
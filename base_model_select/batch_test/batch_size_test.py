@@ -13,6 +13,7 @@ from .resnet.resnet_cifar10 import ResNet as resnet_model
 from .resnet.resnet_cifar10 import BasicBlock
 
 from .binary_search import TestFuncGen, binary_search
+from .profile_store import STORE_PATH, profile_key, load_profile, save_profile
 
 
 PREFIX = '[ BMS - AutoBatch ]'
@@ -21,11 +22,13 @@ DEBUG = False
 
 def run_batch_test(basemodel_yaml, task, imgsz, hyp_yaml=None, nas=None):
     print(f'{PREFIX} Start AutoBatch')
+    profile_yaml = basemodel_yaml
     if task=='detection':
         with open(hyp_yaml, 'r') as f:
             hyp = yaml.load(f, Loader=yaml.SafeLoader)  # load hyps
         if nas:
-            model = YOLOSuperNet(str(Path(os.path.dirname(__file__))/'yolo'/'nas'/'supernet'/'yolov7_supernet.yml'), ch=3, nc=80, anchors=hyp.get('anchors'))
+            profile_yaml = str(Path(os.path.dirname(__file__))/'yolo'/'nas'/'supernet'/'yolov7_supernet.yml')
+            model = YOLOSuperNet(profile_yaml, ch=3, nc=80, anchors=hyp.get('anchors'))
             model.set_max_net()
             if DEBUG: print(f'{PREFIX} YOLOSuperNet is used for AutoBatch.')
         else:
@@ -44,7 +47,7 @@ def run_batch_test(basemodel_yaml, task, imgsz, hyp_yaml=None, nas=None):
         if DEBUG: print(f'{PREFIX} task is unknown ({task})')
         return None
 
-    batch_size = int(get_batch_size_for_gpu(model, 3 if task=='detection' else 1, imgsz, amp=True) * 0.9)
+    batch_size = int(get_batch_size_for_gpu(model, 3 if task=='detection' else 1, imgsz, amp=True, cfg=profile_yaml) * 0.9)
     # It assumes that the memory sizes of all gpus in a machine are same.
     # 0.8 is multiplied by batch size to prevent cuda memory error due to a memory leak of yolov7
 
@@ -58,12 +61,12 @@ def run_batch_test(basemodel_yaml, task, imgsz, hyp_yaml=None, nas=None):
     return batch_size
 
 
-def get_batch_size_for_gpu(model, ch, imgsz, amp):
+def get_batch_size_for_gpu(model, ch, imgsz, amp, cfg=None):
     with torch.cuda.amp.autocast(amp):
-        return autobatch(model, ch, imgsz)
+        return autobatch(model, ch, imgsz, cfg=cfg, amp=amp)
 
 
-def autobatch(model, ch, imgsz, batch_size=4):
+def autobatch(model, ch, imgsz, batch_size=4, cfg=None, amp=True):
     if torch.cuda.is_available():
        num_dev = torch.cuda.device_count()
     else:
@@ -71,6 +74,14 @@ def autobatch(model, ch, imgsz, batch_size=4):
        return batch_size
 
     device = torch.device(f'cuda:0')
+
+    # max batch size profiled by AutoNN or a previous BMS run
+    key = profile_key(cfg, imgsz, amp, device) if cfg and os.path.isfile(cfg) else None
+    profiled = load_profile(key, device) if key else None
+    if profiled is not None:
+        print(f'{PREFIX} Max batch size {profiled} from {STORE_PATH}')
+        return profiled
+
     model.to(device)
     model.train()
     batch_size = 2
@@ -94,5 +105,7 @@ def autobatch(model, ch, imgsz, batch_size=4):
     torch.cuda.empty_cache()
     test_func = TestFuncGen(model, ch, imgsz)
     final_batch_size = binary_search(final_batch_size, batch_size, test_func, want_to_get=True)
+    if key:
+        save_profile(key, device, final_batch_size)
 
     return final_batch_size
@@ -0,0 +1,176 @@
+import torch
+import fcntl
+import gc
+import json
+import time
+import yaml
+import hashlib
+import os
+import platform
+
+import numpy as np
+
+from .yolo.models.yolo import Model as yolo_model
+from .resnet.resnet_cifar10 import ResNet as resnet_model
+from .resnet.resnet_cifar10 import BasicBlock
+
+
+PREFIX = '[ BMS - Benchmark ]'
+DEBUG = False
+
+BATCH_SIZE = 8      # batch size for throughput
+TRAIN_BATCH_SIZE = 2    # smallest training batch, for the training memory footprint
+WARMUP = 3
+ITERS = 10
+CACHE_PATH = '/shared/common/bms_benchmark.json'
+
+
+def run_benchmark(basemodel_yaml, task, imgsz, device=None):
+    '''
+    latency (batch 1), peak memory (batch 1), training memory (forward + backward)
+    and throughput of a candidate yaml with synthetic batches, cached per (yaml, device, imgsz)
+    '''
+    if device is None:
+        device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    name = torch.cuda.get_device_name(device) if device.type == 'cuda' \
+           else f'cpu ({platform.processor() or platform.machine()})'
+    with open(basemodel_yaml, 'rb') as f:
+        key = f'{hashlib.md5(f.read()).hexdigest()}|{name}|{imgsz}'
+
+    cache = load_cache()
+    if 'train_mem' in cache.get(key, {}):
+        if DEBUG: print(f'{PREFIX} {basemodel_yaml} on {name} from cache')
+        return cache[key]
+
+    model = None
+    try:
+        if task == 'detection':
+            model, ch = yolo_model(basemodel_yaml, ch=3, nc=80), 3
+        else:
+            with open(basemodel_yaml, 'r') as f:
+                basemodel_dict = yaml.load(f, Loader=yaml.SafeLoader)
+            model = resnet_model(BasicBlock,
+                                 basemodel_dict.get('layers', [3,3,3]),
+                                 basemodel_dict.get('num_classes', 2))
+            ch = 1
+        result = measure(model, ch, imgsz, device)
+    except RuntimeError as e:
+        print(f'{PREFIX} {basemodel_yaml} on {name} failed: {e}')
+        return None
+    finally:
+        del model
+        gc.collect()
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+    mem = f"{result['peak_mem'] / (1 << 30):.2f}G" if result['peak_mem'] is not None else '-'
+    train_mem = f"{result['train_mem'] / (1 << 30):.2f}G" if result['train_mem'] is not None else '-'
+    print(f"{PREFIX} {basemodel_yaml} on {name}: {result['params'] / 1E6:.1f}M params, "
+          f"{result['latency_ms']:.1f}ms, {result['throughput']:.1f}img/s, peak {mem}, training {train_mem}")
+    save_cache(key, result)
+    return result
+
+
+def measure(model, ch, imgsz, device):
+    cuda = device.type == 'cuda'
+    model = model.to(device).eval()
+    result = {'params': int(sum(p.numel() for p in model.parameters()))}
+    with torch.no_grad():
+        img = torch.zeros(1, ch, imgsz, imgsz, device=device)
+        for _ in range(WARMUP):
+            model(img)
+        if cuda:
+            torch.cuda.synchronize(device)
+            torch.cuda.reset_peak_memory_stats(device)
+        t = time_forward(model, img, device)
+        result['latency_ms'] = t * 1E3
+        result['peak_mem'] = torch.cuda.max_memory_allocated(device) if cuda else None
+        result['throughput'] = 1. / t
+        del img
+
+        try:
+            img = torch.zeros(BATCH_SIZE, ch, imgsz, imgsz, device=device)
+            model(img)
+            result['throughput'] = BATCH_SIZE / time_forward(model, img, device)
+        except RuntimeError:
+            if DEBUG: print(f'{PREFIX} batch size {BATCH_SIZE}: fail')
+        finally:
+            img = None
+
+    result['train_mem'] = train_memory(model, ch, imgsz, device) if cuda else None
+    return result
+
+
+def train_memory(model, ch, imgsz, device):
+    # peak memory of one training step (forward + backward) at TRAIN_BATCH_SIZE
+    model.train()
+    torch.cuda.synchronize(device)
+    torch.cuda.reset_peak_memory_stats(device)
+    try:
+        y = model(torch.zeros(TRAIN_BATCH_SIZE, ch, imgsz, imgsz, device=device))
+        sum(t.float().sum() for t in flatten(y)).backward()
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device)
+    except RuntimeError as e:  # out of memory
+        if DEBUG: print(f'{PREFIX} training step: fail ({e})')
+        return float('inf')
+    finally:
+        y = None
+        model.zero_grad(set_to_none=True)
+        model.eval()
+
+
+def flatten(y):
+    # tensors of a (nested) model output
+    if isinstance(y, (list, tuple)):
+        return [t for x in y for t in flatten(x)]
+    return [y]
+
+
+def time_forward(model, img, device):
+    # median seconds of one forward pass
+    times = []
+    for _ in range(ITERS):
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        t = time.perf_counter()
+        model(img)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        times.append(time.perf_counter() - t)
+    return float(np.median(times))
+
+
+def meets_target(result, latency_ms=None, memory_gb=None):
+    if result is None:
+        return False
+    if latency_ms is not None and result['latency_ms'] > float(latency_ms):
+        return False
+    # the model is trained on the target, so the training footprint has to fit
+    if memory_gb is not None and result.get('train_mem') is not None \
+            and result['train_mem'] > float(memory_gb) * (1 << 30):
+        return False
+    return True
+
+
+def load_cache():
+    try:
+        with open(CACHE_PATH, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(key, result):
+    try:
+        # other BMS processes update the same cache, hold its lock from read to replace
+        with open(f'{CACHE_PATH}.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            cache = load_cache()
+            cache[key] = result
+            tmp = f'{CACHE_PATH}.{os.getpid()}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(cache, f, indent=2)
+            os.replace(tmp, CACHE_PATH)
+    except OSError as e:
+        print(f'{PREFIX} failed to save {CACHE_PATH}: {e}')
@@ -0,0 +1,57 @@
+import torch
+import fcntl
+import json
+import hashlib
+import os
+
+
+PREFIX = '[ BMS - AutoBatch - Profile Store ]'
+
+# max batch size per gpu (without margin), shared with AutoNN (tango/utils/autobatch.py)
+# { 'yaml md5|imgsz|amp|gpu model' : {'batch_size', 'hardware', 'source'} }
+STORE_PATH = '/shared/common/batchsize_profile.json'
+
+
+def profile_key(basemodel_yaml, imgsz, amp, device):
+    with open(basemodel_yaml, 'rb') as f:
+        h = hashlib.md5(f.read()).hexdigest()
+    return f"{h}|{imgsz}|{'amp' if amp else 'fp32'}|{torch.cuda.get_device_name(device)}"
+
+
+def hardware_id(device):
+    # a profile is invalid on a gpu with the same name but different memory or architecture
+    p = torch.cuda.get_device_properties(device)
+    return f'{p.total_memory}|{p.major}.{p.minor}'
+
+
+def load_profile(key, device):
+    try:
+        with open(STORE_PATH, 'r') as f:
+            entry = json.load(f).get(key)
+    except (OSError, ValueError):
+        return None
+    if entry is None:
+        return None
+    if entry.get('hardware') != hardware_id(device):
+        print(f"{PREFIX} hardware changed since profiled by {entry.get('source')}, profiling again")
+        return None
+    return int(entry['batch_size'])
+
+
+def save_profile(key, device, batch_size):
+    try:
+        # AutoNN and other BMS processes update the same store, hold its lock from read to replace
+        with open(f'{STORE_PATH}.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(STORE_PATH, 'r') as f:
+                    store = json.load(f)
+            except (OSError, ValueError):
+                store = {}
+            store[key] = {'batch_size': int(batch_size), 'hardware': hardware_id(device), 'source': 'bms'}
+            tmp = f'{STORE_PATH}.{os.getpid()}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(store, f, indent=2)
+            os.replace(tmp, STORE_PATH)
+    except OSError as e:
+        print(f'{PREFIX} failed to save {STORE_PATH}: {e}')
@@ -27,10 +27,12 @@ import tvm.relay as relay
 import sys
 import logging
 import threading
+import multiprocessing
+import queue
 import time
 import yaml
 # for web service
-from http.server import HTTPServer, SimpleHTTPRequestHandler
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
 import requests
 # import      subprocess
 # import      importlib
@@ -107,6 +109,7 @@ def_newline = '\n'
 def_4blank = "    "
 
 def_codegen_port = 8888
+def_codegen_workers = 2  # number of projects whose code can be generated at the same time
 
 def_n2_manual = './db/odroid-n2-manual.txt'
 def_m1_manual = './db/odroid-m1-manual.txt'
@@ -246,55 +249,8 @@ class CodeGen:
     m_deploy_network_serviceport = 0
 
     m_last_run_state = 0
-    
-    
-    ev = threading.Event()
-    lock = threading.Lock()
-    the_cnt = 0
-    thread_run_flag = 1
-    thread_done = 0
-
-    m_atwork = 0   # set 1 when run() fuction is called, reset when run() function is finished
 
 
-    ####################################################################
-    def thread_for_run(self):
-        while self.thread_run_flag > 0:
-            if self.the_cnt > 0:
-                logging.debug("Call Run()")
-                if self.thread_run_flag > 0:
-                    self.m_atwork = 1
-                    self.run()
-                    self.m_atwork = 0
-                    # khlee 
-                    # send status_report
-                    self.response()
-                    logging.debug("code_gen: send_status_report to manager")
-                    with self.lock:
-                        self.the_cnt = self.the_cnt - 1
-            else:
-                event = self.ev.wait(20)
-                if event:
-                    self.ev.clear()
-                    logging.debug("Recv Event")
-        self.thread_done = 1
-        logging.debug("Thread Done")
-        return
-
-    ####################################################################
-    def wait_for_done(self):
-        self.thread_run_flag = 0
-        with self.lock:
-            self.the_cnt = 0
-        self.ev.set()
-        for j in range(3):
-            if self.thread_done != 0:
-                break
-            else:
-                time.sleep(1)
-        logging.debug("code_gen Module End")
-        return
-
     ####################################################################
     def add_user_libs(self, libs):
         """
@@ -1753,12 +1709,186 @@ class CodeGen:
         return
 
 
+####################################################################
+####################################################################
+def run_codegen_job(userid, projectid):
+    """
+    Generate the code of one project (entry of a job process)
+
+    Each job runs in its own process with its own CodeGen object, so the
+    state of a project (m_* attributes, the model modules imported from the
+    project folder) is never shared with another project.
+
+    Args:
+        userid : user id(string)
+        projectid : project id (string)
+    Returns: None (exit code 0 : success, 1 : failed)
+    """
+    cg = CodeGen()
+    cg.set_folder(userid, projectid)
+    try:
+        ret = cg.run()
+    except Exception as err:
+        logging.debug("code_gen: run() error %s" % err)
+        ret = -1
+    if ret == -1:
+        cg.m_last_run_state = -1
+    # send status_report
+    cg.response()
+    logging.debug("code_gen: send_status_report to manager")
+    sys.exit(0 if cg.m_last_run_state == 0 else 1)
+
+
+####################################################################
+####################################################################
+class CodeGenJob:
+    """State of the code generation of one project"""
+
+    def __init__(self, userid, projectid):
+        self.userid = userid
+        self.projectid = projectid
+        self.status = "queued"  # queued/running/completed/failed
+        self.process = None
+        self.submit_time = time.time()
+        self.start_time = 0
+        self.end_time = 0
+
+
+####################################################################
+####################################################################
+class CodeGenEngine:
+    """
+    Queue of code generation jobs, run by a bounded pool of workers
+
+    A worker thread takes a job from the queue and runs run_codegen_job()
+    in a child process, so up to def_codegen_workers projects are converted
+    in parallel while the web server keeps answering status requests.
+    """
+
+    def __init__(self, workers=def_codegen_workers):
+        self.jobs = {}  # (userid, projectid) : CodeGenJob
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.paused = False
+        self.mp_context = multiprocessing.get_context('spawn')
+        self.workers = []
+        for i in range(workers):
+            thr = threading.Thread(target=self.worker, daemon=True, name="CodeGenWorker%d" % i)
+            thr.start()
+            self.workers.append(thr)
+
+    ####################################################################
+    def submit(self, userid, projectid):
+        """
+        Queue the code generation of a project
+
+        Args:
+            userid : user id(string)
+            projectid : project id (string)
+        Returns: CodeGenJob
+            the job of the project (the current one if it is already queued or running)
+        """
+        with self.lock:
+            job = self.jobs.get((userid, projectid))
+            if job is not None and job.status in ("queued", "running"):
+                return job
+            job = CodeGenJob(userid, projectid)
+            self.jobs[(userid, projectid)] = job
+        self.queue.put(job)
+        logging.debug("code_gen: job %s/%s queued" % (userid, projectid))
+        return job
+
+    ####################################################################
+    def status(self, userid, projectid):
+        """
+        Status of the job of a project
+
+        Args:
+            userid : user id(string)
+            projectid : project id (string)
+        Returns: string
+            ready/running/completed/failed/stopped
+        """
+        if userid == "":
+            return "ready"
+        with self.lock:
+            job = self.jobs.get((userid, projectid))
+        if job is None:
+            return "ready"
+        if job.status in ("queued", "running"):
+            return "running"
+        if self.paused:
+            return "stopped"
+        return job.status
+
+    ####################################################################
+    def clear(self, userid, projectid):
+        """
+        Remove the generated files of a project, unless its job is running
+
+        Args:
+            userid : user id(string)
+            projectid : project id (string)
+        Returns: None
+        """
+        with self.lock:
+            job = self.jobs.get((userid, projectid))
+            if job is not None and job.status in ("queued", "running"):
+                logging.debug("code_gen: job %s/%s is running, not cleared" % (userid, projectid))
+                return
+            self.jobs.pop((userid, projectid), None)
+        cg = CodeGen()
+        cg.set_folder(userid, projectid)
+        cg.clear()
+
+    ####################################################################
+    def worker(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            job.status = "running"
+            job.start_time = time.time()
+            logging.debug("code_gen: job %s/%s started" % (job.userid, job.projectid))
+            # spawn, not fork: the server threads, the other workers and TVM may hold locks in this process
+            job.process = self.mp_context.Process(target=run_codegen_job,
+                                                  args=(job.userid, job.projectid),
+                                                  name="CodeGen-%s-%s" % (job.userid, job.projectid))
+            job.process.start()
+            job.process.join()
+            job.end_time = time.time()
+            job.status = "completed" if job.process.exitcode == 0 else "failed"
+            logging.debug("code_gen: job %s/%s %s in %.1f sec" % (job.userid, job.projectid, job.status,
+                                                                   job.end_time - job.start_time))
+
+    ####################################################################
+    def wait_for_done(self):
+        """
+        Stop the workers, the queued jobs are dropped and the running ones terminated
+        """
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+        for _ in self.workers:
+            self.queue.put(None)
+        with self.lock:
+            jobs = list(self.jobs.values())
+        for job in jobs:
+            if job.process is not None and job.process.is_alive():
+                job.process.terminate()
+        for thr in self.workers:
+            thr.join(3)
+        logging.debug("code_gen Module End")
+        return
+
+
 ####################################################################
 ####################################################################
 class MyHandler(SimpleHTTPRequestHandler):
     """Webserver Definition """
     
-    m_flag = 1
     m_stop = 0
     m_obj = 0
     # allowed_list = ('0,0,0,0', '127.0.0.1')
@@ -1801,6 +1931,7 @@ class MyHandler(SimpleHTTPRequestHandler):
             t_path = self.path
         pathlist = t_path.split('/')[1].split('?')
         cnt = len(pathlist)
+        userid, prjid = "", ""
         if cnt < 2:
             cmd = "unknown"
         else:
@@ -1812,9 +1943,7 @@ class MyHandler(SimpleHTTPRequestHandler):
                 cmd = pathlist[0]
                 userid = ctmp[0].split('user_id')[1].split('=')[1]
                 if userid == '""':
-                    self.m_obj.set_folder("", "")
-                else:
-                    self.m_obj.set_folder(userid, "")
+                    userid = ""
             else:  # mycnt == 2:
                 cmd = pathlist[0]
                 userid = ctmp[0].split('user_id')[1].split('=')[1]
@@ -1823,7 +1952,6 @@ class MyHandler(SimpleHTTPRequestHandler):
                     userid = ""
                 if prjid == '""' or prjid == '%22%22':
                     prjid = ""
-                self.m_obj.set_folder(userid, prjid)
         logging.debug("code_gen: cmd = %s" %  cmd)
 
         if cmd == "start":
@@ -1836,12 +1964,8 @@ class MyHandler(SimpleHTTPRequestHandler):
             self.wfile.write(buf.encode())
             logging.debug("code_gen: send_ack")
 
-            if self.m_flag == 1:
-                # self.m_obj.run()
-                with self.m_obj.lock:
-                    self.m_obj.the_cnt = self.m_obj.the_cnt + 1
-                self.m_obj.ev.set()
-                logging.debug("event Set")
+            if not self.m_obj.paused:
+                self.m_obj.submit(userid, prjid)
             # send notice to project manager
             # self.m_obj.response()
             # print("code_gen: send_status_report to manager")
@@ -1853,10 +1977,10 @@ class MyHandler(SimpleHTTPRequestHandler):
             self.send_header("Content-Length", "%d" % len(buf))
             self.end_headers()
             self.wfile.write(buf.encode())
-            self.m_obj.clear()
+            self.m_obj.clear(userid, prjid)
             self.m_stop = 1
         elif cmd == "clear":
-            self.m_obj.clear()
+            self.m_obj.clear(userid, prjid)
             buf = '"OK"'
             self.send_response(200, 'ok')
             self.send_cors_headers()
@@ -1865,7 +1989,7 @@ class MyHandler(SimpleHTTPRequestHandler):
             self.end_headers()
             self.wfile.write(buf.encode())
         elif cmd == "pause":
-            self.m_flag = 0
+            self.m_obj.paused = True
             buf = '"OK"'
             self.send_response(200, 'ok')
             self.send_cors_headers()
@@ -1874,7 +1998,7 @@ class MyHandler(SimpleHTTPRequestHandler):
             self.end_headers()
             self.wfile.write(buf.encode())
         elif cmd == '"resume"':
-            self.m_flag = 1
+            self.m_obj.paused = False
             buf = "OK"
             self.send_response(200, 'ok')
             self.send_cors_headers()
@@ -1884,17 +2008,7 @@ class MyHandler(SimpleHTTPRequestHandler):
             self.wfile.write(buf.encode())
         elif cmd == 'status_request':
             logging.debug("status_request called")
-            buf = '"failed"'
-            if self.m_obj.m_current_userid == "":
-                buf = '"ready"'
-            else:
-                if self.m_obj.m_atwork == 1:
-                    buf = '"running"'
-                else:
-                    if self.m_flag == 0:
-                        buf = '"stopped"'
-                    else:
-                        buf = '"completed"'
+            buf = '"%s"' % self.m_obj.status(userid, prjid)
             self.send_response(200, 'ok')
             self.send_cors_headers()
             self.send_header('Content-Type', 'text/plain')
@@ -1912,8 +2026,8 @@ class MyHandler(SimpleHTTPRequestHandler):
             self.wfile.write(buf.encode())
 
         if self.m_stop == 1:
-            time.sleep(1)
-            raise KeyboardInterrupt  # to finish web sever
+            # to finish web server (serve_forever() returns), from another thread
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
         return
         
     def do_OPTIONS(self):
@@ -1953,22 +2067,21 @@ if __name__ == '__main__':
     # tmp.run()
     # exit()
 
-    m_obj = CodeGen()
-    mythr = threading.Thread(target=m_obj.thread_for_run, daemon=True, name="MyThread")
-    mythr.start()
+    m_obj = CodeGenEngine()
 
     MyHandler.set_obj(m_obj)
-    server = HTTPServer(('', def_codegen_port), MyHandler)
+    server = ThreadingHTTPServer(('', def_codegen_port), MyHandler)
     logging.debug("Started WebServer on Port %d" % def_codegen_port)
     logging.debug("Press ^C to quit WebServer")
 
     try:
         server.serve_forever()
     except KeyboardInterrupt as e:
-        time.sleep(1)
-        server.socket.close()
-        logging.debug("wait for thread done")
-        m_obj.wait_for_done()
+        pass
+    time.sleep(1)
+    server.server_close()
+    logging.debug("wait for thread done")
+    m_obj.wait_for_done()
 
 
 #스트링으로 함수 호출하기 #1
@@ -0,0 +1,144 @@
+import asyncio
+import os
+import sys
+import time
+from dataclasses import dataclass, field
+
+import numpy as np
+import torch
+
+YOLOV7_REPO = os.environ.get("YOLOV7_REPO", "/model/repo")
+sys.path.insert(0, YOLOV7_REPO)
+
+from models.experimental import attempt_load  # noqa: E402
+from utils.datasets import letterbox  # noqa: E402
+from utils.general import non_max_suppression, scale_coords  # noqa: E402
+from utils.plots import plot_one_box  # noqa: E402
+
+
+@dataclass
+class Request:
+    image: np.ndarray  # BGR, HWC
+    future: asyncio.Future
+    arrival: float = field(default_factory=time.monotonic)
+
+
+class InferenceEngine:
+    """
+    Keeps one YOLOv7 model in memory and runs the queued images in dynamic micro-batches.
+
+    A batch is sent to the GPU as soon as it holds `max_batch` images or its
+    oldest image has waited `max_latency` seconds, whichever comes first.
+    """
+
+    def __init__(self, weights, img_size=640, conf_thres=0.25, iou_thres=0.45,
+                 max_batch=8, max_latency=0.01, device=None):
+        self.weights = weights
+        self.img_size = img_size
+        self.conf_thres = conf_thres
+        self.iou_thres = iou_thres
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.device = torch.device(device or ("cuda:0" if torch.cuda.is_available() else "cpu"))
+        self.half = self.device.type != "cpu"
+
+        self.model = None
+        self.names = []
+        self.colors = []
+        self.queue = None
+        self.task = None
+
+    # -- lifecycle ----------------------------------------------------------
+    def load(self):
+        model = attempt_load(self.weights, map_location=self.device)
+        stride = int(model.stride.max())
+        self.img_size = int(np.ceil(self.img_size / stride) * stride)
+        if self.half:
+            model.half()
+        model.eval()
+        self.model = model
+        self.names = model.module.names if hasattr(model, "module") else model.names
+        rng = np.random.default_rng(0)
+        self.colors = [[int(c) for c in rng.integers(0, 255, 3)] for _ in self.names]
+
+        # warmup: allocate the kernels / cudnn plans of the largest batch once
+        dummy = torch.zeros(self.max_batch, 3, self.img_size, self.img_size, device=self.device)
+        with torch.no_grad():
+            self.model(dummy.half() if self.half else dummy)
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.load)
+        self.queue = asyncio.Queue()
+        self.task = asyncio.create_task(self._batch_loop())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    # -- requests -----------------------------------------------------------
+    async def infer(self, image):
+        """
+        Returns the detections of one BGR image as (n, 6) [x1, y1, x2, y2, conf, cls] in image pixels
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put(Request(image, future))
+        return await future
+
+    def draw(self, image, det):
+        for *xyxy, conf, cls in det:
+            label = f"{self.names[int(cls)]} {conf:.2f}"
+            plot_one_box(xyxy, image, label=label, color=self.colors[int(cls)], line_thickness=1)
+        return image
+
+    # -- batching -----------------------------------------------------------
+    async def _collect(self):
+        batch = [await self.queue.get()]
+        deadline = batch[0].arrival + self.max_latency
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            try:
+                results = await loop.run_in_executor(None, self._run_batch, [r.image for r in batch])
+            except Exception as e:
+                for r in batch:
+                    if not r.future.done():
+                        r.future.set_exception(e)
+                continue
+            for r, det in zip(batch, results):
+                if not r.future.done():
+                    r.future.set_result(det)
+
+    def _run_batch(self, images):
+        # letterbox to a fixed square so that every image of the batch has the same shape
+        x = np.stack([letterbox(im, self.img_size, auto=False)[0] for im in images])
+        x = np.ascontiguousarray(x[..., ::-1].transpose(0, 3, 1, 2))  # BGR to RGB, BHWC to BCHW
+        x = torch.from_numpy(x).to(self.device, non_blocking=True)
+        x = (x.half() if self.half else x.float()) / 255.0
+
+        with torch.no_grad():
+            pred = self.model(x)[0]
+        pred = non_max_suppression(pred, self.conf_thres, self.iou_thres)
+
+        results = []
+        for im, det in zip(images, pred):
+            if len(det):
+                det[:, :4] = scale_coords(x.shape[2:], det[:, :4], im.shape).round()
+            results.append(det.float().cpu().numpy())
+        return results
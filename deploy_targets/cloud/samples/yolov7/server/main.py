@@ -1,20 +1,45 @@
 # Run app: uvicorn main:app --host 0.0.0.0 --port "${PORT:-8080}" --reload
 
 import asyncio
-import subprocess
+import os
 from pathlib import Path
 
 import aiofiles
+import cv2
 
 from fastapi import FastAPI, UploadFile, File, HTTPException
 from fastapi.responses import FileResponse, HTMLResponse
 from fastapi.staticfiles import StaticFiles
 
+from engine import InferenceEngine
+
 MEDIA_DIR = Path("/tmp/yolov7")
 MEDIA_DIR.mkdir(parents=True, exist_ok=True)
+RESULT_DIR = MEDIA_DIR / "exp"
+RESULT_DIR.mkdir(parents=True, exist_ok=True)
+
+# The model is loaded once, requests are batched together (see engine.py)
+engine = InferenceEngine(
+    weights=os.environ.get("MODEL_WEIGHTS", "/model/yolov7-e6e.pt"),
+    img_size=int(os.environ.get("IMG_SIZE", 640)),
+    conf_thres=float(os.environ.get("CONF_THRES", 0.25)),
+    max_batch=int(os.environ.get("MAX_BATCH", 8)),
+    max_latency=float(os.environ.get("MAX_LATENCY_MS", 10)) / 1000,
+)
 
 app = FastAPI()
 
+
+@app.on_event("startup")
+async def startup():
+    await engine.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await engine.stop()
+
+
 # Mount the static directory at the path "/static"
 STATIC_DIR = Path(__file__).parent / "static"
 app.mount("/static", StaticFiles(directory=str(STATIC_DIR)), name="static")
@@ -43,30 +68,86 @@ async def save_file(temp_dir: Path, file: UploadFile):
     return file_path
 
 
-async def run_inference(file_path: Path, file_ext: str):
-    cmd = [
-        "python",
-        "/model/repo/detect.py",
-        "--weights", "/model/yolov7-e6e.pt",
-        "--conf", "0.25",
-        "--img-size", "640",
-        "--project", MEDIA_DIR,
-        "--exist-ok",
-        "--source", str(file_path),
-    ]
-    process = await asyncio.create_subprocess_exec(
-        *cmd,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE,
-        cwd="/model/repo",
-    )
-    stdout, stderr = await process.communicate()
-    if process.returncode != 0:
-        raise InferenceException(stderr.decode())
-    result_path = file_path.parent.joinpath('exp', file_path.name)
+# cv2 decoding, drawing and encoding block, they run in the default executor
+# so that the event loop keeps accepting requests and feeding the engine
+def load_image(file_path: Path):
+    image = cv2.imread(str(file_path))
+    if image is None:
+        raise InferenceException(f"cannot decode {file_path.name}")
+    return image
+
+
+def save_image(result_path: Path, image, det):
+    cv2.imwrite(str(result_path), engine.draw(image, det))
+
+
+def open_video(file_path: Path, result_path: Path):
+    cap = cv2.VideoCapture(str(file_path))
+    if not cap.isOpened():
+        raise InferenceException(f"cannot open {file_path.name}")
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30
+    w, h = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    writer = cv2.VideoWriter(str(result_path), cv2.VideoWriter_fourcc(*"mp4v"), fps, (w, h))
+    return cap, writer
+
+
+def read_frames(cap, n):
+    frames = []
+    while len(frames) < n:
+        ok, frame = cap.read()
+        if not ok:
+            break
+        frames.append(frame)
+    return frames
+
+
+def write_frames(writer, frames, dets):
+    for frame, det in zip(frames, dets):
+        writer.write(engine.draw(frame, det))
+
+
+def close_video(cap, writer):
+    cap.release()
+    writer.release()
+
+
+async def detect_image(file_path: Path):
+    loop = asyncio.get_running_loop()
+    image = await loop.run_in_executor(None, load_image, file_path)
+    det = await engine.infer(image)
+    result_path = RESULT_DIR / file_path.name
+    await loop.run_in_executor(None, save_image, result_path, image, det)
     return result_path
 
 
+async def detect_video(file_path: Path):
+    loop = asyncio.get_running_loop()
+    result_path = (RESULT_DIR / file_path.name).with_suffix(".mp4")
+    cap, writer = await loop.run_in_executor(None, open_video, file_path, result_path)
+    try:
+        while True:
+            # queue up to max_batch frames at once so that they share a batch
+            frames = await loop.run_in_executor(None, read_frames, cap, engine.max_batch)
+            if not frames:
+                break
+            dets = await asyncio.gather(*(engine.infer(frame) for frame in frames))
+            await loop.run_in_executor(None, write_frames, writer, frames, dets)
+    finally:
+        await loop.run_in_executor(None, close_video, cap, writer)
+    return result_path
+
+
+async def run_inference(file_path: Path, file_ext: str):
+    try:
+        if file_ext == "mp4":
+            return await detect_video(file_path)
+        return await detect_image(file_path)
+    except InferenceException:
+        raise
+    except Exception as e:
+        raise InferenceException(repr(e))
+
+
 @app.post("/image")
 async def process_image(file: UploadFile):
     file_path = await save_file(MEDIA_DIR, file)
@@ -85,8 +166,7 @@ async def process_video(file: UploadFile):
     try:
         result_path = await run_inference(file_path, "mp4")  # Assuming videos are mp4
     except InferenceException as e:
-        err_msg = e.error_message if hasattr(e, e.error_message) else repr(e)
-        raise HTTPException(status_code=500, detail=f"Inference failed: {err_msg}")
+        raise HTTPException(status_code=500, detail=f"Inference failed: {e.error_message}")
     media_url = f"/media/{result_path.name}"
     html_response = f"""
       <video controls autoplay>
@@ -99,4 +179,4 @@ async def process_video(file: UploadFile):
 
 @app.get("/media/{filename}")
 async def read_image(filename: str):
-    return FileResponse(MEDIA_DIR / "exp" / filename)
+    return FileResponse(RESULT_DIR / filename)
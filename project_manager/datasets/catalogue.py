@@ -0,0 +1,320 @@
+"""catalogue module for tango
+Persistent catalogue of the datasets under /shared/datasets.
+
+Listing the datasets used to glob the folder, build thumbnails and walk every
+dataset tree on each request. The catalogue keeps that per-dataset information
+(thumbnail, size, file count, ...) in an on-disk index and a background indexer
+refreshes an entry only when its directory stamp (mtime of the dataset folder
+and of its sub folders) changes, so the list/info endpoints answer in
+O(datasets).
+Attributes:
+
+Todo:
+"""
+
+import os
+import json
+import time
+import threading
+
+CATALOGUE_FILE = ".catalogue.json"  # hidden, so glob("*") on the datasets folder never lists it
+CATALOGUE_VERSION = 2               # 2: thumbnails are URLs of the thumbnail store
+STAMP_DEPTH = 2                     # folder levels whose mtime make up a dataset stamp
+INDEX_INTERVAL = 30                 # seconds between two stamp checks of the indexer
+FULL_RESCAN_INTERVAL = 60 * 60      # seconds, re-walk a dataset even if its stamp did not change
+
+
+def get_dir_stamp(path, depth=STAMP_DEPTH):
+    """
+    Returns the stamp of a folder
+
+    Adding, removing or renaming an entry updates the mtime of its parent
+    folder, so the mtimes of the first folder levels change whenever a dataset
+    gains or loses images, labels or splits.
+
+    Args:
+        path (string): folder path
+        depth (int): number of folder levels to stat
+
+    Returns:
+        list of [relative path, mtime_ns], None if the folder does not exist
+    """
+    try:
+        stamp = [["", os.stat(path).st_mtime_ns]]
+    except OSError:
+        return None
+
+    level = [path]
+    for _ in range(depth):
+        next_level = []
+        for folder in level:
+            try:
+                with os.scandir(folder) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            stamp.append([os.path.relpath(entry.path, path), entry.stat(follow_symlinks=False).st_mtime_ns])
+                            next_level.append(entry.path)
+            except OSError:
+                continue
+        level = next_level
+    return sorted(stamp)
+
+
+def default_placeholder(folder_path):
+    """
+    Returns the name and path of a dataset folder, None if it does not exist
+    """
+    if not os.path.isdir(folder_path):
+        return None
+    return {"name": os.path.basename(folder_path), "path": folder_path}
+
+
+def scan_dir(path):
+    """
+    Returns the total size and the number of files of a folder in one walk
+
+    Args:
+        path (string): folder path
+
+    Returns:
+        (int, int): size in bytes, file count
+    """
+    size, count = 0, 0
+    stack = [path]
+    while stack:
+        folder = stack.pop()
+        try:
+            with os.scandir(folder) as it:
+                for entry in it:
+                    try:
+                        if entry.is_file():
+                            size += entry.stat().st_size
+                            count += 1
+                        elif entry.is_dir():
+                            stack.append(entry.path)
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+    return size, count
+
+
+class DatasetCatalogue:
+    """
+    On-disk index of the dataset folders, kept fresh by a background indexer
+
+    Args:
+        root (string): folder holding one sub folder per dataset
+        describe (callable): folder_path -> dict of the static info of a dataset
+                             (name, path, creation_time, thumbnail, ...)
+        is_busy (callable): folder_path -> True while a dataset is being written
+                            (e.g. downloaded), such datasets are not indexed
+        placeholder (callable): folder_path -> dict of the info of a dataset which
+                                is known without reading it (no thumbnail), served
+                                until the indexer has described the dataset
+    """
+    def __init__(self, root, describe, is_busy=None, placeholder=None):
+        self.root = root
+        self.path = os.path.join(root, CATALOGUE_FILE)
+        self.describe = describe
+        self.is_busy = is_busy or (lambda folder_path: False)
+        self.placeholder = placeholder or default_placeholder
+
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()  # one writer of the index file at a time
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._entries = self._load()
+
+    # ---- persistence ------------------------------------------------------
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                index = json.load(f)
+            if index.get("version") == CATALOGUE_VERSION:
+                return index.get("datasets", {})
+        except (OSError, ValueError):
+            pass
+        return {}
+
+    def _save(self):
+        # the tmp name is unique per process so that the indexers of other
+        # workers never replace the index with a partial file
+        with self._save_lock:
+            with self._lock:
+                index = {"version": CATALOGUE_VERSION, "datasets": dict(self._entries)}
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            try:
+                with open(tmp, "w") as f:
+                    json.dump(index, f)
+                os.replace(tmp, self.path)
+            except OSError as error:
+                print(f"dataset catalogue save error : {error}")
+
+    # ---- lookup -----------------------------------------------------------
+
+    def list_dirs(self):
+        """
+        Returns the dataset folders, sorted by name
+        """
+        try:
+            with os.scandir(self.root) as it:
+                return sorted(entry.path for entry in it if entry.is_dir() and not entry.name.startswith("."))
+        except OSError:
+            return []
+
+    def get(self, folder_path):
+        """
+        Returns the cached entry of a dataset
+
+        A dataset which has not been indexed yet gets a placeholder entry (no
+        thumbnail, size or file count) and the indexer is woken up to describe
+        it, so the dataset is never read inside a request.
+
+        Args:
+            folder_path (string): dataset folder path
+
+        Returns:
+            dict, None if the folder does not exist
+        """
+        key = os.path.basename(folder_path)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and entry.get("path") == folder_path:
+            return dict(entry)
+
+        info = self.placeholder(folder_path)
+        if info is None:
+            return None
+        entry = dict(info, thumbnail=None, size=None, file_count=None, stamp=None, indexed_at=0)
+        with self._lock:
+            current = self._entries.get(key)
+            if current is None or current.get("path") != folder_path:  # unless the indexer got there first
+                self._entries[key] = entry
+        self.wakeup()
+        return dict(entry)
+
+    def owns(self, folder_path):
+        """
+        Returns True if folder_path is a dataset folder of the catalogue
+        """
+        return os.path.dirname(os.path.normpath(folder_path)) == os.path.normpath(self.root)
+
+    def get_size(self, folder_path):
+        """
+        Returns the size of a dataset from the catalogue, None until the indexer has walked it
+        """
+        if not self.owns(folder_path):
+            return scan_dir(folder_path)[0]
+        return self._indexed(folder_path, "size")
+
+    def get_file_count(self, folder_path):
+        """
+        Returns the number of files of a dataset from the catalogue, None until the indexer has walked it
+        """
+        if not self.owns(folder_path):
+            return scan_dir(folder_path)[1]
+        return self._indexed(folder_path, "file_count")
+
+    def _indexed(self, folder_path, key):
+        # never walks the dataset in the request, a missing value is left to the indexer
+        entry = self._entry(folder_path)
+        if entry is None:
+            entry = self.get(folder_path) or {}
+        elif entry.get(key) is None:
+            self.wakeup()
+        return entry.get(key)
+
+    def _entry(self, folder_path):
+        with self._lock:
+            entry = self._entries.get(os.path.basename(folder_path))
+        if entry is None or entry.get("path") != folder_path:
+            return None
+        return entry
+
+    # ---- indexing ---------------------------------------------------------
+
+    def index(self, folder_path, stamp=None):
+        """
+        (Re)builds the entry of a dataset
+
+        Args:
+            folder_path (string): dataset folder path
+            stamp (list): stamp of the folder, computed when not given
+
+        Returns:
+            dict, the new entry ({} if the folder does not exist)
+        """
+        if stamp is None:
+            stamp = get_dir_stamp(folder_path)
+        info = self.describe(folder_path) if stamp is not None else None
+        if info is None:
+            with self._lock:
+                self._entries.pop(os.path.basename(folder_path), None)
+            return {}
+
+        size, file_count = scan_dir(folder_path)
+        entry = dict(info, size=size, file_count=file_count, stamp=stamp, indexed_at=time.time())
+        with self._lock:
+            self._entries[os.path.basename(folder_path)] = entry
+        return dict(entry)
+
+    def refresh(self):
+        """
+        Re-indexes the datasets whose stamp changed and forgets the removed ones
+
+        Returns:
+            int: number of datasets (re)indexed or removed
+        """
+        changed = 0
+        dirs = self.list_dirs()
+        names = set(os.path.basename(d) for d in dirs)
+
+        with self._lock:
+            removed = [name for name in self._entries if name not in names]
+            for name in removed:
+                self._entries.pop(name)
+        changed += len(removed)
+
+        now = time.time()
+        for folder_path in dirs:
+            if self.is_busy(folder_path):
+                continue
+            stamp = get_dir_stamp(folder_path)
+            entry = self._entry(folder_path)
+            if (entry is not None and entry.get("stamp") == stamp
+                    and now - entry.get("indexed_at", 0) < FULL_RESCAN_INTERVAL):
+                continue
+            try:
+                self.index(folder_path, stamp)
+                changed += 1
+            except Exception as error:
+                print(f"dataset catalogue index error : {folder_path}")
+                print(error)
+
+        if changed:
+            self._save()
+        return changed
+
+    def wakeup(self):
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as error:
+                print(f"dataset catalogue indexer error : {error}")
+            self._wakeup.wait(INDEX_INTERVAL)
+            self._wakeup.clear()
+
+    def start(self):
+        """
+        Starts the background indexer (once)
+        """
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="DATASET_CATALOGUE_INDEXER", daemon=True)
+            self._thread.start()
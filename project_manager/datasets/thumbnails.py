@@ -0,0 +1,65 @@
+"""thumbnails module for tango
+Content-addressed store of the dataset preview thumbnails.
+
+A preview is rendered once when the dataset catalogue indexes a dataset and is
+saved under the sha1 of its JPEG bytes. The listing only carries its URL; the
+file itself is served with that digest as ETag and a long max-age, since the
+content of a digest never changes.
+Attributes:
+
+Todo:
+"""
+
+import os
+import hashlib
+
+THUMBNAIL_DIR = ".thumbnails"                   # hidden, so glob("*") on the datasets folder never lists it
+THUMBNAIL_URL = "/api/datasets/thumbnail/{}.jpg"
+THUMBNAIL_MAX_AGE = 60 * 60 * 24 * 365          # seconds, a digest always names the same image
+
+
+class ThumbnailStore:
+    """
+    Folder of <sha1>.jpg files
+
+    Args:
+        root (string): folder under which the thumbnails are saved
+    """
+    def __init__(self, root):
+        self.root = os.path.join(root, THUMBNAIL_DIR)
+
+    def path(self, digest):
+        return os.path.join(self.root, digest + ".jpg")
+
+    def url(self, digest):
+        return THUMBNAIL_URL.format(digest)
+
+    def put(self, jpg_bytes):
+        """
+        Saves a JPEG (once) and returns its digest
+
+        Args:
+            jpg_bytes (bytes): encoded JPEG
+
+        Returns:
+            string: sha1 hex digest of jpg_bytes
+        """
+        digest = hashlib.sha1(jpg_bytes).hexdigest()
+        path = self.path(digest)
+        if not os.path.isfile(path):
+            os.makedirs(self.root, exist_ok=True)
+            tmp = path + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write(jpg_bytes)
+            os.replace(tmp, path)
+        return digest
+
+    def read(self, digest):
+        """
+        Returns the JPEG bytes of a digest, None if unknown
+        """
+        try:
+            with open(self.path(digest), "rb") as f:
+                return f.read()
+        except OSError:
+            return None
@@ -15,6 +15,7 @@ urlpatterns = [
     re_path(r'^get_dataset_info', views.get_dataset_info, name='get_dataset_info'), 
     re_path(r'^get_folders_size', views.get_folders_size, name='get_folders_size'), 
     re_path(r'^get_folders_file_count', views.get_folders_file_count, name='get_folders_file_count'), 
+    re_path(r'^thumbnail/(?P<digest>[0-9a-f]{40})\.jpg$', views.get_thumbnail, name='get_thumbnail'), 
 
     re_path(r'^download_coco', views.download_coco, name='download_coco'), 
     re_path(r'^download_imagenet', views.download_imagenet, name='download_imagenet'), 
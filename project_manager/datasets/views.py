@@ -21,9 +21,17 @@ import zipfile
 import shutil
 
 from .enums import DATASET_STATUS
+from .catalogue import DatasetCatalogue
+from .thumbnails import ThumbnailStore, THUMBNAIL_MAX_AGE
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 root_path = os.path.dirname(os.path.dirname(BASE_DIR))
+DATASETS_ROOT = os.path.join(root_path, "shared/datasets")
+
+THUMBNAIL_COUNT = 4          # 미리보기에 이어 붙일 이미지 수
+THUMBNAIL_MAX_ERRORS = 16    # 이 이상 읽기에 실패하면 thumbnail 생성 포기
+
+thumbnail_store = ThumbnailStore(DATASETS_ROOT)
 
 RUN_COCO_THREAD="RUN_COCO_THREAD"
 RUN_IMAGENET_THREAD="RUN_IMAGENET_THREAD"
@@ -73,23 +81,12 @@ def get_dataset_list(request):
     """
 
     try:
-        path = os.path.join(root_path, "shared/datasets/*")
-        dir_list = glob.glob(path)
-
-        dataset_dir_list = []        
-        for dir_path in dir_list:
-            name = os.path.basename(dir_path)
-            if name != '*' :
-                dataset_dir_list.append(dir_path)
-
+        # thumbnail, size 등은 dataset_catalogue에 캐시되어 있으므로 폴더 목록만 확인
         dir_info_list = []
-        with ThreadPoolExecutor() as executor:
-            futures = [executor.submit(get_folder_info, dir_path) for dir_path in dataset_dir_list]
-            
-            for future in as_completed(futures):
-                result = future.result()
-                if result != None :
-                    dir_info_list.append(result)
+        for dir_path in dataset_catalogue.list_dirs():
+            result = get_folder_info(dir_path)
+            if result != None :
+                dir_info_list.append(result)
 
         dir_info_list = sorted(dir_info_list, key= lambda x: x["name"])
         return HttpResponse(json.dumps({'status': 200, 'datasets': dir_info_list }))
@@ -118,17 +115,12 @@ def get_dataset_info(request):
 
         print("dataset_name : " + str(dataset_name))
 
-        path = os.path.join(root_path, "shared/datasets/*")
-        dir_list = glob.glob(path)
-
         dataset_info = None
 
-        for dir_path in dir_list:
-            name = os.path.basename(dir_path)
-            if name ==  dataset_name:
-                print("dir_path : " + str(dir_path))
-                dataset_info = get_folder_info(dir_path)
-                break
+        dir_path = os.path.join(DATASETS_ROOT, os.path.basename(dataset_name))
+        if os.path.basename(dataset_name) and os.path.isdir(dir_path):
+            print("dir_path : " + str(dir_path))
+            dataset_info = get_folder_info(dir_path)
 
         return HttpResponse(json.dumps({'status': 200, 'dataset': dataset_info }))
     except Exception as e:
@@ -141,9 +133,7 @@ def get_folders_size(request):
     try:
         folder_list = request.data['folder_list']
 
-        num_processes = multiprocessing.cpu_count()
-        with multiprocessing.Pool(processes=num_processes) as pool:
-            results = pool.map(get_dir_size_handler, folder_list)
+        results = [get_dir_size_handler(folder_path) for folder_path in folder_list]
 
         return HttpResponse(json.dumps({'status': 200, 'datas': results }))
     except Exception as e:
@@ -156,9 +146,7 @@ def get_folders_file_count(request):
     try:
         folder_list = request.data['folder_list']
 
-        num_processes = multiprocessing.cpu_count()
-        with multiprocessing.Pool(processes=num_processes) as pool:
-            results = pool.map(get_file_count, folder_list)
+        results = [{"folder_path": folder_path, "count": dataset_catalogue.get_file_count(folder_path)} for folder_path in folder_list]
 
         return HttpResponse(json.dumps({'status': 200, 'datas': results }))
     except Exception as e:
@@ -168,14 +156,36 @@ def get_folders_file_count(request):
 
 def get_folder_info(folder_path):
     """
-    Returns the folder info
+    Returns the folder info, from the dataset catalogue
 
     Args:
         folder_path (string): folder_path
 
     Returns:
         folder name, folder path, folder size, folder creation_time, 
-        folder last_modified_time, file_count, thumbnail
+        file_count, thumbnail, status
+    """
+    entry = dataset_catalogue.get(folder_path)
+    if entry is None:
+        print("유효한 폴더 경로가 아닙니다.")
+        return None
+
+    folder_info = {key: entry[key] for key in ('name', 'path', 'creation_time', 'thumbnail', 'size', 'file_count') if key in entry}
+    # 다운로드 상태는 쓰레드 상태에 따라 바뀌므로 캐시하지 않음
+    folder_info['status'] = check_dataset_status(folder_info)
+    return folder_info
+
+def describe_folder(folder_path, thumbnail=True):
+    """
+    Returns the folder info kept in the dataset catalogue
+
+    Args:
+        folder_path (string): folder_path
+        thumbnail (bool): False for the placeholder served until the indexer
+                          has described the folder (the images are not read)
+
+    Returns:
+        folder name, folder path, folder creation_time, thumbnail
     """
     folder_info = {}
 
@@ -187,18 +197,28 @@ def get_folder_info(folder_path):
         folder_info['creation_time'] = get_folder_creation_date(folder_path)
         # folder_info['last_modified_time'] = get_folder_last_modified_date(folder_path)
         # folder_info['file_count'] = get_file_count(folder_path) # 계산하는데 시간이 오래걸려 따로 수행..
-        folder_info['thumbnail'] = get_folder_thumbnail(folder_path)
+        folder_info['thumbnail'] = get_folder_thumbnail(folder_path) if thumbnail else None
         # folder_info['isDownload'] = is_download_complete_dataset(folder_path)
-        folder_info['status'] = check_dataset_status(folder_info)
         
     else:
-        print("유효한 폴더 경로가 아닙니다.")
         return None
 
     return folder_info
 
+def is_downloading_dataset(folder_path):
+    """
+    Returns True while a common dataset is being downloaded into folder_path
+    """
+    name = os.path.basename(folder_path)
+    common_dataset = next((common_dataset for common_dataset in COMMON_DATASET_INFO.values() if common_dataset["name"] == name), None)
+    return common_dataset != None and is_thread_name_active(common_dataset["thread_name"])
+
+# /shared/datasets 하위 dataset 정보 캐시 (dataset_start_scirpt에서 indexer 시작)
+dataset_catalogue = DatasetCatalogue(DATASETS_ROOT, describe_folder, is_busy=is_downloading_dataset,
+                                     placeholder=lambda folder_path: describe_folder(folder_path, thumbnail=False))
+
 def get_dir_size_handler(path):
-    return {"folder_path": path, "size": get_dir_size(path)}
+    return {"folder_path": path, "size": dataset_catalogue.get_size(path)}
 
 def get_dir_size(path='.'):
     total = 0
@@ -273,45 +293,20 @@ def get_file_count(folder_path):
 
 def get_folder_thumbnail(folder_path):
     """
-    Create thumbnails after randomly extracting 4 images from a folder
+    Create thumbnails after extracting 4 images from a folder
 
     Args:
         folder_path (string): Image folder path
 
     Returns:
-        Returns Thumbnails to base64
-    """
-
-    # file_list = []
-
-    # # get image path in folder
-    # for path, dirs, files in os.walk(folder_path):
-    #     images = [ fi for fi in files if str(fi).lower().endswith(('.jpg','.jpeg', '.png',)) ]
-    #     for image in images:
-    #         file_list.append(os.path.join(path, image))
-    #         if len(file_list)>4:
-    #             break
-    #     if len(file_list)>4:
-    #         break
-
-    # # random choice
-    # if len(file_list) >= 4:
-    #     # random_images = random.sample(file_list,4) if len(file_list) >= 4  else random.sample(file_list, len(file_list))
-    #     random_images = file_list[0:4]
-    #     thumbnail_list = []
-    #     for image in random_images:
-    #         try:
-    #             thumbnail = make_image_thumbnail(image)
-    #             thumbnail_list.append(thumbnail)
-    #         except Exception:
-    #             print("thumbnail error")
-
-    # get image path in folder
+        Returns the URL of the thumbnail in the thumbnail store
+    """
 
     thumbnail_list = []
     error_count = 0
     for path, dirs, files in os.walk(folder_path):
-        images = [ fi for fi in files if str(fi).lower().endswith(('.jpg','.jpeg', '.png',)) ]
+        dirs.sort()
+        images = sorted( fi for fi in files if str(fi).lower().endswith(('.jpg','.jpeg', '.png',)) )
         for image in images:
             try:
                 thumbnail = make_image_thumbnail(os.path.join(path, image))
@@ -322,14 +317,14 @@ def get_folder_thumbnail(folder_path):
                 print("=====================================================")
 
                 error_count += 1
-                if error_count > 1000:
+                if error_count >= THUMBNAIL_MAX_ERRORS:
                     return None
                 else:
                     continue
 
-            if len(thumbnail_list)>=4:
+            if len(thumbnail_list)>=THUMBNAIL_COUNT:
                 break
-        if len(thumbnail_list)>=4:
+        if len(thumbnail_list)>=THUMBNAIL_COUNT:
             break
 
     if len(thumbnail_list) <= 0:
@@ -339,7 +334,8 @@ def get_folder_thumbnail(folder_path):
     try:
         thumb = cv2.hconcat(thumbnail_list)
         jpg_img = cv2.imencode('.jpg', thumb)
-        return "data:image/jpg;base64," + str(base64.b64encode(jpg_img[1]).decode('utf-8'))
+        digest = thumbnail_store.put(jpg_img[1].tobytes())
+        return thumbnail_store.url(digest)
     
     except Exception as error:
         print(f" get_folder_thumbnail error : {folder_path}\n")
@@ -358,7 +354,8 @@ def make_image_thumbnail(path):
     """
 
     maxsize = (128, 128) 
-    img = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    # 1/4 크기로 decode (JPEG은 decode 단계에서 축소되어 원본 전체를 풀지 않음), 채널 수도 3으로 통일
+    img = cv2.imread(path, cv2.IMREAD_REDUCED_COLOR_4)
 
     if img is None:
         raise Exception("Image file not found in path.")
@@ -367,6 +364,31 @@ def make_image_thumbnail(path):
 
     return thumbnail
 
+@api_view(['GET'])
+@permission_classes([AllowAny])   # <img src>로 요청되므로 토큰 없음 (digest를 알아야 접근 가능)
+def get_thumbnail(request, digest):
+    """
+    Serves a thumbnail of the thumbnail store
+
+    Args:
+        request (HttpRequest): request
+        digest (string): sha1 of the thumbnail
+
+    Returns:
+        image/jpeg, 304 if the client already has it
+    """
+    etag = f'"{digest}"'
+    if etag in request.headers.get('If-None-Match', ''):
+        response = HttpResponse(status=304)
+    else:
+        jpg = thumbnail_store.read(digest)
+        if jpg is None:
+            return HttpResponse(status=404)
+        response = HttpResponse(jpg, content_type='image/jpeg')
+    response['ETag'] = etag
+    response['Cache-Control'] = f'public, max-age={THUMBNAIL_MAX_AGE}, immutable'
+    return response
+
 #endregion
 
 #region Dataset Download .................................................................................
@@ -706,6 +728,7 @@ def create_folder_if_not_exists(path):
 def dataset_start_scirpt():
     for common_dataset in COMMON_DATASET_INFO.values():
         create_folder_if_not_exists(common_dataset["path"])
+    dataset_catalogue.start()
 
 def is_thread_name_active(name):
     """
@@ -100,6 +100,32 @@ export async function postStatusRequest(data) {
   return response.data;
 }
 
+/* 컨테이너 상태 / Auto NN 업데이트 스트림 (SSE) */
+const STATUS_STREAM_MAX_ERRORS = 3;
+
+export function openStatusStream(user_id, project_id, { onOpen, onContainer, onAutonn, onError } = {}) {
+  const baseURL = process.env.NODE_ENV === "production" ? "" : process.env.VUE_APP_ROOT_API;
+  const params = new URLSearchParams({ user_id: user_id, project_id: project_id });
+  const source = new EventSource(`${baseURL}/api/status_stream?${params.toString()}`);
+
+  let errors = 0;
+  source.onopen = () => {
+    errors = 0;
+    onOpen?.();
+  };
+  source.addEventListener("container", e => onContainer?.(JSON.parse(e.data)));
+  source.addEventListener("autonn", e => onAutonn?.(JSON.parse(e.data)));
+  source.onerror = error => {
+    // 일시적인 끊김은 브라우저가 자동으로 재연결, 재연결을 포기했거나 계속 실패할 때만 polling으로 전환
+    errors += 1;
+    if (source.readyState !== EventSource.CLOSED && errors < STATUS_STREAM_MAX_ERRORS) return;
+    source.close();
+    onError?.(error);
+  };
+
+  return source;
+}
+
 /* 컨테이너 상태 요청 */
 /**
  * user_id , project_id , container_id
@@ -1,11 +1,12 @@
 import os
 import requests
-import docker
 # import zipfile
 import shutil
 import json
 import textwrap
 
+from .service.docker_log_tailer import log_tailer
+
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 root_path = os.path.dirname(os.path.dirname(BASE_DIR))
 
@@ -96,30 +97,24 @@ def call_container_api(host, path, user_id, project_id):
 
 #region Get Docker Logs ...............................................................................................
 
-def get_docker_log_handler(container, last_logs_timestamp):
+def get_docker_log_handler(container, last_logs_timestamp, project_id=None):
     """
     Docker-compose log Get function
 
     Args:
         container : container
         last_logs_timestamp(int) : Finally, the time stamp that received the docker log
+        project_id : when given, the log is read from the background log tailer,
+                     continuing where this project's previous read stopped
 
     Returns:
         docker log
     """
 
-    client = docker.from_env()
     dockerContainerName = CONTAINER_INFO[container].docker_name
-    containerList = client.containers.list()
-    container = next(item for item in containerList if dockerContainerName in str(item.name))
-    logs = ''
-    if int(last_logs_timestamp) == 0:
-        logs = container.logs(timestamps = True)
-    else:
-        logs = container.logs(timestamps = True, since = int(last_logs_timestamp))
-    if logs == None:
-        return ''
-    return logs.decode('utf-8')
+    if project_id is not None:
+        return log_tailer.read(project_id, dockerContainerName, last_logs_timestamp)
+    return log_tailer.read_from_docker(dockerContainerName, last_logs_timestamp)
 #endregion
 
 #region Get Container Info ............................................................................................
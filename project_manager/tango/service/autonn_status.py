@@ -1,5 +1,6 @@
 import json
 
+from django.db import transaction
 from django.db.models import Model
 
 from ..models import Project, AutonnStatus, TrainLossLastStep, ValAccuracyLastStep, EpochSummary
@@ -166,3 +167,171 @@ def update_autonn_status(body):
             create_last_step(TrainLossLastStep, body['update_content'], body['project_id'])
 
 
+
+# bulk updates -----------------------------------------------------------------
+# AutonnStatus foreign key holding the row each update id overwrites
+bulk_update_fields = {
+    autonn_update_ids["hyperparameter"] : "hyperparameter",
+    autonn_update_ids["arguments"] : "arguments",
+    autonn_update_ids["system"] : "system",
+    autonn_update_ids["basemodel"] : "basemodel",
+    autonn_update_ids["model_summary"] : "model_summary",
+    autonn_update_ids["batchsize"] : "batch_size",
+    autonn_update_ids["train_dataset"] : "train_dataset",
+    autonn_update_ids["val_dataset"] : "val_dataset",
+    autonn_update_ids["anchors"] : "anchor",
+    autonn_update_ids["train_start"] : "train_start",
+    autonn_update_ids["train_loss"] : "train_loss_latest",
+    autonn_update_ids["val_accuracy"] : "val_accuracy_latest",
+}
+
+def normalize_update_content(update_id, data):
+    """
+    Rename autonn keys to model fields, the same way update_autonn_status() does
+    """
+    if update_id == autonn_update_ids["system"]:
+        gpus = [data[key] for key in data.keys() if str(key).isdigit()]
+        return {"torch": data["torch"], "cuda": data["cuda"], "cudnn": data["cudnn"], "gpus": json.dumps(gpus)}
+    if update_id == autonn_update_ids["model_summary"] and 'FLOPS' in data:
+        data["flops"] = data.pop("FLOPS")
+    elif update_id == autonn_update_ids["epoch_summary"] and 'total_time' in data:
+        data['total_time'] = float(data['total_time']) * 3600
+    elif update_id == autonn_update_ids["val_accuracy"]:
+        if 'class' in data:
+            data['class_type'] = data.pop('class')
+        if 'mAP50-95' in data:
+            data['mAP50_95'] = data.pop('mAP50-95')
+    return data
+
+def concrete_fields(instance, data):
+    names = {f.attname for f in instance._meta.concrete_fields if not f.primary_key}
+    return [key for key in data.keys() if key in names]
+
+def update_autonn_status_bulk(bodies):
+    """
+    Apply a list of autonn status updates in one transaction
+
+    AutonnStatus rows and their related rows are loaded once per batch
+    (select_related) and written back with one bulk_update() per model;
+    last-step and epoch summary rows are inserted with bulk_create().
+    When the batch transaction fails, e.g. on a value a column rejects,
+    the updates are applied again one by one, each in its own savepoint,
+    so only the bad ones are lost.
+
+    Returns:
+        list of {"index", "update_id", "result"[, "error"]}, one per update
+
+    Raises:
+        the database error when no update could be applied at all; the
+        caller answers with a 5xx then and the reporter resends
+    """
+    results = [None] * len(bodies)
+    staged = stage_autonn_status_updates(bodies, range(len(bodies)), results)
+    try:
+        with transaction.atomic():
+            write_autonn_status_updates(*staged)
+        return results
+    except Exception as error:
+        print("autonn_status bulk 업데이트 오류, 하나씩 다시 적용.............")
+        print(error)
+        batch_error = error
+
+    applied = 0
+    for index, result in enumerate(results):
+        if result["result"] != "ok":
+            continue
+        try:
+            with transaction.atomic():
+                write_autonn_status_updates(*stage_autonn_status_updates(bodies, [index], results))
+            applied += results[index]["result"] == "ok"
+        except Exception as error:
+            results[index] = {"index": index, "update_id": result["update_id"], "result": "error", "error": str(error)}
+    if not applied and any(result["result"] == "error" for result in results):
+        raise batch_error
+    return results
+
+def stage_autonn_status_updates(bodies, indices, results):
+    """
+    Apply bodies[i] for i in indices to freshly loaded rows, without saving them
+
+    Sets results[i] for each of them and returns (by_model, created) for
+    write_autonn_status_updates()
+    """
+    bodies_to_stage = [bodies[index] for index in indices]
+    project_ids = {str(body.get("project_id")) for body in bodies_to_stage if isinstance(body, dict)}
+    statuses = {}
+    for autonn_status_info in AutonnStatus.objects.select_related("project", *bulk_update_fields.values()) \
+                                                   .filter(project__in=[pid for pid in project_ids if pid.isdigit()]):
+        statuses.setdefault(str(autonn_status_info.project_id), autonn_status_info)
+
+    dirty = {}      # (model class, pk): (instance, set of changed fields)
+    created = {}    # model class: [new rows]
+
+    def mark(instance, fields):
+        _, changed = dirty.setdefault((type(instance), instance.pk), (instance, set()))
+        changed.update(fields)
+
+    for index in indices:
+        body = bodies[index]
+        update_id = body.get("update_id") if isinstance(body, dict) else None
+        try:
+            autonn_status_info = statuses.get(str(body.get("project_id")))
+            if autonn_status_info is None:
+                raise ValueError("AutonnStatus를 찾을 수 없음")
+
+            if update_id in autonn_process:
+                autonn_status_info.progress = autonn_process[update_id]
+                mark(autonn_status_info, ["progress"])
+
+            if update_id not in bulk_update_fields and update_id != autonn_update_ids["epoch_summary"]:
+                # progress-only updates (train_end, nas_start, ...) changed the progress above
+                result = "ok" if update_id in autonn_process else "ignored"
+                results[index] = {"index": index, "update_id": update_id, "result": result}
+                continue
+
+            data = normalize_update_content(update_id, json.loads(body["update_content"]))
+            project_info = autonn_status_info.project
+
+            if update_id == autonn_update_ids["epoch_summary"]:
+                epoch_summary = EpochSummary()
+                for key, value in data.items():
+                    setattr(epoch_summary, key, value)
+                epoch_summary.project_id = project_info.id
+                epoch_summary.project_version = project_info.version
+                created.setdefault(EpochSummary, []).append(epoch_summary)
+                # EPOCH 완료 시 autonn_retry_count 초기화
+                project_info.autonn_retry_count = 0
+                mark(project_info, ["autonn_retry_count"])
+            else:
+                instance = getattr(autonn_status_info, bulk_update_fields[update_id])
+                for key, value in data.items():
+                    setattr(instance, key, value)
+                mark(instance, concrete_fields(instance, data))
+
+                last_step_class = {autonn_update_ids["train_loss"]: TrainLossLastStep,
+                                   autonn_update_ids["val_accuracy"]: ValAccuracyLastStep}.get(update_id)
+                if last_step_class and "step" in data and int(data["step"]) == int(data["total_step"]):
+                    last_step = last_step_class()
+                    for key, value in data.items():
+                        setattr(last_step, key, value)
+                    last_step.project_id = project_info.id
+                    last_step.project_version = project_info.version
+                    created.setdefault(last_step_class, []).append(last_step)
+
+            results[index] = {"index": index, "update_id": update_id, "result": "ok"}
+        except Exception as error:
+            results[index] = {"index": index, "update_id": update_id, "result": "error", "error": str(error)}
+
+    by_model = {}
+    for (model_class, _), (instance, fields) in dirty.items():
+        entry = by_model.setdefault(model_class, ([], set()))
+        entry[0].append(instance)
+        entry[1].update(fields)
+    return by_model, created
+
+def write_autonn_status_updates(by_model, created):
+    for model_class, (instances, fields) in by_model.items():
+        if fields:
+            model_class.objects.bulk_update(instances, list(fields))
+    for model_class, rows in created.items():
+        model_class.objects.bulk_create(rows)
@@ -0,0 +1,231 @@
+"""docker_log_tailer module for tango
+Follows the docker logs of the task containers in the background.
+
+One docker client is kept for the whole process and each container's log
+stream is followed by a daemon thread into an in-memory ring buffer.
+status_request then reads what a project has not seen yet with a byte
+offset, instead of asking the docker API for every poll. Lines carry their
+docker timestamp, so the lines of an overlapping second (docker 'since' has
+a granularity of seconds) are dropped instead of being returned twice.
+Attributes:
+
+Todo:
+"""
+
+import calendar
+import threading
+import time
+
+import docker
+
+LOG_BUFFER_SIZE = 4 * 1024 * 1024   # bytes kept per container
+RECONNECT_INTERVAL = 3              # seconds to wait before following a restarted log stream again
+
+
+def docker_timestamp(line):
+    """
+    Returns the docker timestamp (RFC 3339, UTC) of a log line in nanoseconds, None if it has none
+    """
+    stamp = line.split(b' ', 1)[0]
+    try:
+        seconds, _, fraction = stamp.decode('ascii').rstrip('Z').partition('.')
+        return calendar.timegm(time.strptime(seconds, '%Y-%m-%dT%H:%M:%S')) * 10**9 + int(fraction[:9].ljust(9, '0'))
+    except (UnicodeDecodeError, ValueError):
+        return None
+
+
+def drop_seen(data, last_ts):
+    """
+    Drops the lines of data at or before the docker timestamp last_ts
+
+    Returns:
+        (kept bytes, timestamp of the last kept line or last_ts)
+    """
+    kept = []
+    for line in data.splitlines(keepends=True):
+        ts = docker_timestamp(line)
+        if ts is not None:
+            if last_ts is not None and ts <= last_ts:
+                continue
+            last_ts = ts
+        kept.append(line)
+    return b''.join(kept), last_ts
+
+
+class LogRingBuffer:
+    """
+    Bounded byte buffer addressed by absolute offsets (bytes ever written)
+    """
+    def __init__(self, size=LOG_BUFFER_SIZE):
+        self.size = size
+        self._buf = bytearray()
+        self._start = 0     # absolute offset of _buf[0]
+        self._lock = threading.Lock()
+
+    @property
+    def end(self):
+        with self._lock:
+            return self._start + len(self._buf)
+
+    def write(self, data):
+        with self._lock:
+            self._buf += data
+            excess = len(self._buf) - self.size
+            if excess > 0:
+                del self._buf[:excess]
+                self._start += excess
+
+    def read(self, offset):
+        """
+        Returns (bytes from offset, new offset, bytes skipped because they were overwritten)
+        """
+        with self._lock:
+            skipped = max(0, self._start - offset)
+            offset = max(offset, self._start)
+            data = bytes(self._buf[offset - self._start:])
+            return data, self._start + len(self._buf), skipped
+
+
+class ContainerLogFollower:
+    """
+    Daemon thread streaming one container's log into a LogRingBuffer
+    """
+    def __init__(self, tailer, docker_name, since=None):
+        self.tailer = tailer
+        self.docker_name = docker_name
+        self.buffer = LogRingBuffer()
+        self.since = since      # docker 'since' of the first stream, None for the whole log
+        self.last_ts = None     # docker timestamp (ns) of the last line written to the buffer
+        self._partial = b''     # incomplete last line of the stream
+        self._thread = None
+        self.start()
+
+    @property
+    def alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        # (re)start following, the buffer keeps what was read before the container exited
+        self._thread = threading.Thread(target=self._run, name=f"log-{self.docker_name}", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                container = self.tailer.get_container(self.docker_name)
+                if container is None:
+                    break
+                # resume from the second of the last line, its lines already read are dropped
+                since = self.since if self.last_ts is None else self.last_ts // 10**9
+                self._partial = b''
+                for chunk in container.logs(stream=True, follow=True, timestamps=True, since=since):
+                    self.write(chunk)
+                # the stream ends when the container stops, follow again only if it is still running
+                container.reload()
+                if container.status != "running":
+                    break
+            except Exception as error:
+                self.tailer.forget_container(self.docker_name)
+                print(f"docker log follower ({self.docker_name}) - {error}")
+            time.sleep(RECONNECT_INTERVAL)
+        # the container has exited, a later read() follows it again
+        self.tailer.forget_container(self.docker_name)
+
+    def write(self, chunk):
+        # only whole lines go to the buffer, so that each one can be matched by its timestamp
+        lines = (self._partial + chunk).split(b'\n')
+        self._partial = lines.pop()
+        data, self.last_ts = drop_seen(b''.join(line + b'\n' for line in lines), self.last_ts)
+        if data:
+            self.buffer.write(data)
+
+
+class DockerLogTailer:
+    """
+    Long-lived docker client, cached container handles and one follower per container.
+    Each project keeps its own read offset into the follower of the container it watches.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._client = None
+        self._containers = {}   # docker name: docker Container
+        self._followers = {}    # docker name: ContainerLogFollower
+        self._cursors = {}      # project_id: (docker name, offset, docker timestamp of the last line read)
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                self._client = docker.from_env()
+            return self._client
+
+    def get_container(self, docker_name):
+        with self._lock:
+            container = self._containers.get(docker_name)
+        if container is None:
+            container = next((item for item in self.client.containers.list() if docker_name in str(item.name)), None)
+            if container is not None:
+                with self._lock:
+                    self._containers[docker_name] = container
+        return container
+
+    def forget_container(self, docker_name):
+        with self._lock:
+            self._containers.pop(docker_name, None)
+
+    def follower(self, docker_name, since=None):
+        with self._lock:
+            follower = self._followers.get(docker_name)
+            if follower is None:
+                follower = self._followers[docker_name] = ContainerLogFollower(self, docker_name, since)
+            elif not follower.alive:
+                follower.start()
+            return follower
+
+    def read(self, project_id, docker_name, last_logs_timestamp):
+        """
+        Returns the log of docker_name the project has not read yet.
+        The first read of a project (or after it switched containers) falls back to
+        the docker API with last_logs_timestamp, later reads come from memory,
+        without the lines at or before the last one already returned.
+        """
+        since = int(last_logs_timestamp) or None
+        follower = self.follower(docker_name, since)
+        with self._lock:
+            cursor = self._cursors.get(str(project_id))
+
+        if cursor is None or cursor[0] != docker_name:
+            offset = follower.buffer.end
+            logs = self.read_from_docker(docker_name, last_logs_timestamp)
+            _, last_ts = drop_seen(logs.encode('utf-8'), None)
+            with self._lock:
+                self._cursors[str(project_id)] = (docker_name, offset, last_ts)
+            return logs
+
+        data, offset, skipped = follower.buffer.read(cursor[1])
+        data, last_ts = drop_seen(data, cursor[2])
+        with self._lock:
+            self._cursors[str(project_id)] = (docker_name, offset, last_ts)
+        logs = data.decode('utf-8', errors='replace')
+        if skipped:
+            logs = f"... ({skipped} bytes of log skipped)\n" + logs
+        return logs
+
+    def read_from_docker(self, docker_name, last_logs_timestamp):
+        try:
+            container = self.get_container(docker_name)
+            if container is None:
+                return ''
+            if int(last_logs_timestamp) == 0:
+                logs = container.logs(timestamps = True)
+            else:
+                logs = container.logs(timestamps = True, since = int(last_logs_timestamp))
+        except docker.errors.NotFound:
+            self.forget_container(docker_name)
+            raise
+        if logs == None:
+            return ''
+        return logs.decode('utf-8')
+
+
+log_tailer = DockerLogTailer()
@@ -0,0 +1,112 @@
+"""status_stream module for tango
+In-process fan-out of container status and AutoNN updates to the dashboard.
+
+Containers already push their progress to P.M. (status_report, status_update);
+this module relays each of those pushes to every client subscribed to the
+project through a server-sent event (SSE) stream, so the dashboard does not
+have to poll status_request to notice them.
+Attributes:
+
+Todo:
+"""
+
+import json
+import queue
+import threading
+
+SUBSCRIBER_QUEUE_SIZE = 256     # events kept for a slow client, the oldest are dropped first
+HEARTBEAT_INTERVAL = 15         # seconds, keeps proxies from closing an idle stream
+
+
+class StatusBroker:
+    """
+    Per-project publish/subscribe hub, one queue per connected client
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}  # project_id: set of queue.Queue
+
+    def subscribe(self, project_id):
+        q = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.setdefault(str(project_id), set()).add(q)
+        return q
+
+    def unsubscribe(self, project_id, q):
+        with self._lock:
+            subscribers = self._subscribers.get(str(project_id))
+            if subscribers is not None:
+                subscribers.discard(q)
+                if not subscribers:
+                    self._subscribers.pop(str(project_id), None)
+
+    def publish(self, project_id, event, data):
+        with self._lock:
+            subscribers = list(self._subscribers.get(str(project_id), ()))
+        for q in subscribers:
+            while True:
+                try:
+                    q.put_nowait((event, data))
+                    break
+                except queue.Full:
+                    try:
+                        q.get_nowait()  # drop the oldest event of a client which does not keep up
+                    except queue.Empty:
+                        pass
+
+
+broker = StatusBroker()
+
+
+def publish_container_status(project_info):
+    """
+    Notify subscribers of a project's current container and its status
+    """
+    try:
+        broker.publish(project_info.id, "container", {
+            "container": project_info.container,
+            "container_status": project_info.container_status,
+        })
+    except Exception as error:
+        print("status_stream publish error")
+        print(error)
+
+
+def publish_autonn_update(body):
+    """
+    Notify subscribers of one AutoNN status_update body
+    """
+    try:
+        content = body.get("update_content")
+        if isinstance(content, str):
+            content = json.loads(content)
+        broker.publish(body["project_id"], "autonn", {
+            "update_id": body.get("update_id"),
+            "update_content": content,
+        })
+    except Exception as error:
+        print("status_stream publish error")
+        print(error)
+
+
+def sse_format(event, data):
+    return "event: " + event + "\ndata: " + json.dumps(data, default=str) + "\n\n"
+
+
+def event_stream(project_id, snapshot):
+    """
+    Generator for a StreamingHttpResponse: the current snapshot first, then every published event
+    """
+    q = broker.subscribe(project_id)
+    try:
+        yield sse_format("container", snapshot)
+        while True:
+            try:
+                event, data = q.get(timeout=HEARTBEAT_INTERVAL)
+            except queue.Empty:
+                yield ": keep-alive\n\n"
+                continue
+            yield sse_format(event, data)
+    finally:
+        # the server closes the generator when the client goes away
+        broker.unsubscribe(project_id, q)
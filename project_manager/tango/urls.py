@@ -44,6 +44,7 @@ urlpatterns = [
     re_path(r'^container_start', viewsProject.container_start, name='container_start'),       # 컨테이너 실행
     re_path(r'^next_pipeline_start', viewsProject.next_pipeline_start, name='next_pipeline_start'),       # 다음 버전의 파이프라인을 실행 (CI/CD pipeline 반복 기능)
     re_path(r'^status_request', viewsProject.status_request, name='status_request'),       # 컨테이너 실행 상태 확인 요청
+    re_path(r'^status_stream', viewsProject.status_stream, name='status_stream'),          # 컨테이너 실행 상태 / Auto NN 업데이트 스트림 (SSE)
 
     re_path(r'^download_nn_model', viewsProject.download_nn_model, name='download_nn_model'), # nn_model 다운로드(외부IDE연동)
     re_path(r'^upload_nn_model', viewsProject.upload_nn_model, name='upload_nn_model'),       # nn_model 업로드(외부IDE연동)
@@ -12,6 +12,7 @@ from . import viewsProject
 
 urlpatterns = [
     re_path(r'^status_report', viewsProject.status_report, name='status_report'),  # 컨테이너 상태 값 반환
+    re_path(r'^status_update_bulk', viewsProject.status_update_bulk, name='status_update_bulk'),  # 컨테이너 Auto NN 업데이트 묶음
     re_path(r'^status_update', viewsProject.status_update, name='status_update'),       # 컨테이너 Auto NN 업데이트
 ]
 
@@ -13,7 +13,7 @@ import shutil
 from datetime import datetime
 import time
 
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from rest_framework.permissions import AllowAny
 
 from rest_framework.response import Response
@@ -31,7 +31,8 @@ from . import models
 from .projectHandler import *
 from targets.views import target_to_response
 
-from .service.autonn_status import update_autonn_status
+from .service.autonn_status import update_autonn_status, update_autonn_status_bulk
+from .service.status_stream import event_stream, publish_container_status, publish_autonn_update
 
 from .enums import ContainerId, ContainerStatus, LearningType
 
@@ -361,6 +362,7 @@ def container_start(request):
         project_info.container = container_id
         project_info.container_status = ContainerStatus.STARTED
         project_info.save()
+        publish_container_status(project_info)
         return HttpResponse(json.dumps({'status': 200, 'message': str(container_id) + ' 시작 요청\n', 'response' : log}))
     except Project.DoesNotExist:
         print(f"project_id : {project_id}를 찾을 수 없음.")
@@ -423,9 +425,9 @@ def status_request(request):
         
         # docker의 log를 가져옴
         if container_id != ContainerId.imagedeploy:
-            logs = get_docker_log_handler(project_info.container, project_info.last_logs_timestamp)
+            logs = get_docker_log_handler(project_info.container, project_info.last_logs_timestamp, project_id)
         else:
-            logs = get_docker_log_handler(get_deploy_container(project_info.target.target_info), project_info.last_logs_timestamp)
+            logs = get_docker_log_handler(get_deploy_container(project_info.target.target_info), project_info.last_logs_timestamp, project_id)
         
         # log를 가지고 온 마지막 timestamp와 실행 컨테이너를 저장
         project_info.last_logs_timestamp = time.mktime(datetime.now().timetuple()) + 1.0
@@ -453,6 +455,40 @@ def status_request(request):
         print(error)
         return HttpResponse(error)
 
+# 컨테이너 상태 스트림 (SSE)
+@api_view(['GET'])
+@permission_classes([AllowAny])   # 토큰 확인
+def status_stream(request):
+    """
+    Server-sent event stream of a project's container status and AutoNN updates
+
+    The first "container" event is the current state, further "container" and
+    "autonn" events are pushed as other containers report them.
+
+    Args:
+        user_id (string): user_id
+        project_id (string): project_id
+
+    Returns:
+        text/event-stream
+    """
+    try:
+        user_id = request.GET['user_id']
+        project_id = request.GET['project_id']
+        project_info = Project.objects.get(id=project_id, create_user=str(user_id))
+    except Project.DoesNotExist:
+        return HttpResponse(json.dumps({'status': 404}), status=404)
+    except Exception as error:
+        print("status_stream - error")
+        print(error)
+        return HttpResponse(json.dumps({'status': 400, 'error': str(error)}), status=400)
+
+    snapshot = {'container': project_info.container, 'container_status': project_info.container_status}
+    response = StreamingHttpResponse(event_stream(project_id, snapshot), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # nginx must not buffer the stream
+    return response
+
 # 컨테이너 상태 결과 응답
 @api_view(['GET'])
 @permission_classes([AllowAny])   # 토큰 확인
@@ -509,6 +545,7 @@ def status_report(request):
                     project_info.autonn_retry_count = project_info.autonn_retry_count + 1
                     project_info.container_status = ContainerStatus.RUNNING
                     project_info.save()
+                    publish_container_status(project_info)
                     return HttpResponse(json.dumps({'status': 200}))
                 except Exception as error:
                     print("resume API 호출 실패..")
@@ -549,6 +586,7 @@ def status_report(request):
             project_info.container_status = result
 
         project_info.save()
+        publish_container_status(project_info)
         return HttpResponse(json.dumps({'status': 200}))
 
     except Exception as error:
@@ -575,6 +613,7 @@ def status_update(request):
     try:
         print("@@@@@@@@@@@@@@@ status_update @@@@@@@@@@@@@@@")
         update_autonn_status(request.data)
+        publish_autonn_update(request.data)
         return HttpResponse(json.dumps({'status': 200}))
 
     except Exception as error:
@@ -582,6 +621,35 @@ def status_update(request):
         print(error)
         return HttpResponse(error)
 
+# 컨테이너 업데이트 묶음 (for Auto NN)
+@api_view(['POST'])
+@permission_classes([AllowAny])   # 토큰 확인
+def status_update_bulk(request):
+    """
+    API to receive a batch of task status reports from other containers
+
+    Args:
+        updates (list): status_update bodies (user_id, project_id, container_id, update_id, update_content),
+                        either as the request body itself or under the "updates" key
+
+    Returns:
+        status, results (one per update, in order)
+    """
+    try:
+        updates = request.data.get("updates", []) if isinstance(request.data, dict) else request.data
+        if not isinstance(updates, list):
+            return HttpResponse(json.dumps({'status': 400, 'error': 'updates must be a list'}), status=400)
+        results = update_autonn_status_bulk(updates)
+        for body, result in zip(updates, results):
+            if result["result"] == "ok":
+                publish_autonn_update(body)
+        return HttpResponse(json.dumps({'status': 200, 'results': results}))
+
+    except Exception as error:
+        print("status_update_bulk - error")
+        print(error)
+        return HttpResponse(json.dumps({'status': 500, 'error': str(error)}), status=500)
+
 # nn_model 다운로드(외부IDE연동)
 @api_view(['GET'])
 @permission_classes([AllowAny])   # 토큰 확인
@@ -927,6 +995,10 @@ def project_update(request):
             s_weight_file = str(request.data.get('weight_file', ""))
             project_info_content += f"weight_file : {s_weight_file}\n"
 
+        # 모델 선택 시 latency 제한 (ms, batch 1), 없으면 BMS/Auto NN이 타겟별 기본값 사용
+        if request.data.get('latency'):
+            project_info_content += f"latency : {str(request.data['latency'])}\n"
+
         project_info_content += (
             f"cpu : {str(data.target_cpu)}\n"
             f"acc : {str(data.target_acc)}\n"
@@ -0,0 +1,23 @@
+import axios from 'axios';
+
+// project of the editor : user_id & project_id of the page url (?user_id=..&project_id=..)
+// without them, the server edits the graph of the last started project
+const query = new URLSearchParams(window.location.search);
+export const projectParams = {};
+['user_id', 'project_id'].forEach((key) => {
+  if (query.get(key) !== null) {
+    projectParams[key] = query.get(key);
+  }
+});
+
+// every request of the editor is scoped to its project
+axios.interceptors.request.use((config) => ({
+  ...config,
+  params: {...projectParams, ...config.params}
+}));
+
+// batched edit of the graph, applied all or nothing
+// delta = {node: {add: [{order, layer, parameters}], modify: [{order, ...}], delete: [order]},
+//          edge: {add: [{id, prior, next}], modify: [{id, ...}], delete: [id]}}
+// deleting a node deletes its edges too
+export const editGraph = (delta) => axios.post('/api/graph/', delta);
@@ -29,6 +29,7 @@ import ReOrg from "../layer/ReOrg";
 import InitialArch from '../../InitialArch';
 
 import axios from 'axios';
+import { editGraph } from "../../api";
 import ReactFlow, {
   addEdge,
   MiniMap,
@@ -131,12 +132,11 @@ function InfoList() {
         maxId = cedge.data[i].id
        }
       }
-      axios.post("/api/edge/",{
+      editGraph({edge: {add: [{
         id: maxId+1,
-        id: cedge.data.length+1,
         prior: params.source,
         next: params.target
-      }).then(function(response){
+      }]}}).then(function(response){
         console.log(response)
       }).catch(err=>console.log(err));
   };
@@ -176,37 +176,18 @@ function InfoList() {
   };
 
   const deleteModal = (remove) => {
-    axios.get("/api/node/".concat(String(nowc)).concat('/'))
-    .then(function(response){
-    console.log(response)});
     console.log("remove", remove)
-    if(remove[0].data){
-        console.log('node')
-        axios.delete("/api/node/".concat(String(nowc)).concat('/'));
-        axios.get("/api/edge/")
-        .then(function(response){
-        for(var i=0;i<response.data.length;i++){
-            if(String(response.data[i].prior) === String(nowc)){
-                axios.delete("/api/edge/".concat(String(response.data[i].id)).concat('/'));
-            }
-            if(String(response.data[i].next) === String(nowc)){
-                axios.delete("/api/edge/".concat(String(response.data[i].id)).concat('/'));
-            }
-        }
-        });
-    } else{
-    console.log('edge')
-    axios.get("/api/edge/")
+    // one batched edit for the removed nodes and edges, the server deletes the edges of a removed node too
+    const nodes = remove.filter((el) => el.data).map((el) => Number(el.id));
+    const links = remove.filter((el) => !el.data);
+    const edgeIds = links.length ? axios.get("/api/edge/").then((response) => response.data
+      .filter((edge) => links.some((link) =>
+        String(edge.prior) === String(link.source) && String(edge.next) === String(link.target)))
+      .map((edge) => edge.id)) : Promise.resolve([]);
+    edgeIds.then((edges) => editGraph({node: {delete: nodes}, edge: {delete: edges}}))
     .then(function(response){
-      for(var i=0;i<response.data.length;i++){
-        if(String(response.data[i].prior) === String(remove[0].source)){
-          if(String(response.data[i].next) === String(remove[0].target)){
-            axios.delete("/api/edge/".concat(String(response.data[i].id)).concat('/'));
-          }
-        }
-      }
-  });
-    }
+      console.log(response)
+    }).catch(err=>console.log(err));
   };
 
   const onDragOver = (event) => {
@@ -255,11 +236,11 @@ function InfoList() {
 
     //node create **********************
     //const cnode = plusId()
-    axios.post("/api/node/",{
+    editGraph({node: {add: [{
         order: id,
         layer: name,
         parameters: subp
-    }).then(function(response){
+    }]}}).then(function(response){
         console.log(response)
     }).catch(err=>console.log(err));
     //node create **********************
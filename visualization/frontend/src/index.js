@@ -1,6 +1,7 @@
 import React from 'react';
 import ReactDOM from 'react-dom';
 import App from './App';
+import './api';
 import EditText from './EditText';
 import EditTextarea from './EditTextarea';
 
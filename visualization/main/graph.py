@@ -9,6 +9,7 @@ from __future__ import unicode_literals
 
 from tkinter import messagebox
 from copy import deepcopy
+import heapq
 
 import torch.nn as nn
 
@@ -151,100 +152,111 @@ class CGraph:
             activelist.remove(sink)
         self.activeedgelist.update({source: activelist})
 
-    def topological_sort_util(self, _nodeid, visited, stack):
-        """A dummy docstring."""
-        # Mark the current node as visited.
-        visited.update({_nodeid: True})
-        # Recur for all the vertices adjacent to this vertex
-        for node_id in self.adadjacencylist.get(_nodeid):
-            if visited.get(node_id) is False:
-                self.topological_sort_util(node_id, visited, stack)
-
-        # Push current vertex to stack which stores result
-        stack.insert(0, _nodeid)
-
-    # The function to do Topological Sort. It uses recursive
-    # topologicalsortutil()
+    def build_index(self):
+        """
+        Forward and reverse adjacency indexes of the active nodes
+
+        Returns:
+            (succ, pred): dicts of node id -> list of node ids, edges between
+            active nodes only, each listed once and in insertion order
+        """
+        active = {key for key, node in self.nodes.items()
+                  if key in self.adadjacencylist and node.status is not False}
+        succ = {key: [] for key in self.adadjacencylist if key in active}
+        pred = {key: [] for key in succ}
+        for key in succ:
+            for sink in dict.fromkeys(self.adadjacencylist[key]):
+                if sink in active:
+                    succ[key].append(sink)
+                    pred[sink].append(key)
+        return succ, pred
+
+    # Kahn's algorithm, O(V+E) and without recursion.
+    # Among the nodes ready at the same time, the earliest added comes first,
+    # so a graph whose nodes were added in a valid order keeps that order.
     # sort는 display를 위한 것. 우린 안써도됨.
     def topological_sort(self):
         """A dummy docstring."""
-        stack = []
-        e_stack = {}
-        visited = {}
-        for key, val in self.adadjacencylist.items():
-            node = self.nodes.get(key)  # check if active
-            if node.status is False:
-                continue
-            visited.update({key: False})
+        succ, pred = self.build_index()
+        rank = {key: i for i, key in enumerate(succ)}
+        indegree = {key: len(val) for key, val in pred.items()}
+        ready = [rank[key] for key, val in indegree.items() if val == 0]
+        heapq.heapify(ready)
+        keys = list(succ)
 
+        stack = []
+        while ready:
+            key = keys[heapq.heappop(ready)]
+            stack.append(key)
+            for sink in succ[key]:
+                indegree[sink] -= 1
+                if indegree[sink] == 0:
+                    heapq.heappush(ready, rank[sink])
+
+        if len(stack) < len(succ):  # cycle, keep its nodes in insertion order
+            done = set(stack)
+            stack.extend(key for key in succ if key not in done)
+
+        # prior : every node (active or not) with an edge to the node
+        prior = {key: [] for key in stack}
         for key, val in self.adadjacencylist.items():
-            if visited.get(key) is False:
-                self.topological_sort_util(key, visited, stack)
+            for sink in dict.fromkeys(val):
+                if sink in prior:
+                    prior[sink].append(key)
 
+        e_stack = {}
         for value in stack:
-            e_stack[value] = {'prior': [], 'next': []}
-            e_stack[value]['next'] = self.adadjacencylist[value]
-            for key, val in self.adadjacencylist.items():
-                if value in val:
-                    e_stack[value]['prior'].append(key)
+            e_stack[value] = {'prior': prior[value],
+                              'next': self.adadjacencylist[value]}
 
         return stack, e_stack
 
     # Toolbolx.py에서 컴파일할 때 사용함
     def normalize(self):
-        # pylint: disable=too-many-locals, too-many-branches
-        """A dummy docstring."""
-        id_count = 0
-        deleted_nodes = []
-        convert_dict = {}
-        topo, expanded = self.topological_sort()
-        # pylint: disable=too-many-nested-blocks, missing-class-docstring
-        for _id in list(topo):
-            if self.nodes.get(_id).type == 'PASS':
-                self.deletenode(_id)
-                deleted_nodes.append(_id)
-                for node in self.adadjacencylist:
-                    if _id in self.adadjacencylist[node]:
-                        self.adadjacencylist[node].remove(_id)
-                for node in self.activeedgelist:
-                    if _id in self.activeedgelist[node]:
-                        self.activeedgelist[node].remove(_id)
-                expanded_prior = expanded[_id]['prior']
-                expanded_next = expanded[_id]['next']
-                for p_id in expanded_prior:
-                    if p_id not in deleted_nodes:
-                        for e_id in expanded_next:
-                            if e_id not in deleted_nodes:
-                                if p_id in self.adadjacencylist and \
-                                        e_id not in self.adadjacencylist[p_id]:
-                                    self.adadjacencylist[p_id].append(e_id)
-                                if p_id in self.activeedgelist and \
-                                        e_id not in self.activeedgelist[p_id]:
-                                    self.activeedgelist[p_id].append(e_id)
-                topo.remove(_id)
+        """
+        Removes the PASS nodes, connecting their predecessors to their
+        successors, and renumbers the nodes 1..N in topological order, O(V+E)
+        """
+        topo, _ = self.topological_sort()
+        passes = {_id for _id in topo if self.nodes.get(_id).type_ == 'PASS'}
+
+        # non-PASS nodes reached through a PASS node, PASS chains included;
+        # successors come before their predecessors in reversed(topo)
+        reach = {}
+        for _id in reversed(topo):
+            if _id not in passes:
                 continue
-            id_count += 1
-            convert_dict[_id] = id_count
-        old_nodes = dict(self.nodes)
-        old_adj = dict(self.adadjacencylist)
-        old_active = dict(self.activeedgelist)
-        self.nodes = {}
-        self.adadjacencylist = {}
-        self.activeedgelist = {}
-        for _id in old_nodes:
-            self.nodes[convert_dict[_id]] = old_nodes[_id]
-        for _id in old_adj:
-            new_adj_list = []
-            old_adj_list = old_adj[_id]
-            for item in old_adj_list:
-                new_adj_list.append(convert_dict[item])
-            self.adadjacencylist[convert_dict[_id]] = list(new_adj_list)
-        for _id in old_active:
-            new_active_list = []
-            old_active_list = old_active[_id]
-            for item in old_active_list:
-                new_active_list.append(convert_dict[item])
-            self.activeedgelist[convert_dict[_id]] = list(new_active_list)
+            out = {}
+            for sink in self.adadjacencylist.get(_id, []):
+                if sink in passes:
+                    out.update(dict.fromkeys(reach.get(sink, [])))
+                elif sink != _id:
+                    out[sink] = None
+            reach[_id] = list(out)
+
+        def bypass(sinks):
+            # PASS sinks are replaced by what they reach, appended at the end
+            out = dict.fromkeys(sink for sink in sinks if sink not in passes)
+            for sink in sinks:
+                if sink in passes:
+                    out.update(dict.fromkeys(reach[sink]))
+            return list(out)
+
+        convert_dict = {}
+        for _id in topo:
+            if _id not in passes:
+                convert_dict[_id] = len(convert_dict) + 1
+        for _id in self.nodes:  # inactive nodes are not in topo
+            if _id not in convert_dict and _id not in passes:
+                convert_dict[_id] = len(convert_dict) + 1
+
+        def renumber(adjacency):
+            return {convert_dict[_id]: [convert_dict[sink] for sink in bypass(sinks) if sink in convert_dict]
+                    for _id, sinks in adjacency.items() if _id in convert_dict}
+
+        self.nodes = {convert_dict[_id]: node for _id, node in self.nodes.items() if _id in convert_dict}
+        self.adadjacencylist = renumber(self.adadjacencylist)
+        self.activeedgelist = renumber(self.activeedgelist)
         return self
 
 
@@ -0,0 +1,76 @@
+# Node and Edge rows are scoped to a Graph (user_id, project_id).
+# The old rows belong to no project and are reloaded from basemodel.yaml/json
+# on the next start, so the tables are recreated instead of altered.
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0003_sort'),
+    ]
+
+    operations = [
+        migrations.DeleteModel(
+            name='Node',
+        ),
+        migrations.DeleteModel(
+            name='Edge',
+        ),
+        migrations.CreateModel(
+            name='Graph',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True,
+                                           primary_key=True,
+                                           serialize=False,
+                                           verbose_name='ID')),
+                ('user_id', models.CharField(max_length=200)),
+                ('project_id', models.CharField(max_length=200)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Node',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True,
+                                           primary_key=True,
+                                           serialize=False,
+                                           verbose_name='ID')),
+                ('order', models.IntegerField()),
+                ('layer', models.CharField(max_length=200)),
+                ('parameters', models.TextField()),
+                ('graph', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE,
+                                            related_name='nodes',
+                                            to='main.graph')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Edge',
+            fields=[
+                ('uid', models.BigAutoField(primary_key=True,
+                                            serialize=False)),
+                ('edge_id', models.IntegerField()),
+                ('prior', models.IntegerField()),
+                ('next', models.IntegerField()),
+                ('graph', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE,
+                                            related_name='edges',
+                                            to='main.graph')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='graph',
+            constraint=models.UniqueConstraint(fields=('user_id', 'project_id'),
+                                               name='unique_graph_project'),
+        ),
+        migrations.AddConstraint(
+            model_name='node',
+            constraint=models.UniqueConstraint(fields=('graph', 'order'),
+                                               name='unique_node_order'),
+        ),
+        migrations.AddConstraint(
+            model_name='edge',
+            constraint=models.UniqueConstraint(fields=('graph', 'edge_id'),
+                                               name='unique_edge_id'),
+        ),
+    ]
@@ -4,21 +4,48 @@ high level support for doing this and that.
 from django.db import models
 
 
+class Graph(models.Model):
+    # pylint: disable=too-few-public-methods, missing-class-docstring
+    # one model graph per (user_id, project_id); nodes and edges belong to it
+    objects = models.Manager()
+    user_id = models.CharField(max_length=200)
+    project_id = models.CharField(max_length=200)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user_id', 'project_id'], name='unique_graph_project'),
+        ]
+
+
 class Node(models.Model):
     # pylint: disable=too-few-public-methods, missing-class-docstring
     objects = models.Manager()
-    order = models.IntegerField(primary_key=True)
+    graph = models.ForeignKey(Graph, on_delete=models.CASCADE, related_name='nodes')
+    order = models.IntegerField()
     layer = models.CharField(max_length=200)
     parameters = models.TextField()
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['graph', 'order'], name='unique_node_order'),
+        ]
+
 
 class Edge(models.Model):
     # pylint: disable=too-few-public-methods, missing-class-docstring
+    # 'id' is reserved for the primary key, the edge number within its graph is 'edge_id'
     objects = models.Manager()
-    id = models.IntegerField(primary_key=True)
+    uid = models.BigAutoField(primary_key=True)
+    graph = models.ForeignKey(Graph, on_delete=models.CASCADE, related_name='edges')
+    edge_id = models.IntegerField()
     prior = models.IntegerField()
     next = models.IntegerField()
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['graph', 'edge_id'], name='unique_edge_id'),
+        ]
+
 
 class Pth(models.Model):
     # pylint: disable=too-few-public-methods, missing-class-docstring
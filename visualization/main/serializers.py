@@ -23,17 +23,18 @@ class NodeSerializer(serializers.ModelSerializer):
     class Meta:  # pylint: disable-msg=too-few-public-methods
         """A dummy docstring."""
         model = Node
-        fields = '__all__'
+        fields = ('order', 'layer', 'parameters')
 
 
 class EdgeSerializer(serializers.ModelSerializer):
     # pylint: disable-msg=too-few-public-methods
     """A dummy docstring."""
+    id = serializers.IntegerField(source='edge_id')
 
     class Meta:  # pylint: disable-msg=too-few-public-methods
         """A dummy docstring."""
         model = Edge
-        fields = '__all__'
+        fields = ('id', 'prior', 'next')
 
 
 class PthSerializer(serializers.ModelSerializer):
@@ -0,0 +1,432 @@
+"""
+symbolic shape inference for viz2code graphs
+
+Propagates the tensor shape of every node of a CGraph and counts its
+parameters and FLOPs from the layer parameters alone (defaults taken from
+layer_difinition.CDefaults), without building any torch module.
+
+Shapes are per sample, i.e. without the batch dimension: (C, H, W) for
+feature maps, (F,) after Flatten. FLOPs count a multiply-add as 2 like the
+GFLOPs of the YOLO model summaries; element-wise layers (BatchNorm,
+activations, pooling, ...) count one operation per output element.
+"""
+import ast
+import math
+
+from .layer_difinition import CDefaults
+
+
+def _value(v):
+    # node params may hold strings ('(3, 3)', 'None', 'True', ...)
+    if isinstance(v, str):
+        try:
+            return ast.literal_eval(v.strip())
+        except (ValueError, SyntaxError):
+            return v.strip()
+    return v
+
+
+def _pair(v):
+    v = _value(v)
+    if isinstance(v, (list, tuple)):
+        return (int(v[0]), int(v[-1]))
+    return (int(v), int(v))
+
+
+def _flag(v):
+    v = _value(v)
+    if isinstance(v, str):
+        return v.lower() == 'true'
+    return bool(v)
+
+
+def _numel(shape):
+    return math.prod(shape) if shape else 1
+
+
+def _autopad(k, p):
+    # same as common.autopad
+    p = _value(p)
+    if p is None:
+        return k // 2
+    return p
+
+
+def _conv_out(h, k, s, p, d=1, ceil_mode=False):
+    x = (h + 2 * p - d * (k - 1) - 1) / s + 1
+    out = math.ceil(x) if ceil_mode else math.floor(x)
+    if ceil_mode and (out - 1) * s >= h + p:
+        out -= 1
+    if out < 1:
+        raise ValueError(f'output size {out} (input {h}, kernel {k}, stride {s}, padding {p})')
+    return out
+
+
+def _conv(shape, c2, k, s=1, p=0, g=1, d=1, bias=False):
+    """
+    Returns (output shape, params, flops) of a nn.Conv2d
+    """
+    c1, h, w = shape
+    (kh, kw), (sh, sw), (ph, pw), (dh, dw) = _pair(k), _pair(s), _pair(p), _pair(d)
+    if c1 % g or c2 % g:
+        raise ValueError(f'channels {c1}->{c2} are not divisible by groups {g}')
+    out = (c2, _conv_out(h, kh, sh, ph, dh), _conv_out(w, kw, sw, pw, dw))
+    params = c2 * (c1 // g) * kh * kw + (c2 if bias else 0)
+    flops = 2 * _numel(out) * (c1 // g) * kh * kw
+    return out, params, flops
+
+
+def _yolo_conv(shape, c2, k=1, s=1, p=None, g=1):
+    """
+    Returns (output shape, params, flops) of a common.Conv (conv + bn + act)
+    """
+    k, s = _value(k), _value(s)
+    out, params, flops = _conv(shape, c2, k, s, _autopad(k if isinstance(k, int) else k[0], p), g)
+    return out, params + 2 * c2, flops + 2 * _numel(out)
+
+
+def _pool(shape, k, s=None, p=0, d=1, ceil_mode=False):
+    c, h, w = shape
+    (kh, kw), (ph, pw), (dh, dw) = _pair(k), _pair(p), _pair(d)
+    sh, sw = _pair(s) if _value(s) is not None else (kh, kw)
+    out = (c, _conv_out(h, kh, sh, ph, dh, ceil_mode), _conv_out(w, kw, sw, pw, dw, ceil_mode))
+    return out, 0, _numel(out) * kh * kw
+
+
+def _fmap(shape, name):
+    if shape is None or len(shape) != 3:
+        raise ValueError(f'{name} expects a (C, H, W) input, got {shape}')
+    return shape
+
+
+def _check(name, key, expected, actual):
+    if expected is not None and int(expected) != int(actual):
+        raise ValueError(f"{name} {key}={expected} but the input has {actual}")
+
+
+class CShapeInference:
+    """
+    Shape, parameter and FLOPs inference over a CGraph
+
+    The results of the previous infer() are kept: a node is recomputed only
+    if its type, its params, its inputs or their shapes changed, so editing
+    one node recomputes that node and the descendants whose input shape
+    actually changed.
+
+    Args:
+        input_shape (tuple): (C, H, W) fed to the nodes which have no input
+    """
+    def __init__(self, input_shape=(3, 640, 640)):
+        self.defaults = CDefaults().tags
+        self.input_shape = tuple(input_shape)
+        self.results = {}
+        self.signatures = {}
+        self.recomputed = []
+        self.rules = {
+            'Conv2d': self._conv2d, 'Conv': self._conv,
+            'BatchNorm2d': self._batchnorm2d,
+            'MaxPool2d': self._maxpool2d, 'AvgPool2d': self._avgpool2d,
+            'AdaptiveAvgPool2d': self._adaptiveavgpool2d,
+            'MP': self._mp, 'SP': self._sp,
+            'ZeroPad2d': self._pad2d, 'ConstantPad2d': self._pad2d,
+            'ReLU': self._elementwise, 'ReLU6': self._elementwise,
+            'Sigmoid': self._elementwise, 'LeakyReLU': self._elementwise,
+            'Tanh': self._elementwise, 'Softmax': self._elementwise,
+            'SoftMax': self._elementwise, 'Dropout': self._identity,
+            'PASS': self._identity,
+            'Linear': self._linear, 'Flatten': self._flatten,
+            'Upsample': self._upsample, 'ReOrg': self._reorg,
+            'BCELoss': self._loss, 'CrossEntropyLoss': self._loss,
+            'MSELoss': self._loss,
+            'BasicBlock': self._basicblock, 'Bottleneck': self._bottleneck,
+            'Concat': self._concat, 'Shortcut': self._shortcut,
+            'DownC': self._downc, 'SPPCSPC': self._sppcspc,
+            'IDetect': self._idetect,
+        }
+
+    def infer(self, graph, changed=()):
+        """
+        Infers the active nodes of a graph
+
+        Args:
+            graph (CGraph): graph to infer
+            changed (iterable): node ids to recompute even if they look unchanged
+
+        Returns:
+            dict of node id -> {'input': [shapes], 'output': shape,
+                                'params': int, 'flops': int, 'error': str or None}
+        """
+        order, expanded = graph.topological_sort()
+        active = set(order)
+        changed = set(changed)
+        results, signatures, recomputed = {}, {}, []
+        for id_ in order:
+            node = graph.nodes.get(id_)
+            priors = [p for p in expanded[id_]['prior'] if p in active]
+            inputs = [results[p]['output'] for p in priors] if priors else [self.input_shape]
+            signature = (node.type_, repr(sorted(node.params.items(), key=lambda kv: str(kv[0]))), tuple(priors))
+            signatures[id_] = signature
+
+            prev = self.results.get(id_)
+            if (prev is not None and id_ not in changed
+                    and self.signatures.get(id_) == signature and prev['input'] == inputs):
+                results[id_] = prev
+                continue
+            results[id_] = self.infer_node(node.type_, node.params, inputs)
+            recomputed.append(id_)
+
+        self.results, self.signatures, self.recomputed = results, signatures, recomputed
+        return results
+
+    def infer_node(self, type_, params, inputs):
+        """
+        Infers one layer
+
+        Args:
+            type_ (string): layer name (CNode.type_)
+            params (dict): layer parameters, missing ones take the CDefaults values
+            inputs (list): shapes of the inputs, in edge order
+
+        Returns:
+            dict, see infer()
+        """
+        result = {'input': inputs, 'output': None, 'params': 0, 'flops': 0, 'error': None}
+        rule = self.rules.get(type_)
+        if rule is None:
+            result['error'] = f'{type_} is not supported by shape inference'
+            return result
+        if any(x is None for x in inputs):
+            result['error'] = 'input shape is unknown'
+            return result
+
+        p = dict(self.defaults.get(type_, {}))
+        p.update({k: _value(v) for k, v in params.items()})
+        try:
+            result['output'], result['params'], result['flops'] = rule(type_, p, inputs)
+        except (ValueError, TypeError, KeyError, IndexError, ZeroDivisionError) as e:
+            result['error'] = f'{type_}: {e}'
+        return result
+
+    def summary(self, results=None):
+        """
+        Returns the totals of infer() results
+        """
+        results = self.results if results is None else results
+        errors = {id_: r['error'] for id_, r in results.items() if r['error']}
+        return {'params': sum(r['params'] for r in results.values()),
+                'flops': sum(r['flops'] for r in results.values()),
+                'errors': errors}
+
+    # ---- layer rules: (type_, params, inputs) -> (output, params, flops) ----
+
+    @staticmethod
+    def _single(type_, inputs):
+        if len(inputs) != 1:
+            raise ValueError(f'expects 1 input, got {len(inputs)}')
+        return inputs[0]
+
+    def _conv2d(self, type_, p, inputs):
+        x = _fmap(self._single(type_, inputs), type_)
+        _check(type_, 'in_channels', p.get('in_channels'), x[0])
+        return _conv(x, int(p['out_channels']), p['kernel_size'], p['stride'], p['padding'],
+                     int(p.get('groups') or 1), p.get('dilation') or 1, _flag(p.get('bias')))
+
+    def _conv(self, type_, p, inputs):
+        x = _fmap(self._single(type_, inputs), type_)
+        _check(type_, 'in_channels', p.get('in_channels'), x[0])
+        pad = p['pad'] if p.get('pad') is not None else p.get('padding')
+        return _yolo_conv(x, int(p['out_channels']), p['kernel_size'], p['stride'], pad, int(p.get('groups') or 1))
+
+    def _batchnorm2d(self, type_, p, inputs):
+        x = _fmap(self._single(type_, inputs), type_)
+        _check(type_, 'num_features', p.get('num_features'), x[0])
+        return x, 2 * x[0], 2 * _numel(x)
+
+    def _maxpool2d(self, type_, p, inputs):
+        x = _fmap(self._single(type_, inputs), type_)
+        return _pool(x, p['kernel_size'], p.get('stride'), p.get('padding') or 0,
+                     p.get('dilation') or 1, _flag(p.get('ceil_mode')))
+
+    def _avgpool2d(self, type_, p, inputs):
+        x = _fmap(self._single(type_, inputs), type_)
+        return _pool(x, p['kernel_size'], p.get('stride'), p.get('padding') or 0,
+                     1, _flag(p.get('ceil_mode')))
+
+    def _adaptiveavgpool2d(self, type_, p, inputs):
+        c, h, w = _fmap(self._single(type_, inputs), type_)
+        size = p['output_size']
+        oh, ow = size if isinstance(size, (list, tuple)) else (size, size)
+        out = (c, h if oh is None else int(oh), w if ow is None else int(ow))
+        return out, 0, c * h * w
+
+    def _mp(self, type_, p, inputs):
+        k = int(p.get('k') or 2)
+        return _pool(_fmap(self._single(type_, inputs), type_), k, k)
+
+    def _sp(self, type_, p, inputs):
+        k = _pair(p['kernel_size'])[0]
+        return _pool(_fmap(self._single(type_, inputs), type_), k, p['stride'], k // 2)
+
+    def _pad2d(self, type_, p, inputs):
+        c, h, w = _fmap(self._single(type_, inputs), type_)
+        pad = p['padding']
+        left, right, top, bottom = pad if isinstance(pad, (list, tuple)) else (pad,) * 4
+        out = (c, h + int(top) + int(bottom), w + int(left) + int(right))
+        return out, 0, 0
+
+    def _elementwise(self, type_, p, inputs):
+        x = self._single(type_, inputs)
+        return x, 0, _numel(x)
+
+    def _identity(self, type_, p, inputs):
+        return self._single(type_, inputs), 0, 0
+
+    def _linear(self, type_, p, inputs):
+        x = self._single(type_, inputs)
+        if not x:
+            raise ValueError('input is a scalar')
+        _check(type_, 'in_features', p.get('in_features'), x[-1])
+        out_features = int(p['out_features'])
+        out = tuple(x[:-1]) + (out_features,)
+        params = x[-1] * out_features + (out_features if _flag(p.get('bias')) else 0)
+        return out, params, 2 * _numel(x) * out_features
+
+    def _flatten(self, type_, p, inputs):
+        full = (1,) + tuple(self._single(type_, inputs))  # with the batch dimension
+        start, end = int(p.get('start_dim', 1)), int(p.get('end_dim', -1))
+        start, end = start % len(full), end % len(full)
+        out = full[:start] + (_numel(full[start:end + 1]),) + full[end + 1:]
+        return out[1:], 0, 0
+
+    def _upsample(self, type_, p, inputs):
+        c, h, w = _fmap(self._single(type_, inputs), type_)
+        size, scale = p.get('size'), p.get('scale_factor')
+        if size is not None:
+            oh, ow = size if isinstance(size, (list, tuple)) else (size, size)
+        elif scale is not None:
+            sh, sw = scale if isinstance(scale, (list, tuple)) else (scale, scale)
+            oh, ow = math.floor(h * float(sh)), math.floor(w * float(sw))
+        else:
+            raise ValueError('either size or scale_factor is required')
+        out = (c, int(oh), int(ow))
+        return out, 0, _numel(out)
+
+    def _reorg(self, type_, p, inputs):
+        c, h, w = _fmap(self._single(type_, inputs), type_)
+        return (4 * c, (h + 1) // 2, (w + 1) // 2), 0, 0
+
+    def _loss(self, type_, p, inputs):
+        return (), 0, sum(_numel(x) for x in inputs)
+
+    def _basicblock(self, type_, p, inputs):
+        x = _fmap(self._single(type_, inputs), type_)
+        _check(type_, 'inplanes', p.get('inplanes'), x[0])
+        if int(p.get('groups') or 1) != 1 or int(p.get('base_width') or 64) != 64:
+            raise ValueError('BasicBlock only supports groups=1 and base_width=64')
+        if int(p.get('dilation') or 1) > 1:
+            raise ValueError('dilation > 1 is not supported in BasicBlock')
+        planes = int(p['planes'])
+        return self._residual(x, [(planes, 3, p['stride'], 1, 1), (planes, 3, 1, 1, 1)], planes,
+                              p['stride'], _flag(p.get('downsample')))
+
+    def _bottleneck(self, type_, p, inputs):
+        x = _fmap(self._single(type_, inputs), type_)
+        _check(type_, 'inplanes', p.get('inplanes'), x[0])
+        g, d = int(p.get('groups') or 1), int(p.get('dilation') or 1)
+        width = int(int(p['planes']) * (int(p.get('base_width') or 64) / 64.)) * g
+        c2 = int(p['planes']) * 4
+        return self._residual(x, [(width, 1, 1, 1, 1), (width, 3, p['stride'], g, d), (c2, 1, 1, 1, 1)],
+                              c2, p['stride'], _flag(p.get('downsample')))
+
+    @staticmethod
+    def _residual(x, convs, c2, stride, downsample):
+        # torchvision resnet blocks: conv-bn(-relu) stack + identity or conv1x1-bn downsample
+        y, params, flops = x, 0, 0
+        for c, k, s, g, d in convs:
+            y, n, f = _conv(y, c, k, s, d if k == 3 else 0, g, d)
+            params, flops = params + n + 2 * c, flops + f + 2 * _numel(y)
+        if downsample:
+            z, n, f = _conv(x, c2, 1, stride, 0)
+            params, flops = params + n + 2 * c2, flops + f + 2 * _numel(z)
+        else:
+            z = x
+        if tuple(z) != tuple(y):
+            raise ValueError(f'residual shapes differ: {z} and {y}, a downsample is required')
+        return y, params, flops + _numel(y)
+
+    def _concat(self, type_, p, inputs):
+        dim = int(p.get('dim', 1))
+        ranks = {len(x) for x in inputs}
+        if len(ranks) != 1:
+            raise ValueError(f'inputs of different ranks: {inputs}')
+        rank = ranks.pop()
+        axis = dim - 1 if dim > 0 else rank + dim  # per sample shape has no batch dimension
+        if not 0 <= axis < rank:
+            raise ValueError(f'dim={dim} is out of range')
+        for x in inputs[1:]:
+            if any(a != b for i, (a, b) in enumerate(zip(x, inputs[0])) if i != axis):
+                raise ValueError(f'inputs differ outside of dim {dim}: {inputs}')
+        out = list(inputs[0])
+        out[axis] = sum(x[axis] for x in inputs)
+        return tuple(out), 0, 0
+
+    def _shortcut(self, type_, p, inputs):
+        if len(inputs) < 2:
+            raise ValueError(f'expects 2 inputs, got {len(inputs)}')
+        if any(tuple(x) != tuple(inputs[0]) for x in inputs[1:2]):
+            raise ValueError(f'inputs must have the same shape: {inputs}')
+        return inputs[0], 0, _numel(inputs[0])
+
+    def _downc(self, type_, p, inputs):
+        x = _fmap(self._single(type_, inputs), type_)
+        _check(type_, 'in_channels', p.get('in_channels'), x[0])
+        c2, k = int(p['out_channels']), _pair(p['kernel_size'])[0]
+        y, n1, f1 = _yolo_conv(x, x[0], 1, 1)
+        y, n2, f2 = _yolo_conv(y, c2 // 2, 3, k)
+        z, _, f3 = _pool(x, k, k)
+        z, n4, f4 = _yolo_conv(z, c2 // 2, 1, 1)
+        if y[1:] != z[1:]:
+            raise ValueError(f'branch shapes differ: {y} and {z}')
+        return (y[0] + z[0],) + y[1:], n1 + n2 + n4, f1 + f2 + f3 + f4
+
+    def _sppcspc(self, type_, p, inputs):
+        x = _fmap(self._single(type_, inputs), type_)
+        _check(type_, 'in_channels', p.get('in_channels'), x[0])
+        c2 = int(p['out_channels'])
+        c_ = int(2 * c2 * float(p.get('expansion') or 0.5))
+        kernels = p.get('kernels') or (5, 9, 13)
+        params, flops = 0, 0
+
+        def conv(y, c, k):
+            nonlocal params, flops
+            y, n, f = _yolo_conv(y, c, k, 1)
+            params, flops = params + n, flops + f
+            return y
+
+        x1 = conv(conv(conv(x, c_, 1), c_, 3), c_, 1)
+        for k in kernels:
+            flops += _pool(x1, k, 1, int(k) // 2)[2]
+        y1 = conv(conv((c_ * (len(kernels) + 1),) + x1[1:], c_, 1), c_, 3)
+        y2 = conv(x, c_, 1)
+        out = conv((y1[0] + y2[0],) + y1[1:], c2, 1)
+        return out, params, flops
+
+    def _idetect(self, type_, p, inputs):
+        nc = int(p.get('nc') or 80)
+        anchors = p.get('anchors') or ()
+        if isinstance(anchors, int):
+            na = anchors
+        elif anchors:
+            na = len(anchors[0]) // 2
+        else:
+            raise ValueError('anchors are required')
+        no = nc + 5
+        if isinstance(anchors, (list, tuple)) and len(anchors) != len(inputs):
+            raise ValueError(f'{len(anchors)} anchor levels but {len(inputs)} inputs')
+        out, params, flops = [], 0, 0
+        for x in inputs:
+            c, h, w = _fmap(x, type_)
+            params += c * no * na + no * na + c + no * na  # conv + ImplicitA + ImplicitM
+            flops += 2 * c * no * na * h * w + (c + no * na) * h * w
+            out.append((na, h, w, no))
+        return tuple(out), params, flops
@@ -22,6 +22,8 @@ urlpatterns = [
     path('pth/', views.pthlist),
     path('sort/', views.sortlist),
     path('sort/<int:pk>/', views.sortlist_detail),
+    path('shape/', views.shapelist),
+    path('graph/', views.graphlist),
     path('architecture/', views.ArchitectureView.as_view()),
     path('start', views.startList),
     path('stop', views.stopList),
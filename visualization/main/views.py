@@ -4,6 +4,7 @@ high level support for doing this and that.
 import os
 import random
 import string
+import threading
 from time import sleep
 from datetime import datetime
 import torch
@@ -18,6 +19,9 @@ from rest_framework.decorators import api_view
 from rest_framework import viewsets
 from rest_framework.response import Response
 from rest_framework import status
+from rest_framework.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from django.db.models import Q
 from django.shortcuts import render
 from django.http import HttpResponse
 
@@ -31,6 +35,7 @@ from .serializers import RunningSerializer
 from .serializers import StopSerializer
 from .serializers import SortSerializer
 
+from .models import Graph
 from .models import Node
 from .models import Edge
 from .models import Pth
@@ -42,6 +47,7 @@ from .models import Status
 
 from .graph import CGraph, CEdge, CNode, CShow2
 from .binder import CPyBinder
+from .shape import CShapeInference
 import json
 
 # Create your views here.
@@ -61,6 +67,11 @@ TORCH_NN_MODULES =  {   'Conv2d', 'ConvTranspose2d',
 HEAD_MODULES = { 'Classify', 'Detect', 'IDetect', 'IAuxDetect', 'IKeypoint',
                  'IBin', 'Segment', 'Pose'}
 
+# symbolic shape inference of the edited graphs (one per Graph pk), kept between
+# requests so that only the edited nodes (and what they feed) are recomputed
+SHAPE_INFERENCE = {}
+SHAPE_LOCK = threading.Lock()
+
 @api_view(['GET', 'POST', 'DELETE', 'UPDATE'])
 # pylint: disable = invalid-name, inconsistent-return-statements
 def mainList(request):
@@ -122,13 +133,17 @@ def pthlist(request):
         host_ip = str(request.get_host())[:-5]
         #print(host_ip)
 
-        edges = Edge.objects.all()
-        nodes = Node.objects.all()
+        graph = get_graph(request)
+        edges = Edge.objects.filter(graph=graph).order_by('edge_id')
+        nodes = Node.objects.filter(graph=graph).order_by('order')
 
         name = random_char(8)
         # name = 'resnet50'
 
         if nodes and edges:
+            _, shape_summary = infer_shapes(graph.pk, nodes, edges)
+            for node_id, error in shape_summary['errors'].items():
+                print(f"warning: node #{node_id} {error}")
             created_model = make_branches(nodes, edges)
             file_path = (os.getcwd() + '/model_' +
                          name + '.pt').replace("\\", '/')
@@ -137,43 +152,24 @@ def pthlist(request):
             serializer = PthSerializer(data={'model_output': file_path})
 
 
-            node_layer_list = []
-            node_order_list = []
-            node_parameters_list = []
-
-            edge_id_list = []
-            edge_prior_list = []
-            edge_next_list = []
-
-            for node in nodes:
-                node_order_list.append(node.order)
-                node_layer_list.append(node.layer)
-                node_parameters_list.append(node.parameters)
-
-            for edge in edges:
-                edge_id_list.append(edge.id)
-                edge_prior_list.append(edge.prior)
-                edge_next_list.append(edge.next)
+            node_rows = list(nodes.values_list('order', 'layer', 'parameters'))
+            edge_rows = list(edges.values_list('edge_id', 'prior', 'next'))
+            node_order_list = [order for order, _, _ in node_rows]
+            node_layer_list = [layer for _, layer, _ in node_rows]
+            node_parameters_list = [parameters for _, _, parameters in node_rows]
+            json_position = {order: index for index, order in enumerate(node_order_list)}
 
+            # prior nodes of each node, in edge order
+            prior_nodes = {}
+            for _, prior, next_ in edge_rows:
+                prior_nodes.setdefault(next_, []).append(prior)
 
             #json_data = serializers.serialize('json', nodes)
             json_data = OrderedDict()
-            json_data['node'] = []
-            json_data['edge'] = []
-
-            for c in range(len(node_order_list)):
-                json_data['node'].append({
-                    "order": node_order_list[c],
-                    "layer": node_layer_list[c],
-                    "parameters": node_parameters_list[c]
-                })
-
-            for a in range(len(edge_id_list)):
-                json_data['edge'].append({
-                    "id": edge_id_list[a],
-                    "prior": edge_prior_list[a],
-                    "next": edge_next_list[a]
-                })
+            json_data['node'] = [{"order": order, "layer": layer, "parameters": parameters}
+                                 for order, layer, parameters in node_rows]
+            json_data['edge'] = [{"id": id_, "prior": prior, "next": next_}
+                                 for id_, prior, next_ in edge_rows]
 
 
             print(json.dumps(json_data, ensure_ascii=False, indent="\t"))
@@ -261,7 +257,7 @@ def pthlist(request):
             # for yaml_index, node_index in enumerate(nodes_order):
             #     json_index = node_order_list.index(node_index)
             for yaml_index, node_index in enumerate(node_order_list):
-                json_index = node_index - 1
+                json_index = json_position[node_index]
 
                 # YOLO-style yaml module description
                 # [from, number, module, args]
@@ -422,10 +418,7 @@ def pthlist(request):
                 print(f"layer #{yaml_index} (node_index #{node_index}; json_index #{json_index}) : {module_}")
 
                 # from
-                f_ = []
-                for a in range(len(edge_id_list)):
-                    if edge_next_list[a] == node_index:
-                        f_.append(edge_prior_list[a])
+                f_ = prior_nodes.get(node_index, [])
                 print(f"f_={f_}")
                 if not f_:
                     from_ = -1 # this has to be the first layer
@@ -485,10 +478,8 @@ def pthlist(request):
                 serializer.save()
                 # pylint: disable = invalid-name, missing-timeout, unused-variable
 
-                # get user_id & project_id from status_request
-                get_status = Status.objects.all()
-                user_id = get_status[len(get_status)-1].user_id
-                project_id = get_status[len(get_status)-1].project_id
+                user_id = graph.user_id
+                project_id = graph.project_id
 
                 # save json file
                 json_path = ('/shared/common/'+str(user_id)+'/'+str(project_id)+'/basemodel.json').replace("\\", '/')
@@ -524,10 +515,8 @@ def pthlist(request):
                 print(serializer.errors)
                 #serializer.save()
 
-                # get user_id & project_id from status_request
-                get_status = Status.objects.all()
-                user_id = get_status[len(get_status)-1].user_id
-                project_id = get_status[len(get_status)-1].project_id
+                user_id = graph.user_id
+                project_id = graph.project_id
 
                 url = 'http://projectmanager:8085/status_report'  ##
                 #url = 'http://' + host_ip + ':8091/status_report'
@@ -570,8 +559,9 @@ def sortlist(request):
         #CShow2()
         host_ip = str(request.get_host())[:-5]
         print(host_ip)
-        edges = Edge.objects.all()
-        nodes = Node.objects.all()
+        graph = get_graph(request)
+        edges = Edge.objects.filter(graph=graph)
+        nodes = Node.objects.filter(graph=graph)
         if nodes and edges:
             sorted_ids = post_sorted_id(nodes, edges)
             sorted_ids_str = ''
@@ -616,6 +606,50 @@ def sortlist_detail(request, pk):
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
+@api_view(['GET', 'POST'])
+def graphlist(request):
+    '''
+    graph list : nodes & edges of a project (GET), batched edits (POST)
+    '''
+    if request.method == 'GET':
+        graph = get_graph(request)
+        nodes = Node.objects.filter(graph=graph).order_by('order')
+        edges = Edge.objects.filter(graph=graph).order_by('edge_id')
+        return Response({'node': NodeSerializer(nodes, many=True).data,
+                         'edge': EdgeSerializer(edges, many=True).data})
+
+    graph = get_graph(request, create=True)
+    if graph is None:
+        return Response("unknown project", status=status.HTTP_400_BAD_REQUEST)
+    try:
+        counts = edit_graph(graph, request.data)
+    except (ValueError, TypeError, IntegrityError) as e:
+        print(f"graph edit rejected: {e}")
+        return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
+    return Response(counts, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+def shapelist(request):
+    '''
+    shape list : output shape, parameters and FLOPs of every node of the edited graph
+    '''
+    graph = get_graph(request)
+    edges = Edge.objects.filter(graph=graph)
+    nodes = Node.objects.filter(graph=graph)
+    if not nodes:
+        return Response("invalid node or edge",
+                        status=status.HTTP_400_BAD_REQUEST)
+    imgsz = int(request.GET.get('imgsz', 640))
+    ch = int(request.GET.get('ch', 3))
+    results, summary = infer_shapes(graph.pk, nodes, edges, (ch, imgsz, imgsz))
+    return Response({'nodes': results,
+                     'params': summary['params'],
+                     'flops': summary['flops'],
+                     'errors': summary['errors']},
+                    status=status.HTTP_200_OK)
+
+
 @api_view(['GET', 'POST', 'DELETE', 'UPDATE'])
 # pylint: disable = invalid-name, inconsistent-return-statements
 def startList(request):
@@ -636,12 +670,7 @@ def startList(request):
             if serializer.is_valid():
                 serializer.save()
                 try:
-                    print(f"🧹 Clear all nodes & edges")
-                    nodes = Node.objects.all()
-                    nodes.delete()
-
-                    edges = Edge.objects.all()
-                    edges.delete()
+                    graph = get_graph(request, create=True)
 
                     yaml_path = '/shared/common/'+str(user_id)+'/'+str(project_id)+'/basemodel.yaml'
                     json_path = '/shared/common/'+str(user_id)+'/'+str(project_id)+'/basemodel.json'
@@ -1086,16 +1115,9 @@ def startList(request):
                         print(f"🚛 Generate json data")
                         print(json.dumps(json_data, ensure_ascii=False, indent="\t"))
 
-                        # save
-                        for i in json_data.get('node'):
-                            serializer = NodeSerializer(data=i)
-                            if serializer.is_valid():
-                                serializer.save()
-                        for j in json_data.get('edge'):
-                            serializer = EdgeSerializer(data=j)
-                            if serializer.is_valid():
-                                serializer.save()
-                        print(f"🏳‍🌈 Save Nodes and Edges")
+                        # save (only the nodes & edges which differ from the stored graph)
+                        counts = sync_graph(graph, json_data.get('node'), json_data.get('edge'))
+                        print(f"🏳‍🌈 Save Nodes and Edges : {counts}")
 
                     elif os.path.isfile(json_path):
                         # json import
@@ -1104,15 +1126,8 @@ def startList(request):
                         print(f"🚛 Load json file from {json_path}")
                         with open(json_path, "r", encoding="utf-8-sig") as f:
                             data = json.load(f)
-                            for i in data.get('node'):
-                                serializer = NodeSerializer(data=i)
-                                if serializer.is_valid():
-                                    serializer.save()
-                            for j in data.get('edge'):
-                                serializer = EdgeSerializer(data=j)
-                                if serializer.is_valid():
-                                    serializer.save()
-                        print(f"🏳‍🌈 Save Nodes and Edges")
+                        counts = sync_graph(graph, data.get('node'), data.get('edge'))
+                        print(f"🏳‍🌈 Save Nodes and Edges : {counts}")
                     else:
                         print(f"not found basemode.yaml neither basemodel.json")
                         return Response("error", status=404, content_type="text/plain")
@@ -1280,6 +1295,16 @@ class NodeView(viewsets.ModelViewSet):
     '''
     serializer_class = NodeSerializer
     queryset = Node.objects.all()
+    lookup_field = 'order'
+
+    def get_queryset(self):
+        return Node.objects.filter(graph=get_graph(self.request)).order_by('order')
+
+    def perform_create(self, serializer):
+        graph = get_graph(self.request, create=True)
+        if graph is None:
+            raise ValidationError("unknown project")
+        serializer.save(graph=graph)
 
     def print_serializer(self):
         '''
@@ -1301,6 +1326,17 @@ class EdgeView(viewsets.ModelViewSet):
     '''
     serializer_class = EdgeSerializer
     queryset = Edge.objects.all()
+    lookup_field = 'edge_id'
+    lookup_url_kwarg = 'pk'
+
+    def get_queryset(self):
+        return Edge.objects.filter(graph=get_graph(self.request)).order_by('edge_id')
+
+    def perform_create(self, serializer):
+        graph = get_graph(self.request, create=True)
+        if graph is None:
+            raise ValidationError("unknown project")
+        serializer.save(graph=graph)
 
     def print_serializer(self):
         '''
@@ -1448,51 +1484,169 @@ class RunningView(viewsets.ModelViewSet):
 #         print("Stop queryset")
 
 
-def make_branches(get_node, get_edge):
+def parse_params(params_string):
     '''
-    make a graph with nodes and edges and export pytorch model from the graph
+    parse the parameters of a node ("key: value" lines separated by '>') into a dict
+    '''
+    # tenace -------------------------------------------------------------->
+    # workaround to avoid eval() error when a value is string or nn.Module
+    params_dict = {}
+    params_ = params_string.split('>')
+    for p in params_:
+        try:
+            eval_params_ = eval("{"+p+"}")
+        except:
+            # print(p)
+            p_key, p_value = p.split(': ') # [0] key [1] value
+            if 'LeakyReLU' in p_value:
+                p_value = f"nn.{p_value}"
+                eval_params_ = eval("{"+p_key+": "+p_value+"}")
+            elif isinstance(p_value, str):
+                # print(f"---{p_key}---{p_value}---")
+                p_key = p_key.strip()
+                p_value = p_value.strip()
+                # print(f"---{p_key}---{p_value}---")
+                p_key = p_key.replace("'","")
+                p_value = p_value.replace("'", "")
+                # print(f"---{p_key}---{p_value}---")
+                eval_params_[p_key.strip("'")] = p_value
+            else:
+                print("forced to convert string-to-dictionary")
+                p_key.strip()
+                p_value.strip()
+                p_key = p_key.replace("'","")
+                p_value = p_value.replace("'", "")
+                eval_params_[p_key] = p_value
+        finally:
+            params_dict.update(eval_params_)
+    # tenace <--------------------------------------------------------------
+    return params_dict
+
+
+def get_graph(request, create=False):
+    '''
+    graph of the user_id & project_id given in the request (query string or body),
+    of the last started project when they are not given
+    '''
+    data = request.data if hasattr(request.data, 'get') else {}
+    user_id = request.GET.get('user_id', data.get('user_id'))
+    project_id = request.GET.get('project_id', data.get('project_id'))
+    if user_id is None or project_id is None:
+        start = Start.objects.last()
+        if start is None:
+            return None
+        user_id, project_id = start.user_id, start.project_id
+    if create:
+        graph, _ = Graph.objects.get_or_create(user_id=str(user_id), project_id=str(project_id))
+        return graph
+    return Graph.objects.filter(user_id=str(user_id), project_id=str(project_id)).first()
+
+
+def validate_rows(serializer_class, rows, partial=False, skip_invalid=False):
+    '''
+    validated data of node/edge rows, raise ValueError on an invalid row unless skip_invalid
+    '''
+    validated = []
+    for row in rows or []:
+        serializer = serializer_class(data=row, partial=partial)
+        if serializer.is_valid():
+            validated.append(dict(serializer.validated_data))
+        elif not skip_invalid:
+            raise ValueError(f"invalid {row}: {serializer.errors}")
+    return validated
+
+
+def apply_delta(graph, nodes, edges):
+    '''
+    apply validated edits to a graph in one transaction, with one query per kind of edit
+    nodes & edges: {'add': [rows], 'modify': [rows], 'delete': [order or edge_id]}
+    '''
+    counts = {}
+    with transaction.atomic():
+        # deletions first, so that a batch can delete and re-add the same order/id
+        counts['node_deleted'] = Node.objects.filter(
+            graph=graph, order__in=nodes.get('delete', [])).delete()[0]
+        counts['edge_deleted'] = Edge.objects.filter(
+            graph=graph, edge_id__in=edges.get('delete', [])).delete()[0]
+
+        for model, key, fields, delta, name in (
+                (Node, 'order', ('layer', 'parameters'), nodes, 'node'),
+                (Edge, 'edge_id', ('prior', 'next'), edges, 'edge')):
+            modify = {row[key]: row for row in delta.get('modify', [])}
+            rows = list(model.objects.filter(graph=graph, **{f'{key}__in': list(modify)}))
+            if len(rows) != len(modify):
+                found = set(getattr(row, key) for row in rows)
+                raise ValueError(f"{name} {sorted(set(modify) - found)} not found")
+            for row in rows:
+                for field in fields:
+                    if field in modify[getattr(row, key)]:
+                        setattr(row, field, modify[getattr(row, key)][field])
+            model.objects.bulk_update(rows, fields)
+            counts[f'{name}_modified'] = len(rows)
+
+            added = model.objects.bulk_create([model(graph=graph, **row) for row in delta.get('add', [])])
+            counts[f'{name}_added'] = len(added)
+    return counts
+
+
+def edit_graph(graph, delta):
+    '''
+    apply a batch of edits from the editor, all or nothing
+    delta = {'node': {'add': [{order, layer, parameters}], 'modify': [{order, ...}], 'delete': [order]},
+             'edge': {'add': [{id, prior, next}], 'modify': [{id, ...}], 'delete': [id]}}
+    deleting a node deletes its edges too
+    '''
+    node_delta, edge_delta = delta.get('node') or {}, delta.get('edge') or {}
+    nodes = {'add': validate_rows(NodeSerializer, node_delta.get('add')),
+             'modify': validate_rows(NodeSerializer, node_delta.get('modify'), partial=True),
+             'delete': [int(order) for order in node_delta.get('delete') or []]}
+    edges = {'add': validate_rows(EdgeSerializer, edge_delta.get('add')),
+             'modify': validate_rows(EdgeSerializer, edge_delta.get('modify'), partial=True),
+             'delete': [int(id_) for id_ in edge_delta.get('delete') or []]}
+    for name, delta_, key in (('node', nodes, 'order'), ('edge', edges, 'edge_id')):
+        if any(key not in row for row in delta_['modify']):
+            raise ValueError(f"{name} to modify without {'id' if key == 'edge_id' else key}")
+
+    if nodes['delete']:
+        kept = set(row['edge_id'] for row in edges['modify'])
+        dangling = Edge.objects.filter(graph=graph).filter(
+            Q(prior__in=nodes['delete']) | Q(next__in=nodes['delete'])).values_list('edge_id', flat=True)
+        edges['delete'] = list(set(edges['delete']) | (set(dangling) - kept))
+    return apply_delta(graph, nodes, edges)
+
+
+def sync_graph(graph, nodes, edges):
+    '''
+    make a graph hold exactly these node & edge rows, writing only the rows which differ
+    invalid rows are skipped
+    '''
+    nodes = {row['order']: row for row in validate_rows(NodeSerializer, nodes, skip_invalid=True)}
+    edges = {row['edge_id']: row for row in validate_rows(EdgeSerializer, edges, skip_invalid=True)}
+    old_nodes = {row['order']: row for row in
+                 Node.objects.filter(graph=graph).values('order', 'layer', 'parameters')}
+    old_edges = {row['edge_id']: row for row in
+                 Edge.objects.filter(graph=graph).values('edge_id', 'prior', 'next')}
+
+    def diff(new, old):
+        return {'add': [row for key, row in new.items() if key not in old],
+                'modify': [row for key, row in new.items() if key in old and old[key] != row],
+                'delete': [key for key in old if key not in new]}
+
+    return apply_delta(graph, diff(nodes, old_nodes), diff(edges, old_edges))
+
+
+def make_graph(get_node, get_edge):
+    '''
+    make a graph with nodes and edges
     '''
     graph = CGraph()
-    self_binder = CPyBinder()
     for node in get_node:
         # pylint: disable-msg=bad-option-value, consider-using-f-string
         params_string = "{parameters}". \
             format(**node.__dict__).replace("\n", '>')
         # print(f"{params_string}")
 
-        # tenace -------------------------------------------------------------->
-        # workaround to avoid eval() error when a value is string or nn.Module
-        params_dict = {}
-        params_ = params_string.split('>')
-        for p in params_:
-            try:
-                eval_params_ = eval("{"+p+"}")
-            except:
-                # print(p)
-                p_key, p_value = p.split(': ') # [0] key [1] value
-                if 'LeakyReLU' in p_value:
-                    p_value = f"nn.{p_value}"
-                    eval_params_ = eval("{"+p_key+": "+p_value+"}")
-                elif isinstance(p_value, str):
-                    # print(f"---{p_key}---{p_value}---")
-                    p_key = p_key.strip()
-                    p_value = p_value.strip()
-                    # print(f"---{p_key}---{p_value}---")
-                    p_key = p_key.replace("'","")
-                    p_value = p_value.replace("'", "")
-                    # print(f"---{p_key}---{p_value}---")
-                    eval_params_[p_key.strip("'")] = p_value
-                else:
-                    print("forced to convert string-to-dictionary")
-                    p_key.strip()
-                    p_value.strip()
-                    p_key = p_key.replace("'","")
-                    p_value = p_value.replace("'", "")
-                    eval_params_[p_key] = p_value
-            finally:
-                params_dict.update(eval_params_)
-        # print(f"{params_dict}")
-        # tenace <--------------------------------------------------------------
+        params_dict = parse_params(params_string)
 
         # pylint: disable-msg=bad-option-value, eval-used
         graph.addnode(CNode("{order}".format(**node.__dict__),
@@ -1502,11 +1656,37 @@ def make_branches(get_node, get_edge):
         # pylint: disable-msg=bad-option-value, consider-using-f-string
         graph.addedge(CEdge("{prior}".format(**edge.__dict__),
                             "{next}".format(**edge.__dict__)))
+    return graph
+
+
+def make_branches(get_node, get_edge):
+    '''
+    make a graph with nodes and edges and export pytorch model from the graph
+    '''
+    graph = make_graph(get_node, get_edge)
+    self_binder = CPyBinder()
     net = CPyBinder.exportmodel(self_binder, graph)
     print(net)
     return net
 
 
+def infer_shapes(key, get_node, get_edge, input_shape=None):
+    '''
+    shapes, parameters and FLOPs of the graph nodes, without building the model
+    only the nodes changed since the previous call for the same key are recomputed
+    '''
+    graph = make_graph(get_node, get_edge)
+    with SHAPE_LOCK:
+        engine = SHAPE_INFERENCE.setdefault(key, CShapeInference())
+        if input_shape is not None and tuple(input_shape) != engine.input_shape:
+            engine.input_shape = tuple(input_shape)
+        results = engine.infer(graph)
+        summary = engine.summary(results)
+        print(f"shape inference: {len(engine.recomputed)}/{len(results)} nodes recomputed, "
+              f"{summary['params']:,} parameters, {summary['flops'] / 1E9:.1f} GFLOPs")
+    return results, summary
+
+
 def post_sorted_id(get_node, get_edge):
     '''
     test branches
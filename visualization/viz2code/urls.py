@@ -32,6 +32,8 @@ urlpatterns = [
     path('api/pth/', views.pthlist),
     path('api/sort/', views.sortlist),
     path('api/sort/<int:pk>/', views.sortlist_detail),
+    path('api/shape/', views.shapelist),
+    path('api/graph/', views.graphlist),
     path('start', views.startList),
     path('stop', views.stopList),
     path('status_request', views.statusList),